@@ -0,0 +1,4 @@
+"""
+Loopback benchmarks for the STEP server.
+Run them from the Codes folder, e.g. python -m benchmark.bench_engine
+"""
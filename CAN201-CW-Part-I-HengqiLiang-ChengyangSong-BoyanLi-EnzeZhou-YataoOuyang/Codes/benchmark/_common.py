@@ -0,0 +1,201 @@
+import asyncio
+import contextlib
+import hashlib
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import json
+
+CODES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_PATH = os.path.join(CODES_DIR, 'server.py')
+if CODES_DIR not in sys.path:
+    sys.path.insert(0, CODES_DIR)
+
+import server  # noqa: E402  (the STEP constants and make_packet)
+
+
+def free_port():
+    """
+    Ask the kernel for a free TCP port on loopback
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def start_server(*server_args, workdir=None, server_path=SERVER_PATH):
+    """
+    Start server.py on loopback inside a temp directory and stop it afterwards
+    :param server_args: extra command line arguments of server.py
+    :param workdir: run in this folder instead of a fresh temp directory
+    :param server_path: another server.py to run, e.g. from a checkout of an older commit
+    :return: (process, port, workdir)
+    """
+    port = free_port()
+    with contextlib.ExitStack() as stack:
+        if workdir is None:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix='step_bench_'))
+        proc = subprocess.Popen([sys.executable, server_path, '--ip', '127.0.0.1', '--port', str(port),
+                                 *server_args], cwd=workdir,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.time() + 10
+            while True:
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    break
+                except OSError:
+                    if proc.poll() is not None or time.time() > deadline:
+                        raise RuntimeError(f'server.py {" ".join(server_args)} did not start')
+                    time.sleep(0.05)
+            yield proc, port, workdir
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+
+def proc_stats(pid):
+    """
+    Read the memory and thread counters of a process from /proc (Linux only)
+    :return: {'rss_kb', 'peak_rss_kb', 'threads'}
+    """
+    stats = {}
+    try:
+        with open(f'/proc/{pid}/status') as fid:
+            for line in fid:
+                name, _, value = line.partition(':')
+                if name == 'VmRSS':
+                    stats['rss_kb'] = int(value.split()[0])
+                elif name == 'VmHWM':
+                    stats['peak_rss_kb'] = int(value.split()[0])
+                elif name == 'Threads':
+                    stats['threads'] = int(value)
+    except OSError:
+        pass
+    return stats
+
+
+def proc_tree(pid):
+    """
+    A process and its child processes, e.g. the workers of server.py --workers (Linux only)
+    """
+    pids = [pid]
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as fid:
+                pids += [int(child) for child in fid.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def proc_cpu_seconds(pid):
+    """
+    User + system CPU time of a process and its children from /proc (Linux only), 0.0 if unavailable
+    """
+    seconds = 0.0
+    for one in proc_tree(pid):
+        try:
+            with open(f'/proc/{one}/stat') as fid:
+                # The command name may contain spaces, the counters follow its closing parenthesis
+                fields = fid.read().rpartition(')')[2].split()
+            seconds += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError):
+            pass
+    return seconds
+
+
+def proc_peak_rss_kb(pid):
+    """
+    Sum of the peak RSS of a process and its children, None if unavailable
+    """
+    peaks = [proc_stats(one).get('peak_rss_kb') for one in proc_tree(pid)]
+    return sum(peaks) if None not in peaks else None
+
+
+def reset_peak_rss(pid):
+    """
+    Reset the VmHWM (peak RSS) counter of a process and its children so the next phase measures its own peak
+    """
+    for one in proc_tree(pid):
+        try:
+            with open(f'/proc/{one}/clear_refs', 'w') as fid:
+                fid.write('5')
+        except OSError:
+            pass
+
+
+def recv_packet(sock):
+    """
+    Blocking read of one STEP frame, kept independent from the code under test
+    """
+    def recv_exactly(n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError('connection closed')
+            buf += chunk
+        return bytes(buf)
+
+    j_len, b_len = struct.unpack('!II', recv_exactly(8))
+    json_data = json.loads(recv_exactly(j_len).decode())
+    return json_data, recv_exactly(b_len)
+
+
+def login(port, username='bench'):
+    """
+    LOGIN and return the token
+    """
+    with socket.create_connection(('127.0.0.1', port)) as s:
+        s.sendall(server.make_packet({
+            server.FIELD_OPERATION: server.OP_LOGIN,
+            server.FIELD_DIRECTION: server.DIR_REQUEST,
+            server.FIELD_TYPE: server.TYPE_AUTH,
+            server.FIELD_USERNAME: username,
+            server.FIELD_PASSWORD: hashlib.md5(username.encode()).hexdigest()
+        }))
+        json_data, _ = recv_packet(s)
+    return json_data[server.FIELD_TOKEN]
+
+
+async def open_connection(port, retries=50):
+    """
+    asyncio connect with retries, a burst of clients may overflow a small accept backlog
+    """
+    for attempt in range(retries):
+        try:
+            return await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(0.05 * (attempt + 1))
+    raise ConnectionError(f'cannot connect to 127.0.0.1:{port}')
+
+
+async def async_call(reader, writer, json_data, bin_data=None):
+    """
+    Send one STEP request and wait for its response on an asyncio stream
+    """
+    writer.write(server.make_packet(json_data, bin_data))
+    j_len, b_len = struct.unpack('!II', await reader.readexactly(8))
+    response = json.loads((await reader.readexactly(j_len)).decode())
+    return response, await reader.readexactly(b_len)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a list of numbers
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
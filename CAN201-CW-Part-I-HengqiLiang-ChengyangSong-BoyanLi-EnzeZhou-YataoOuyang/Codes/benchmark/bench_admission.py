@@ -0,0 +1,110 @@
+"""
+A burst of clients against the default limits and against a small worker pool / pending queue.
+Every client connects at the same time and runs DATA SAVE/GET requests; a busy answer (503) is waited
+out for its "retry_after" and the client reconnects. Reports the clients served, the busy answers,
+the connections that failed anyway, the per-client completion time and the server's peak threads and RSS.
+
+    python -m benchmark.bench_admission --clients 2000 --requests 20
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from benchmark._common import server, start_server, login, open_connection, async_call, proc_stats, percentile
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--clients", default=1000, type=int, help="Clients of the burst. Default is 1000.")
+    parse.add_argument("--requests", default=20, type=int, help="DATA requests of every client. Default is 20.")
+    return parse.parse_args()
+
+
+class Counters:
+    def __init__(self):
+        self.busy = 0
+        self.errors = 0
+        self.times = []
+
+
+async def _one_client(port, token, client_id, requests, counters):
+    start = time.perf_counter()
+    base = {server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TYPE: server.TYPE_DATA,
+            server.FIELD_TOKEN: token}
+    done = 0
+    writer = None
+    try:
+        while done < requests:
+            if writer is None:
+                reader, writer = await open_connection(port)
+            operation = server.OP_SAVE if done % 2 == 0 else server.OP_GET
+            response, _ = await async_call(reader, writer, {**base, server.FIELD_OPERATION: operation,
+                                                            server.FIELD_KEY: f'burst_{client_id}_{done // 2}'})
+            if response.get(server.FIELD_STATUS) == 503:
+                counters.busy += 1
+                writer.close()
+                writer = None
+                await asyncio.sleep(response.get(server.FIELD_RETRY_AFTER, 100) / 1000)
+                continue
+            done += 1
+        counters.times.append(time.perf_counter() - start)
+    except (OSError, asyncio.IncompleteReadError):
+        counters.errors += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def run(label, server_args, clients, requests):
+    with start_server(*server_args) as (proc, port, _):
+        token = login(port)
+        counters = Counters()
+        peak_threads = 0
+        sampling = True
+
+        def sampler():
+            nonlocal peak_threads
+            while sampling:
+                peak_threads = max(peak_threads, proc_stats(proc.pid).get('threads', 0))
+                time.sleep(0.02)
+
+        th = threading.Thread(target=sampler, daemon=True)
+        th.start()
+
+        async def burst():
+            await asyncio.gather(*[_one_client(port, token, i, requests, counters) for i in range(clients)])
+
+        start = time.perf_counter()
+        asyncio.run(burst())
+        elapsed = time.perf_counter() - start
+        sampling = False
+        th.join()
+        stats = proc_stats(proc.pid)
+    return {
+        'case': label,
+        'server_args': ' '.join(server_args),
+        'clients': clients,
+        'served': len(counters.times),
+        'busy_answers': counters.busy,
+        'failed_connections': counters.errors,
+        'seconds': round(elapsed, 3),
+        'p50_client_s': round(percentile(counters.times, 50), 3),
+        'p99_client_s': round(percentile(counters.times, 99), 3),
+        'peak_threads': peak_threads,
+        'peak_rss_kb': stats.get('peak_rss_kb'),
+    }
+
+
+def main():
+    args = _argparse()
+    cases = (('thread, defaults', []),
+             ('thread, 64 threads + 64 pending', ['--max_connections', '64', '--max_pending', '64']),
+             ('async, defaults', ['--engine', 'async']),
+             ('async, 16 threads + 16 pending', ['--engine', 'async', '--async_threads', '16', '--max_pending', '16']))
+    print(json.dumps([run(label, server_args, args.clients, args.requests) for label, server_args in cases], indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Microbenchmark of the per-request token check in STEP_request, in process (no sockets).
+"cold" gives every request a fresh ConnectionState and an empty directory cache, like the
+server did before caching; "cached" reuses one ConnectionState like a persistent connection.
+
+    python -m benchmark.bench_auth --requests 100000
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from benchmark._common import server
+
+
+class NullConnection:
+    def send(self, data):
+        return len(data)
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--requests", default=100000, type=int, help="Requests per mode. Default is 100000.")
+    return parse.parse_args()
+
+
+def make_token(username):
+    user_str = f'{username}.{server.get_time_based_filename("login")}'
+    md5_auth_str = hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest()
+    return base64.b64encode(f'{user_str}.{md5_auth_str}'.encode()).decode()
+
+
+def run(mode, requests):
+    # BYE on FILE passes the token check and does nothing in file_process
+    request = {server.FIELD_OPERATION: server.OP_BYE, server.FIELD_DIRECTION: server.DIR_REQUEST,
+               server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_TOKEN: make_token('bench')}
+    connection = NullConnection()
+    state = server.ConnectionState()
+    start = time.perf_counter()
+    for _ in range(requests):
+        if mode == 'cold':
+            state = server.ConnectionState()
+            server.user_dirs_ready.clear()
+        server.STEP_request(connection, request, b'', state)
+    elapsed = time.perf_counter() - start
+    return {'mode': mode, 'requests': requests, 'us_per_request': round(elapsed / requests * 1e6, 2)}
+
+
+def main():
+    args = _argparse()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            results = [run(mode, args.requests) for mode in ('cold', 'cached')]
+        finally:
+            os.chdir(cwd)
+    results.append({'saved_us_per_request': round(results[0]['us_per_request'] - results[1]['us_per_request'], 2)})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
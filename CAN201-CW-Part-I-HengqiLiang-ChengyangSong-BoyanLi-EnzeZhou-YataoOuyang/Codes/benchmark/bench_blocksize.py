@@ -0,0 +1,76 @@
+"""
+Sweep the negotiated block size: upload a file with client.py, then GET its plan and DOWNLOAD
+every block over one connection. "default" leaves the choice to the server (MAX_PACKET_SIZE).
+
+    python -m benchmark.bench_blocksize --size_mb 32 --block_sizes default,65536,1048576,8388608
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import tempfile
+import time
+
+from benchmark._common import server, start_server, login, recv_packet
+
+import client
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--size_mb", default=32, type=float, help="Size of the file. Default is 32 MB.")
+    parse.add_argument("--block_sizes", default='default,65536,262144,1048576,4194304,8388608',
+                       help="Comma separated block sizes in bytes, 'default' for the server's choice.")
+    return parse.parse_args()
+
+
+def download(port, token, key, block_size):
+    request = {server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TYPE: server.TYPE_FILE,
+               server.FIELD_TOKEN: token, server.FIELD_KEY: key}
+    if block_size is not None:
+        request[server.FIELD_BLOCK_SIZE] = block_size
+    with socket.create_connection(('127.0.0.1', port)) as s:
+        s.sendall(server.make_packet({**request, server.FIELD_OPERATION: server.OP_GET}))
+        plan, _ = recv_packet(s)
+        assert plan[server.FIELD_STATUS] == 200, plan
+        request[server.FIELD_BLOCK_SIZE] = plan[server.FIELD_BLOCK_SIZE]
+        for block_index in range(plan[server.FIELD_TOTAL_BLOCK]):
+            s.sendall(server.make_packet({**request, server.FIELD_OPERATION: server.OP_DOWNLOAD,
+                                          server.FIELD_BLOCK_INDEX: block_index}))
+            response, _ = recv_packet(s)
+            assert response[server.FIELD_STATUS] == 200, response
+    return plan[server.FIELD_BLOCK_SIZE]
+
+
+def run(block_size, file_path):
+    size = os.path.getsize(file_path)
+    with start_server() as (proc, port, _):
+        token = login(port)
+        client.SERVER_IP, client.SERVER_PORT = '127.0.0.1', port
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ok = client.upload_file(token, file_path, max_retries=1, block_size=block_size)
+        upload_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        planned = download(port, token, os.path.basename(file_path), block_size)
+        download_seconds = time.perf_counter() - start
+    return {'block_size': planned, 'asked': block_size, 'ok': bool(ok),
+            'upload_MB_per_s': round(size / upload_seconds / 1024 / 1024, 2),
+            'download_MB_per_s': round(size / download_seconds / 1024 / 1024, 2)}
+
+
+def main():
+    args = _argparse()
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = os.path.join(tmp, 'bench_blocksize.bin')
+        with open(file_path, 'wb') as fid:
+            fid.write(os.urandom(int(args.size_mb * 1024 * 1024)))
+        results = [run(None if block_size == 'default' else int(block_size), file_path)
+                   for block_size in args.block_sizes.split(',')]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
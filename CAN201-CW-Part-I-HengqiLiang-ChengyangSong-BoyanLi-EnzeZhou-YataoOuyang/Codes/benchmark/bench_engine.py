@@ -0,0 +1,85 @@
+"""
+Compare the thread-per-connection listener with the asyncio engine.
+Many concurrent clients each keep one connection, SAVE a file plan and UPLOAD its blocks.
+
+    python -m benchmark.bench_engine --clients 1000 --blocks 4
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from benchmark._common import server, start_server, login, open_connection, async_call, proc_stats
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--clients", default=500, type=int, help="Concurrent connections. Default is 500.")
+    parse.add_argument("--blocks", default=4, type=int, help="Blocks uploaded by every client. Default is 4.")
+    parse.add_argument("--engines", default='thread,async', help="Engines to compare. Default is thread,async.")
+    return parse.parse_args()
+
+
+async def _one_client(port, token, client_id, blocks, payload):
+    reader, writer = await open_connection(port)
+    key = f'engine_{client_id}'
+    base = {server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TYPE: server.TYPE_FILE,
+            server.FIELD_TOKEN: token, server.FIELD_KEY: key}
+    plan, _ = await async_call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_SAVE,
+                                                server.FIELD_SIZE: len(payload) * blocks})
+    assert plan[server.FIELD_STATUS] == 200, plan
+    for block_index in range(blocks):
+        response, _ = await async_call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_UPLOAD,
+                                                        server.FIELD_BLOCK_INDEX: block_index}, payload)
+        assert response[server.FIELD_STATUS] == 200, response
+    writer.close()
+
+
+async def _run_clients(port, token, clients, blocks):
+    payload = b'x' * server.MAX_PACKET_SIZE
+    await asyncio.gather(*[_one_client(port, token, i, blocks, payload) for i in range(clients)])
+
+
+def run(engine, clients, blocks):
+    with start_server('--engine', engine) as (proc, port, _):
+        token = login(port)
+        peak_threads = 0
+        sampling = True
+
+        def sampler():
+            nonlocal peak_threads
+            while sampling:
+                peak_threads = max(peak_threads, proc_stats(proc.pid).get('threads', 0))
+                time.sleep(0.02)
+
+        th = threading.Thread(target=sampler, daemon=True)
+        th.start()
+        start = time.perf_counter()
+        asyncio.run(_run_clients(port, token, clients, blocks))
+        elapsed = time.perf_counter() - start
+        sampling = False
+        th.join()
+        stats = proc_stats(proc.pid)
+
+    requests = clients * (blocks + 1)
+    return {
+        'engine': engine,
+        'clients': clients,
+        'blocks_per_client': blocks,
+        'seconds': round(elapsed, 3),
+        'requests_per_s': round(requests / elapsed, 1),
+        'MB_per_s': round(clients * blocks * server.MAX_PACKET_SIZE / elapsed / 1024 / 1024, 2),
+        'peak_threads': peak_threads,
+        'peak_rss_kb': stats.get('peak_rss_kb'),
+    }
+
+
+def main():
+    args = _argparse()
+    results = [run(engine, args.clients, args.blocks) for engine in args.engines.split(',')]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
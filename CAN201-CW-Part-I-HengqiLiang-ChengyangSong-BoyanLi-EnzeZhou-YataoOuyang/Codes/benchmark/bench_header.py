@@ -0,0 +1,63 @@
+"""
+Per-block header cost in process: make and parse the UPLOAD request and response headers
+of one block, with the json header and with the binary header (interned token and key).
+
+    python -m benchmark.bench_header --blocks 100000
+"""
+import argparse
+import json
+import struct
+import time
+
+from benchmark._common import server
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--blocks", default=100000, type=int, help="Blocks per mode. Default is 100000.")
+    return parse.parse_args()
+
+
+def parse(packet, table):
+    j_len, b_len = struct.unpack_from('!II', packet, 0)
+    if j_len & server.BINARY_HEADER_FLAG:
+        j_len &= ~server.BINARY_HEADER_FLAG
+        return server.decode_binary_header(memoryview(packet)[8:8 + j_len], table)
+    return json.loads(packet[8:8 + j_len])
+
+
+def run(mode, blocks):
+    client_table, server_table = (server.HeaderTable(), server.HeaderTable()) if mode == 'binary' else (None, None)
+    request = {server.FIELD_OPERATION: server.OP_UPLOAD, server.FIELD_DIRECTION: server.DIR_REQUEST,
+               server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_TOKEN: 'YmVuY2guMjAyNC4xMC4xN' * 3,
+               server.FIELD_KEY: 'some_folder_name/a_fairly_long_file_name.csv'}
+    header_bytes = 0
+    start = time.perf_counter()
+    for block_index in range(blocks):
+        request[server.FIELD_BLOCK_INDEX] = block_index
+        if client_table is not None:
+            header = server.encode_binary_header(request, client_table, True)
+            packet = struct.pack('!II', len(header) | server.BINARY_HEADER_FLAG, 0) + header
+        else:
+            packet = server.make_packet(request)
+        json_data = parse(packet, server_table)
+        response = {server.FIELD_KEY: json_data[server.FIELD_KEY],
+                    server.FIELD_BLOCK_INDEX: json_data[server.FIELD_BLOCK_INDEX],
+                    server.FIELD_OPERATION: server.OP_UPLOAD, server.FIELD_DIRECTION: server.DIR_RESPONSE,
+                    server.FIELD_STATUS: 200, server.FIELD_STATUS_MSG: f'The block {block_index} is uploaded.',
+                    server.FIELD_TYPE: server.TYPE_FILE}
+        reply = server.make_packet(response, None, server_table)
+        parse(reply, client_table)
+        header_bytes += len(packet) + len(reply)
+    elapsed = time.perf_counter() - start
+    return {'mode': mode, 'blocks': blocks, 'us_per_block': round(elapsed / blocks * 1e6, 2),
+            'header_bytes_per_block': round(header_bytes / blocks, 1)}
+
+
+def main():
+    args = _argparse()
+    print(json.dumps([run(mode, args.blocks) for mode in ('json', 'binary')], indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Cost of logging on the request path.
+"in-process" has many threads log per-block lines through set_logger with the handlers called
+directly (as before) or behind the queue, with every line or with sampling.
+"server" has concurrent clients upload and download a file block by block against server.py
+with every block logged, with the default sampling and with --log_level WARNING.
+
+    python -m benchmark.bench_logging --threads 16 --lines 20000 --size_mb 16
+"""
+import argparse
+import asyncio
+import atexit
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark._common import server, start_server, login, open_connection, async_call
+
+name_counter = itertools.count()
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--threads", default=16, type=int, help="Logging threads in process. Default is 16.")
+    parse.add_argument("--lines", default=20000, type=int, help="Lines logged by every thread. Default is 20000.")
+    parse.add_argument("--size_mb", default=16, type=float, help="Size of the file sent to the server. Default is 16.")
+    parse.add_argument("--clients", default=8, type=int, help="Concurrent server clients. Default is 8.")
+    return parse.parse_args()
+
+
+def run_in_process(queued, block_log_every, threads, lines):
+    cwd, stderr = os.getcwd(), sys.stderr
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull:
+        os.chdir(tmp)
+        sys.stderr = devnull  # the StreamHandler of set_logger binds sys.stderr when it is created
+        try:
+            logger = server.set_logger(f'bench{next(name_counter)}', block_log_every=block_log_every, queued=queued)
+
+            def worker(worker_id):
+                for i in range(lines):
+                    logger.info(f'--> Upload file/block of "key" bench_{worker_id}_{i}.', extra=server.BLOCK_LOG)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(worker, range(threads)))
+            elapsed = time.perf_counter() - start
+            for handler in logger.handlers:
+                if getattr(handler, 'listener', None) is not None:
+                    # Drain the queue before stderr is restored
+                    atexit.unregister(handler.listener.stop)
+                    handler.listener.stop()
+                handler.close()
+        finally:
+            os.chdir(cwd)
+            sys.stderr = stderr
+    return {'mode': 'in-process', 'queued': queued, 'block_log_every': block_log_every,
+            'lines_per_s': round(threads * lines / elapsed, 1), 'us_per_line': round(elapsed / (threads * lines) * 1e6, 3)}
+
+
+async def _one_client(port, token, key, payload):
+    reader, writer = await open_connection(port)
+    base = {server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TYPE: server.TYPE_FILE,
+            server.FIELD_TOKEN: token, server.FIELD_KEY: key}
+    plan, _ = await async_call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_SAVE,
+                                                server.FIELD_SIZE: len(payload)})
+    block_size = plan[server.FIELD_BLOCK_SIZE]
+    for block_index in range(plan[server.FIELD_TOTAL_BLOCK]):
+        await async_call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_UPLOAD,
+                                          server.FIELD_BLOCK_INDEX: block_index},
+                         payload[block_index * block_size:(block_index + 1) * block_size])
+    for block_index in range(plan[server.FIELD_TOTAL_BLOCK]):
+        await async_call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_DOWNLOAD,
+                                          server.FIELD_BLOCK_INDEX: block_index})
+    writer.close()
+
+
+def run_server(label, server_args, clients, payload):
+    with start_server(*server_args) as (proc, port, _):
+        token = login(port)
+
+        async def run_clients():
+            await asyncio.gather(*[_one_client(port, token, f'log_{i}', payload) for i in range(clients)])
+
+        start = time.perf_counter()
+        asyncio.run(run_clients())
+        elapsed = time.perf_counter() - start
+    return {'mode': 'server', 'logging': label, 'server_args': ' '.join(server_args),
+            'MB_per_s': round(2 * clients * len(payload) / elapsed / 1024 / 1024, 2)}
+
+
+def main():
+    args = _argparse()
+    results = [run_in_process(queued, every, args.threads, args.lines)
+               for queued, every in ((False, 1), (True, 1), (True, 100))]
+    payload = os.urandom(int(args.size_mb * 1024 * 1024))
+    for label, server_args in (('every block', ['--block_log_every', '1']),
+                               ('sampled', []),
+                               ('warnings only', ['--log_level', 'WARNING'])):
+        results.append(run_server(label, server_args, args.clients, payload))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Blocks written in random order, as parallel and resumed uploads do, into a file made like the tmp file
+of an upload plan: "sparse" (seek to the end and write one byte, as before) or "fallocate"
+(server.preallocate). Reports the time to make the file, the write time including the final fsync,
+the extents of the written file (filefrag, if installed) and the sequential read back with the file
+dropped from the page cache, which is where fragmentation shows.
+
+    python -m benchmark.bench_prealloc --size_mb 512 --block_kb 64 --dir /path/on/the/server/disk
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from benchmark._common import server
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--size_mb", default=256, type=float, help="Size of the file. Default is 256.")
+    parse.add_argument("--block_kb", default=64, type=int, help="Size of the written blocks. Default is 64.")
+    parse.add_argument("--dir", default=None, help="Folder of the file, on the file system to test. "
+                                                   "Default is the system temp folder.")
+    parse.add_argument("--repeat", default=3, type=int, help="Runs of every mode. Default is 3.")
+    return parse.parse_args()
+
+
+def make_sparse(path, size):
+    with open(path, 'wb+') as fid:
+        fid.seek(size - 1)
+        fid.write(b'\0')
+
+
+def extents(path):
+    """
+    :return: number of extents of the file, or None without filefrag
+    """
+    if shutil.which('filefrag') is None:
+        return None
+    out = subprocess.run(['filefrag', path], capture_output=True, text=True).stdout
+    m = re.search(r'(\d+) extents? found', out)
+    return int(m.group(1)) if m else None
+
+
+def run(mode, folder, size, block_size, seed):
+    path = os.path.join(folder, f'prealloc_{mode}')
+    order = list(range(size // block_size))
+    random.Random(seed).shuffle(order)
+    block = os.urandom(block_size)
+
+    start = time.perf_counter()
+    if mode == 'sparse':
+        make_sparse(path, size)
+    else:
+        server.preallocate(path, size)
+    create_s = time.perf_counter() - start
+
+    fd = os.open(path, os.O_RDWR)
+    try:
+        start = time.perf_counter()
+        for block_index in order:
+            os.pwrite(fd, block, block_index * block_size)
+        os.fsync(fd)
+        write_s = time.perf_counter() - start
+
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        start = time.perf_counter()
+        offset = 0
+        while True:
+            data = os.pread(fd, 1024 * 1024, offset)
+            if not data:
+                break
+            offset += len(data)
+        read_s = time.perf_counter() - start
+    finally:
+        os.close(fd)
+    result = {'mode': mode, 'create_ms': round(create_s * 1000, 2),
+              'write_MB_per_s': round(size / write_s / 1024 / 1024, 1),
+              'read_back_MB_per_s': round(size / read_s / 1024 / 1024, 1),
+              'extents': extents(path)}
+    os.remove(path)
+    return result
+
+
+def main():
+    args = _argparse()
+    block_size = args.block_kb * 1024
+    size = int(args.size_mb * 1024 * 1024) // block_size * block_size
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as folder:
+        for i in range(args.repeat):
+            for mode in ('sparse', 'fallocate'):
+                results.append({'run': i + 1, **run(mode, folder, size, block_size, seed=i)})
+    print(json.dumps({'size_mb': size / 1024 / 1024, 'block_kb': args.block_kb,
+                      'posix_fallocate': hasattr(os, 'posix_fallocate'), 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+The full loopback sweep: FILE SAVE/UPLOAD and GET/DOWNLOAD over file sizes x block sizes x client
+concurrency, and DATA SAVE/GET/DELETE over client concurrency, one key per request ("data") and in
+batches of --data_batch keys per request ("data_batch"). Every case runs against a fresh
+server and reports throughput, p50/p99 request latency, server CPU time and peak RSS as JSON.
+
+    python -m benchmark.bench_suite --out before.json
+    python -m benchmark.bench_suite --baseline before.json --tolerance 0.1
+
+With --baseline the cases are matched against an earlier run and the ones whose throughput dropped
+or whose p99 latency grew by more than the tolerance are listed as regressions (exit status 1).
+--server runs another server.py, e.g. one from a git worktree of an older commit, for a direct A/B.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from benchmark._common import server, start_server, login, open_connection, async_call, proc_peak_rss_kb, \
+    proc_cpu_seconds, reset_peak_rss, percentile, SERVER_PATH
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--file_sizes", default='1048576,16777216',
+                       help="Comma separated file sizes in bytes. Default is 1048576,16777216.")
+    parse.add_argument("--block_sizes", default='default,1048576',
+                       help="Comma separated block sizes in bytes, 'default' for the server's choice.")
+    parse.add_argument("--concurrency", default='1,8,32',
+                       help="Comma separated numbers of concurrent clients. Default is 1,8,32.")
+    parse.add_argument("--data_ops", default=200, type=int,
+                       help="DATA SAVE/GET/DELETE rounds per client. Default is 200.")
+    parse.add_argument("--data_batch", default=100, type=int,
+                       help="Keys per batched DATA request of the data_batch workload. Default is 100.")
+    parse.add_argument("--workloads", default='file,data,data_batch',
+                       help="Workloads to run. Default is file,data,data_batch.")
+    parse.add_argument("--server", default=SERVER_PATH, help="server.py to benchmark. Default is this tree's.")
+    parse.add_argument("--server_args", default='', help="Extra arguments of server.py, e.g. '--engine async'.")
+    parse.add_argument("--out", default=None, help="Also write the results to this JSON file.")
+    parse.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare against.")
+    parse.add_argument("--tolerance", default=0.1, type=float,
+                       help="Relative change counted as a regression. Default is 0.1 (10%%).")
+    return parse.parse_args()
+
+
+class Phase:
+    """
+    Latencies of one measured phase, together with the server's CPU time and peak RSS (summed over
+    the --workers processes)
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.latencies = []
+        self.errors = 0
+
+    def __enter__(self):
+        reset_peak_rss(self.pid)
+        self.cpu = proc_cpu_seconds(self.pid)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.cpu = proc_cpu_seconds(self.pid) - self.cpu
+        self.peak_rss_kb = proc_peak_rss_kb(self.pid)
+
+    async def call(self, reader, writer, json_data, bin_data=None):
+        start = time.perf_counter()
+        response, bin_data = await async_call(reader, writer, json_data, bin_data)
+        self.latencies.append(time.perf_counter() - start)
+        if response.get(server.FIELD_STATUS) != 200:
+            self.errors += 1
+        return response, bin_data
+
+    def report(self, payload_bytes=None, items=None):
+        rval = {
+            'seconds': round(self.seconds, 3),
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'requests_per_s': round(len(self.latencies) / self.seconds, 1),
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 3),
+            'cpu_seconds': round(self.cpu, 3),
+            'cpu_percent': round(self.cpu / self.seconds * 100, 1),
+            'peak_rss_kb': self.peak_rss_kb,
+        }
+        if payload_bytes is not None:
+            rval['MB_per_s'] = round(payload_bytes / self.seconds / 1024 / 1024, 2)
+        if items is not None:
+            rval['items_per_s'] = round(items / self.seconds, 1)
+        return rval
+
+
+async def _upload_one(phase, port, token, key, payload, block_size):
+    reader, writer = await open_connection(port)
+    base = {server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TYPE: server.TYPE_FILE,
+            server.FIELD_TOKEN: token, server.FIELD_KEY: key}
+    save_request = {**base, server.FIELD_OPERATION: server.OP_SAVE, server.FIELD_SIZE: len(payload)}
+    if block_size is not None:
+        save_request[server.FIELD_BLOCK_SIZE] = block_size
+    plan, _ = await phase.call(reader, writer, save_request)
+    planned = plan.get(server.FIELD_BLOCK_SIZE, server.MAX_PACKET_SIZE)
+    view = memoryview(payload)
+    for block_index in range(plan.get(server.FIELD_TOTAL_BLOCK, 0)):
+        await phase.call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_UPLOAD,
+                                          server.FIELD_BLOCK_INDEX: block_index},
+                         view[block_index * planned:(block_index + 1) * planned])
+    writer.close()
+    return planned
+
+
+async def _download_one(phase, port, token, key, block_size):
+    reader, writer = await open_connection(port)
+    base = {server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TYPE: server.TYPE_FILE,
+            server.FIELD_TOKEN: token, server.FIELD_KEY: key}
+    if block_size is not None:
+        base[server.FIELD_BLOCK_SIZE] = block_size
+    plan, _ = await phase.call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_GET})
+    # Echo the planned block size, the block indexes are only valid for it
+    base[server.FIELD_BLOCK_SIZE] = plan.get(server.FIELD_BLOCK_SIZE, server.MAX_PACKET_SIZE)
+    received = 0
+    for block_index in range(plan.get(server.FIELD_TOTAL_BLOCK, 0)):
+        _, bin_data = await phase.call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_DOWNLOAD,
+                                                        server.FIELD_BLOCK_INDEX: block_index})
+        received += len(bin_data)
+    writer.close()
+    return received
+
+
+async def _data_one(phase, port, token, client_id, rounds):
+    reader, writer = await open_connection(port)
+    base = {server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TYPE: server.TYPE_DATA,
+            server.FIELD_TOKEN: token}
+    for i in range(rounds):
+        key = f'suite_{client_id}_{i}'
+        await phase.call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_SAVE, server.FIELD_KEY: key,
+                                          'value': {'client': client_id, 'round': i, 'text': 'x' * 64}})
+        await phase.call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_GET, server.FIELD_KEY: key})
+        await phase.call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_DELETE, server.FIELD_KEY: key})
+    writer.close()
+
+
+async def _data_batch_one(phase, port, token, client_id, rounds, batch):
+    reader, writer = await open_connection(port)
+    base = {server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TYPE: server.TYPE_DATA,
+            server.FIELD_TOKEN: token}
+    for i in range(0, rounds, batch):
+        keys = [f'suite_{client_id}_{j}' for j in range(i, min(i + batch, rounds))]
+        items = [{server.FIELD_KEY: key, 'value': {'client': client_id, 'round': j, 'text': 'x' * 64}}
+                 for j, key in enumerate(keys, i)]
+        for json_data in ({**base, server.FIELD_OPERATION: server.OP_SAVE, server.FIELD_ITEMS: items},
+                          {**base, server.FIELD_OPERATION: server.OP_GET, server.FIELD_KEYS: keys},
+                          {**base, server.FIELD_OPERATION: server.OP_DELETE, server.FIELD_KEYS: keys}):
+            response, _ = await phase.call(reader, writer, json_data)
+            phase.errors += sum(1 for result in response.get(server.FIELD_RESULTS, []) if result[server.FIELD_STATUS] != 200)
+    writer.close()
+
+
+def run_file(args, file_size, block_size, concurrency, payload):
+    with start_server(*args.server_args.split(), server_path=args.server) as (proc, port, _):
+        token = login(port)
+        keys = [f'suite_{concurrency}_{i}' for i in range(concurrency)]
+
+        async def upload(phase):
+            return await asyncio.gather(*[_upload_one(phase, port, token, key, payload, block_size) for key in keys])
+
+        async def download(phase):
+            return await asyncio.gather(*[_download_one(phase, port, token, key, block_size) for key in keys])
+
+        with Phase(proc.pid) as upload_phase:
+            planned = asyncio.run(upload(upload_phase))[0]
+        with Phase(proc.pid) as download_phase:
+            received = sum(asyncio.run(download(download_phase)))
+
+    case = {'file_size': file_size, 'block_size': 'default' if block_size is None else block_size,
+            'planned_block_size': planned, 'concurrency': concurrency}
+    download_report = download_phase.report(received)
+    if received != file_size * concurrency:
+        download_report['errors'] += 1
+    return [{'workload': 'upload', **case, **upload_phase.report(file_size * concurrency)},
+            {'workload': 'download', **case, **download_report}]
+
+
+def run_data(args, concurrency, batch=None):
+    with start_server(*args.server_args.split(), server_path=args.server) as (proc, port, _):
+        token = login(port)
+
+        async def clients(phase):
+            if batch is None:
+                await asyncio.gather(*[_data_one(phase, port, token, i, args.data_ops) for i in range(concurrency)])
+            else:
+                await asyncio.gather(*[_data_batch_one(phase, port, token, i, args.data_ops, batch)
+                                       for i in range(concurrency)])
+
+        with Phase(proc.pid) as phase:
+            asyncio.run(clients(phase))
+    report = phase.report(items=3 * args.data_ops * concurrency)
+    if batch is None:
+        return [{'workload': 'data', 'concurrency': concurrency, **report}]
+    return [{'workload': 'data_batch', 'batch': batch, 'concurrency': concurrency, **report}]
+
+
+def case_id(result):
+    return tuple(result.get(name) for name in ('workload', 'file_size', 'block_size', 'concurrency'))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Match the cases of two runs
+    :return: one entry per common case with the relative changes, and the list of regressions
+    """
+    old_cases = {case_id(result): result for result in baseline}
+    comparison, regressions = [], []
+    for result in results:
+        old = old_cases.get(case_id(result))
+        if old is None:
+            continue
+        entry = {'workload': result['workload'], 'file_size': result.get('file_size'),
+                 'block_size': result.get('block_size'), 'concurrency': result['concurrency']}
+        # The throughput of the workload and the tail latency decide a regression
+        throughput = 'MB_per_s' if 'MB_per_s' in result else 'items_per_s' if 'items_per_s' in result \
+            else 'requests_per_s'
+        for metric, higher_is_better in (('MB_per_s', True), ('items_per_s', True), ('requests_per_s', True),
+                                         ('p50_ms', False), ('p99_ms', False)):
+            if not old.get(metric) or metric not in result:
+                continue
+            change = result[metric] / old[metric] - 1
+            entry[f'{metric}_change'] = round(change, 3)
+            worse = -change if higher_is_better else change
+            if metric in (throughput, 'p99_ms') and worse > tolerance:
+                regressions.append({**entry, 'metric': metric, 'baseline': old[metric], 'now': result[metric]})
+        comparison.append(entry)
+    return comparison, regressions
+
+
+def main():
+    args = _argparse()
+    workloads = args.workloads.split(',')
+    concurrency = [int(c) for c in args.concurrency.split(',')]
+    results = []
+    if 'file' in workloads:
+        for file_size in [int(size) for size in args.file_sizes.split(',')]:
+            payload = os.urandom(file_size)
+            for block_size in args.block_sizes.split(','):
+                for clients in concurrency:
+                    results += run_file(args, file_size, None if block_size == 'default' else int(block_size),
+                                        clients, payload)
+    if 'data' in workloads:
+        for clients in concurrency:
+            results += run_data(args, clients)
+    if 'data_batch' in workloads:
+        for clients in concurrency:
+            results += run_data(args, clients, args.data_batch)
+
+    output = {'server': os.path.abspath(args.server), 'server_args': args.server_args, 'results': results}
+    status = 0
+    if args.baseline is not None:
+        with open(args.baseline) as fid:
+            baseline = json.load(fid)
+        output['comparison'], output['regressions'] = compare(results, baseline['results'], args.tolerance)
+        status = 1 if output['regressions'] else 0
+    if args.out is not None:
+        with open(args.out, 'w') as fid:
+            json.dump(output, fid, indent=2)
+    print(json.dumps(output, indent=2))
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
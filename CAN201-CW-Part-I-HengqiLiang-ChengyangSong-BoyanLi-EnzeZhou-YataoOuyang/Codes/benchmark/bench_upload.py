@@ -0,0 +1,86 @@
+"""
+Upload throughput of client.py: one connection per block (the old behaviour) against one
+persistent connection with different numbers of pipelined blocks in flight, and the
+multi-stream mode with several connections.
+
+    python -m benchmark.bench_upload --size_mb 8 --windows 1,4,16 --streams 2,4
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import tempfile
+import time
+
+from benchmark._common import server, start_server, login, recv_packet
+
+import client
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--size_mb", default=8, type=float, help="Size of the uploaded file. Default is 8 MB.")
+    parse.add_argument("--windows", default='1,4,16', help="Pipelining windows to measure. Default is 1,4,16.")
+    parse.add_argument("--streams", default='2,4', help="Parallel stream counts to measure (window 8). Default is 2,4.")
+    return parse.parse_args()
+
+
+def upload_connection_per_block(port, token, file_path):
+    """
+    The previous client behaviour: SAVE, then a new TCP connection for every block
+    """
+    file_size = os.path.getsize(file_path)
+    with socket.create_connection(('127.0.0.1', port)) as s:
+        s.sendall(server.make_packet({server.FIELD_OPERATION: server.OP_SAVE, server.FIELD_DIRECTION: server.DIR_REQUEST,
+                                      server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_TOKEN: token,
+                                      server.FIELD_KEY: os.path.basename(file_path), server.FIELD_SIZE: file_size}))
+        plan, _ = recv_packet(s)
+    with open(file_path, 'rb') as fid:
+        for block_index in range(plan[server.FIELD_TOTAL_BLOCK]):
+            with socket.create_connection(('127.0.0.1', port)) as s:
+                block_data = os.pread(fid.fileno(), plan[server.FIELD_BLOCK_SIZE],
+                                      block_index * plan[server.FIELD_BLOCK_SIZE])
+                s.sendall(server.make_packet({server.FIELD_OPERATION: server.OP_UPLOAD,
+                                              server.FIELD_DIRECTION: server.DIR_REQUEST,
+                                              server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_TOKEN: token,
+                                              server.FIELD_KEY: plan[server.FIELD_KEY],
+                                              server.FIELD_BLOCK_INDEX: block_index}, block_data))
+                response, _ = recv_packet(s)
+                assert response[server.FIELD_STATUS] == 200, response
+    return True
+
+
+def run(mode, window, file_path, streams=1):
+    with start_server() as (proc, port, _):
+        token = login(port)
+        client.SERVER_IP, client.SERVER_PORT = '127.0.0.1', port
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if mode == 'connection_per_block':
+                ok = upload_connection_per_block(port, token, file_path)
+            else:
+                ok = client.upload_file(token, file_path, max_retries=1, window=window, streams=streams)
+        elapsed = time.perf_counter() - start
+    size = os.path.getsize(file_path)
+    return {'mode': mode, 'window': window, 'streams': streams, 'ok': bool(ok), 'seconds': round(elapsed, 3),
+            'MB_per_s': round(size / elapsed / 1024 / 1024, 2)}
+
+
+def main():
+    args = _argparse()
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = os.path.join(tmp, 'bench_upload.bin')
+        with open(file_path, 'wb') as fid:
+            fid.write(os.urandom(int(args.size_mb * 1024 * 1024)))
+        results = [run('connection_per_block', 1, file_path)]
+        for window in args.windows.split(','):
+            results.append(run('persistent', int(window), file_path))
+        for streams in args.streams.split(','):
+            results.append(run('multi_stream', client.DEFAULT_WINDOW, file_path, int(streams)))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
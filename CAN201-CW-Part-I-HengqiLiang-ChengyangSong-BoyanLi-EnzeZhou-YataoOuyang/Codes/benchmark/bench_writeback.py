@@ -0,0 +1,92 @@
+"""
+Many concurrent uploads with their blocks sent in random order (as several streams or a resume do),
+with every block written as it arrives (--coalesce_kb 0, the previous behaviour) and with the
+write-behind buffer under each --durability mode. Reports the upload throughput, the write calls
+and syncs of the server (STAT) and the p99 of the block ACKs.
+
+    python -m benchmark.bench_writeback --clients 32 --size_mb 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from benchmark._common import server, start_server, login, open_connection, async_call, percentile
+
+
+def _argparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--clients", default=32, type=int, help="Concurrent uploads. Default is 32.")
+    parse.add_argument("--size_mb", default=4, type=float, help="Size of every uploaded file. Default is 4.")
+    parse.add_argument("--block_size", default=server.MAX_PACKET_SIZE, type=int,
+                       help=f"Block size of the plans. Default is {server.MAX_PACKET_SIZE}.")
+    return parse.parse_args()
+
+
+async def _one_client(port, token, key, payload, block_size, ack_times):
+    reader, writer = await open_connection(port)
+    base = {server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TYPE: server.TYPE_FILE,
+            server.FIELD_TOKEN: token, server.FIELD_KEY: key}
+    plan, _ = await async_call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_SAVE,
+                                                server.FIELD_SIZE: len(payload),
+                                                server.FIELD_BLOCK_SIZE: block_size})
+    block_size = plan[server.FIELD_BLOCK_SIZE]
+    order = list(range(plan[server.FIELD_TOTAL_BLOCK]))
+    random.shuffle(order)
+    for block_index in order:
+        start = time.perf_counter()
+        response, _ = await async_call(reader, writer, {**base, server.FIELD_OPERATION: server.OP_UPLOAD,
+                                                        server.FIELD_BLOCK_INDEX: block_index},
+                                       payload[block_index * block_size:(block_index + 1) * block_size])
+        ack_times.append(time.perf_counter() - start)
+        assert response[server.FIELD_STATUS] == 200, response
+    writer.close()
+    return server.FIELD_TREE_MD5 in response
+
+
+def run(label, server_args, clients, payload, block_size):
+    with start_server(*server_args) as (proc, port, _):
+        token = login(port)
+        ack_times = []
+
+        async def run_clients():
+            return await asyncio.gather(*[_one_client(port, token, f'writeback_{i}', payload, block_size, ack_times)
+                                          for i in range(clients)])
+
+        start = time.perf_counter()
+        completed = asyncio.run(run_clients())
+        elapsed = time.perf_counter() - start
+
+        async def stat():
+            reader, writer = await open_connection(port)
+            response, _ = await async_call(reader, writer, {server.FIELD_OPERATION: server.OP_STAT,
+                                                            server.FIELD_DIRECTION: server.DIR_REQUEST,
+                                                            server.FIELD_TYPE: server.TYPE_FILE,
+                                                            server.FIELD_TOKEN: token})
+            writer.close()
+            return response
+
+        stats = asyncio.run(stat())
+    return {'case': label, 'server_args': ' '.join(server_args), 'completed': sum(completed),
+            'MB_per_s': round(clients * len(payload) / elapsed / 1024 / 1024, 2),
+            'p99_ack_ms': round(percentile(ack_times, 99) * 1000, 3),
+            'disk_writes': stats['disk_writes'], 'fsyncs': stats['fsyncs'],
+            'fsync_seconds': stats['fsync_seconds']}
+
+
+def main():
+    args = _argparse()
+    payload = os.urandom(int(args.size_mb * 1024 * 1024))
+    cases = (('write-through', ['--coalesce_kb', '0']),
+             ('write-behind, none', []),
+             ('write-behind, complete', ['--durability', 'complete']),
+             ('write-behind, every 16 MB', ['--durability', 'every_mb', '--fsync_mb', '16']),
+             ('write-behind, every 1 MB', ['--durability', 'every_mb', '--fsync_mb', '1']))
+    print(json.dumps([run(label, server_args, args.clients, payload, args.block_size)
+                      for label, server_args in cases], indent=2))
+
+
+if __name__ == '__main__':
+    main()
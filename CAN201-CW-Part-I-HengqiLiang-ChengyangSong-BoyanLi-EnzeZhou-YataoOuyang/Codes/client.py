@@ -7,20 +7,38 @@ import os
 import math
 import time
 import argparse
+import threading
+import mmap
+import zlib
+import lzma
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 SERVER_PORT = 1379  # Server port; ensure it matches the port number in server.py
 
 MAX_PACKET_SIZE = 20480
+DEFAULT_WINDOW = 8  # Unacknowledged UPLOAD blocks in flight on one connection
+BINARY_HEADER = False  # set by login() when the server accepts binary headers
+SERVER_COMPRESSIONS = []  # set by login(): the block compression methods the server accepts
+SERVER_DEDUP = False  # set by login(): a SAVE with the md5 of content the server has completes at once
+MAX_BUSY_WAITS = 20  # busy answers (status 503) of the server waited out before giving up
 
 # Constant definitions
 OP_LOGIN = 'LOGIN'
 OP_SAVE = 'SAVE'
 OP_UPLOAD = 'UPLOAD'
 OP_GET = 'GET'
+OP_DOWNLOAD = 'DOWNLOAD'
+OP_RESUME = 'RESUME'
+OP_DELETE = 'DELETE'
+OP_BYE = 'BYE'
+OP_ERROR = 'ERROR'
+OP_STAT = 'STAT'
 DIR_REQUEST = 'REQUEST'
 DIR_RESPONSE = 'RESPONSE'
 TYPE_AUTH = 'AUTH'
 TYPE_FILE = 'FILE'
+TYPE_DATA = 'DATA'
 FIELD_OPERATION = 'operation'
 FIELD_DIRECTION = 'direction'
 FIELD_TYPE = 'type'
@@ -35,20 +53,206 @@ FIELD_TOTAL_BLOCK = 'total_block'
 FIELD_BLOCK_SIZE = 'block_size'
 FIELD_BLOCK_INDEX = 'block_index'
 FIELD_MD5 = 'md5'
+FIELD_TREE_MD5 = 'tree_md5'
+FIELD_RECEIVED_BLOCK = 'received_block'
+FIELD_HEADER = 'header'
+FIELD_COMPRESSION = 'compression'
+FIELD_DEDUP = 'dedup'
+FIELD_COMPLETED = 'completed'
+FIELD_RETRY_AFTER = 'retry_after'
+COMPRESSIONS = ['zlib', 'lzma']
 
 
 def _argparse():
     parse = argparse.ArgumentParser()
     parse.add_argument("--server_ip", type=str, required=True, help="Server IP address")
     parse.add_argument("--id", type=str, required=True, help="User ID")
-    parse.add_argument("--f", type=str, required=True, help="Path to the file to upload")
-    return parse.parse_args()
+    parse.add_argument("--f", type=str, required=False, help="Path to the file to upload")
+    parse.add_argument("--download", type=str, required=False, help="Key of a file to download instead")
+    parse.add_argument("--out", type=str, required=False,
+                       help="Where to save the downloaded file (default: the key in the current folder)")
+    parse.add_argument("--window", type=int, default=DEFAULT_WINDOW,
+                       help=f"Unacknowledged blocks in flight on each connection (default {DEFAULT_WINDOW})")
+    parse.add_argument("--streams", type=int, default=1,
+                       help="Parallel TCP connections used to transfer the blocks (default 1)")
+    parse.add_argument("--block_size", type=int, default=None,
+                       help="Block size to ask the server for, in bytes (default: the server's choice)")
+    parse.add_argument("--resume", action='store_true',
+                       help="Continue an unfinished upload of the same file, sending only the missing blocks")
+    parse.add_argument("--json_header", action='store_true',
+                       help="Do not ask the server for binary block headers, always send json")
+    parse.add_argument("--compress", choices=COMPRESSIONS, default=None,
+                       help="Compress the blocks of the upload or download, if the server supports it")
+    parse.add_argument("--compress_level", type=int, choices=range(10), default=6,
+                       help="Upload compression level, zlib level or lzma preset (default: 6)")
+    args = parse.parse_args()
+    if args.f is None and args.download is None:
+        parse.error("one of --f or --download is required")
+    return args
 
 
-def make_packet(json_data, bin_data=None):
+BINARY_HEADER_FLAG = 0x80000000  # top bit of j_len: the header is binary (negotiated at LOGIN), not json
+BIN_HEADER = struct.Struct('!BBBBHHHqqIB')  # operation, direction, type, compression, status, token id, key id,
+# block_index, size, block_size, number of string definitions; -1/0 mean "not in the fixed fields"
+BIN_STRING = struct.Struct('!HH')  # string definition: id, length of the utf-8 bytes that follow
+BIN_OPERATIONS = [None, OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN, OP_ERROR, OP_RESUME,
+                  OP_STAT]
+BIN_DIRECTIONS = [None, DIR_REQUEST, DIR_RESPONSE]
+BIN_TYPES = [None, TYPE_FILE, TYPE_DATA, TYPE_AUTH]
+BIN_COMPRESSIONS = [None, 'zlib', 'lzma']
+
+
+class HeaderTable:
+    """
+    Interned strings (token, key) of one connection for the binary header.
+    The client gives a string an id the first time it sends it, later headers only carry the id.
+    """
+
+    def __init__(self):
+        self.strings = {}  # id -> string
+        self.ids = {}  # string -> id
+
+    def define(self, string_id, string):
+        old = self.strings.get(string_id)
+        if old is not None:
+            self.ids.pop(old, None)
+        self.strings[string_id] = string
+        self.ids[string] = string_id
+
+
+def encode_binary_header(json_data, table, intern):
+    """
+    Binary form of a json header: the fixed fields, the new string definitions,
+    then the remaining fields (if any) as json. "status_msg" is left out of 200 responses.
+    :param table: HeaderTable of the connection
+    :param intern: define ids for new strings (the client); the server only uses the client's ids
+    :return: bytes
+    """
+    rest = dict(json_data)
+    codes = []
+    for field, values in ((FIELD_OPERATION, BIN_OPERATIONS), (FIELD_DIRECTION, BIN_DIRECTIONS),
+                          (FIELD_TYPE, BIN_TYPES), (FIELD_COMPRESSION, BIN_COMPRESSIONS)):
+        value = rest.get(field)
+        if value is not None and value in values:
+            del rest[field]
+            codes.append(values.index(value))
+        else:
+            codes.append(0)
+    status = rest.get(FIELD_STATUS)
+    if type(status) is int and 0 < status < 0x10000:
+        del rest[FIELD_STATUS]
+        if status == 200:
+            rest.pop(FIELD_STATUS_MSG, None)
+    else:
+        status = 0
+    definitions = []
+    string_ids = []
+    for field in (FIELD_TOKEN, FIELD_KEY):
+        value = rest.get(field)
+        string_id = table.ids.get(value) if type(value) is str else None
+        if string_id is None and intern and type(value) is str and len(table.strings) < 0xFFFF:
+            string_id = len(table.strings) + 1
+            table.define(string_id, value)
+            definitions.append((string_id, value.encode()))
+        if string_id is not None:
+            del rest[field]
+        string_ids.append(string_id or 0)
+    numbers = []
+    for field, low, high, missing in ((FIELD_BLOCK_INDEX, 0, 2 ** 63, -1), (FIELD_SIZE, 0, 2 ** 63, -1),
+                                      (FIELD_BLOCK_SIZE, 1, 2 ** 32, 0)):
+        value = rest.get(field)
+        if type(value) is int and low <= value < high:
+            del rest[field]
+            numbers.append(value)
+        else:
+            numbers.append(missing)
+    parts = [BIN_HEADER.pack(*codes, status, *string_ids, *numbers, len(definitions))]
+    for string_id, string in definitions:
+        parts += [BIN_STRING.pack(string_id, len(string)), string]
+    if rest:
+        parts.append(json.dumps(rest, ensure_ascii=False).encode())
+    return b''.join(parts)
+
+
+def decode_binary_header(buf, table):
+    """
+    json header (dict) of a binary header, the string definitions are added to table
+    :param buf: bytes-like
+    :param table: HeaderTable of the connection
+    :return: dict
+    """
+    operation, direction, data_type, compression, status, token_id, key_id, block_index, size, block_size, \
+        n_strings = BIN_HEADER.unpack_from(buf, 0)
+    pos = BIN_HEADER.size
+    for _ in range(n_strings):
+        string_id, length = BIN_STRING.unpack_from(buf, pos)
+        pos += BIN_STRING.size
+        table.define(string_id, bytes(buf[pos:pos + length]).decode())
+        pos += length
+    json_data = json.loads(bytes(buf[pos:])) if pos < len(buf) else {}
+    for field, code, values in ((FIELD_OPERATION, operation, BIN_OPERATIONS),
+                                (FIELD_DIRECTION, direction, BIN_DIRECTIONS), (FIELD_TYPE, data_type, BIN_TYPES),
+                                (FIELD_COMPRESSION, compression, BIN_COMPRESSIONS)):
+        if code:
+            json_data[field] = values[code]
+    if status:
+        json_data[FIELD_STATUS] = status
+    if token_id:
+        json_data[FIELD_TOKEN] = table.strings[token_id]
+    if key_id:
+        json_data[FIELD_KEY] = table.strings[key_id]
+    if block_index >= 0:
+        json_data[FIELD_BLOCK_INDEX] = block_index
+    if size >= 0:
+        json_data[FIELD_SIZE] = size
+    if block_size:
+        json_data[FIELD_BLOCK_SIZE] = block_size
+    return json_data
+
+
+def compress_block(data, method, level):
+    """
+    Compress one block
+    :param method: 'zlib' or 'lzma'
+    :param level: 0-9 (zlib level, lzma preset)
+    :return: the compressed bytes, or None if they are not smaller than data
     """
-    Creates a data packet following the STEP protocol
+    if method == 'zlib':
+        packed = zlib.compress(data, level)
+    else:
+        packed = lzma.compress(data, preset=level)
+    return packed if len(packed) < len(data) else None
+
+
+def decompress_block(data, method, max_size):
+    """
+    Decompress one block, producing at most max_size bytes
+    :return: bytes, ValueError if the data is broken or longer than max_size
+    """
+    try:
+        if method == 'zlib':
+            decompressor = zlib.decompressobj()
+            block = decompressor.decompress(data, max_size)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError('the block is longer than expected or truncated')
+        else:
+            decompressor = lzma.LZMADecompressor()
+            block = decompressor.decompress(data, max_size)
+            if not decompressor.eof:
+                raise ValueError('the block is longer than expected or truncated')
+    except (zlib.error, lzma.LZMAError) as ex:
+        raise ValueError(str(ex))
+    return block
+
+
+def make_packet(json_data, bin_data=None, table=None):
+    """
+    Creates a data packet following the STEP protocol, with a binary header if table (HeaderTable) is given
     """
+    if table is not None:
+        header = encode_binary_header(json_data, table, True)
+        bin_data = b'' if bin_data is None else bin_data
+        return struct.pack('!II', len(header) | BINARY_HEADER_FLAG, len(bin_data)) + header + bin_data
     j = json.dumps(dict(json_data), ensure_ascii=False)
     j_len = len(j)
     if bin_data is None:
@@ -57,34 +261,51 @@ def make_packet(json_data, bin_data=None):
         return struct.pack('!II', j_len, len(bin_data)) + j.encode() + bin_data
 
 
+def convert_size(size_bytes):
+    """
+    Convert file size to human-readable format
+    """
+    if size_bytes == 0:
+        return "0B"
+    size_name = ("B", "KB", "MB", "GB", "TB")
+    i = int(math.floor(math.log(size_bytes, 1024)))
+    p = math.pow(1024, i)
+    s = round(size_bytes / p, 2)
+    return f"{s} {size_name[i]}"
+
+
+def recv_exactly(conn, n):
+    """
+    Receive exactly n bytes into one preallocated buffer, None if the connection is closed
+    """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        size = conn.recv_into(view[got:])
+        if size == 0:
+            return None
+        got += size
+    return buf
+
+
 def get_tcp_packet(conn, max_retries=3):
     for attempt in range(max_retries):
         try:
-            bin_data = b''
-            while len(bin_data) < 8:
-                data_rec = conn.recv(8)
-                if data_rec == b'':
-                    return None, None
-                bin_data += data_rec
-            data = bin_data[:8]
-            bin_data = bin_data[8:]
-            j_len, b_len = struct.unpack('!II', data)
-            while len(bin_data) < j_len:
-                data_rec = conn.recv(j_len)
-                if data_rec == b'':
-                    return None, None
-                bin_data += data_rec
-            j_bin = bin_data[:j_len]
+            head = recv_exactly(conn, 8)
+            if head is None:
+                return None, None
+            j_len, b_len = struct.unpack('!II', head)
+            j_bin = recv_exactly(conn, j_len)
+            if j_bin is None:
+                return None, None
             try:
                 json_data = json.loads(j_bin.decode())
             except Exception:
                 return None, None
-            bin_data = bin_data[j_len:]
-            while len(bin_data) < b_len:
-                data_rec = conn.recv(b_len)
-                if data_rec == b'':
-                    return None, None
-                bin_data += data_rec
+            bin_data = recv_exactly(conn, b_len)
+            if bin_data is None:
+                return None, None
             return json_data, bin_data
         except ConnectionResetError:
             if attempt < max_retries - 1:
@@ -95,39 +316,141 @@ def get_tcp_packet(conn, max_retries=3):
                 raise  # Raise an exception if max retries are exceeded
 
 
-def login(username, password):
+class FrameReader:
     """
-    Login function
+    Buffered STEP frame reader for a persistent connection (same as the one in server.py).
+    Bytes of the next frame stay in the buffer between read_frame() calls.
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+
+    def __init__(self, conn, buffer_size=MAX_PACKET_SIZE * 4, table=None):
+        self.conn = conn
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.table = table if table is not None else HeaderTable()
+
+    def _fill(self, n):
+        if self.end - self.start >= n:
+            return True
+        if self.start + n > len(self.buf):
+            pending = self.end - self.start
+            if n > len(self.buf):
+                buf = bytearray(max(n, len(self.buf) * 2))
+                buf[:pending] = self.view[self.start:self.end]
+                self.buf = buf
+                self.view = memoryview(buf)
+            else:
+                self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        while self.end - self.start < n:
+            size = self.conn.recv_into(self.view[self.end:])
+            if size == 0:
+                return False
+            self.end += size
+        return True
+
+    def read_frame(self):
+        """
+        Read the next frame, the binary part is a memoryview valid until the next call
+        """
+        if not self._fill(8):
+            return None, None
+        j_len, b_len = struct.unpack_from('!II', self.buf, self.start)
+        binary = j_len & BINARY_HEADER_FLAG != 0
+        j_len &= ~BINARY_HEADER_FLAG
+        if not self._fill(8 + j_len + b_len):
+            return None, None
+        j_start = self.start + 8
+        b_start = j_start + j_len
+        self.start = b_start + b_len
         try:
-            s.connect((SERVER_IP, SERVER_PORT))
-        except ConnectionRefusedError:
-            print(
-                "Cannot connect to the server. Make sure that the server is running and that the IP address and port number are correct.")
-            return None
+            if binary:
+                json_data = decode_binary_header(self.view[j_start:b_start], self.table)
+            else:
+                json_data = json.loads(bytes(self.view[j_start:b_start]))
+        except Exception:
+            return None, None
+        return json_data, self.view[b_start:self.start]
 
-        # Create login request
-        login_request = {
-            FIELD_OPERATION: OP_LOGIN,
-            FIELD_DIRECTION: DIR_REQUEST,
-            FIELD_TYPE: TYPE_AUTH,
-            FIELD_USERNAME: username,
-            FIELD_PASSWORD: hashlib.md5(password.encode()).hexdigest()
-        }
 
-        # Send login request
-        s.sendall(make_packet(login_request))
+class ServerBusy(Exception):
+    """
+    The server answered busy (status 503): try again after retry_after seconds
+    """
 
-        # Receive server response
-        json_data, _ = get_tcp_packet(s)
+    def __init__(self, json_data):
+        super().__init__(json_data.get(FIELD_STATUS_MSG, 'The server is busy.'))
+        self.retry_after = json_data.get(FIELD_RETRY_AFTER, 1000) / 1000
 
-        if json_data and json_data.get(FIELD_STATUS) == 200:
-            print("Log in successfully!")
-            return json_data.get(FIELD_TOKEN)
-        else:
-            print(f"Login Failure: {json_data.get(FIELD_STATUS_MSG) if json_data else 'unknown error'}")
-            return None
+
+def check_busy(json_data):
+    """
+    Raise ServerBusy if the response is the busy answer of the server
+    """
+    if json_data is not None and json_data.get(FIELD_STATUS) == 503:
+        raise ServerBusy(json_data)
+
+
+def send_request(request):
+    """
+    Send one request over a new connection and receive the response. While the server answers busy,
+    wait the time it asks for and send the request again (at most MAX_BUSY_WAITS times).
+    :return: json_data, bin_data of the response (None, None if the connection is closed)
+    """
+    for busy_wait in range(MAX_BUSY_WAITS + 1):
+        with socket.create_connection((SERVER_IP, SERVER_PORT)) as s:
+            s.sendall(make_packet(request))
+            json_data, bin_data = get_tcp_packet(s)
+        try:
+            check_busy(json_data)
+        except ServerBusy as busy:
+            if busy_wait == MAX_BUSY_WAITS:
+                break
+            print(f"{busy} Retrying in {busy.retry_after * 1000:.0f} ms")
+            time.sleep(busy.retry_after)
+            continue
+        break
+    return json_data, bin_data
+
+
+def login(username, password, binary_header=True):
+    """
+    Login function
+    :param binary_header: ask whether the server accepts binary headers (sets BINARY_HEADER)
+    """
+    global BINARY_HEADER, SERVER_COMPRESSIONS, SERVER_DEDUP
+    # Create login request
+    login_request = {
+        FIELD_OPERATION: OP_LOGIN,
+        FIELD_DIRECTION: DIR_REQUEST,
+        FIELD_TYPE: TYPE_AUTH,
+        FIELD_USERNAME: username,
+        FIELD_PASSWORD: hashlib.md5(password.encode()).hexdigest()
+    }
+    if binary_header:
+        # Servers without binary headers ignore the field and keep using json
+        login_request[FIELD_HEADER] = 'binary'
+    login_request[FIELD_COMPRESSION] = COMPRESSIONS
+
+    # Send login request and receive server response
+    try:
+        json_data, _ = send_request(login_request)
+    except ConnectionRefusedError:
+        print(
+            "Cannot connect to the server. Make sure that the server is running and that the IP address and port number are correct.")
+        return None
+
+    if json_data and json_data.get(FIELD_STATUS) == 200:
+        print("Log in successfully!")
+        BINARY_HEADER = json_data.get(FIELD_HEADER) == 'binary'
+        SERVER_COMPRESSIONS = json_data.get(FIELD_COMPRESSION) or []
+        SERVER_DEDUP = json_data.get(FIELD_DEDUP) is True
+
+        return json_data.get(FIELD_TOKEN)
+    else:
+        print(f"Login Failure: {json_data.get(FIELD_STATUS_MSG) if json_data else 'unknown error'}")
+        return None
 
 
 def save_token(token):
@@ -139,8 +462,219 @@ def save_token(token):
     print("Token has been saved to the token.txt file")
 
 
-def upload_file(token, file_path, max_retries=3):
-    for attempt in range(max_retries):
+def get_tree_md5(file_path, block_size):
+    """
+    Tree hash as computed by the server: MD5 over the MD5 digests of all blocks
+    """
+    digests = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digests.update(hashlib.md5(block).digest())
+    return digests.hexdigest()
+
+
+def read_blocks(file, block_indexes, block_size, compression=None, level=6, ahead=DEFAULT_WINDOW):
+    """
+    Read the blocks to upload, compressed in a worker pool `ahead` blocks in advance if compression is set
+    :return: iterator of (block_index, data, size of the original block, compression method or None)
+    """
+    def prepare(block_index):
+        block_data = os.pread(file.fileno(), block_size, block_index * block_size)
+        if compression is not None:
+            packed = compress_block(block_data, compression, level)
+            if packed is not None:
+                return block_index, packed, len(block_data), compression
+        # Blocks that do not shrink are sent as they are
+        return block_index, block_data, len(block_data), None
+
+    if compression is None:
+        for block_index in block_indexes:
+            yield prepare(block_index)
+        return
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        futures = deque()
+        for block_index in block_indexes:
+            futures.append(executor.submit(prepare, block_index))
+            if len(futures) > ahead:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def upload_blocks(s, token, key, file, block_indexes, block_size, window=DEFAULT_WINDOW, on_block=None,
+                  compression=None, level=6):
+    """
+    Upload blocks over one connection, keeping up to `window` UPLOAD requests unacknowledged.
+    Responses are matched to requests by block_index (in sending order if the server omits it).
+    :param s: connected socket
+    :param file: the open file to upload
+    :param block_indexes: the blocks to send
+    :param on_block: called as on_block(block_index, size) for every acknowledged block
+    :param compression: compress the blocks with this method ('zlib' or 'lzma'), None to send them as they are
+    :param level: compression level
+    :return:
+        failed: {block_index: status_msg} of rejected blocks
+        final: the response carrying the server md5/tree_md5, or None
+    """
+    table = HeaderTable() if BINARY_HEADER else None
+    reader = FrameReader(s, table=table)
+    in_flight = {}  # block_index -> size, in sending order
+    pending = read_blocks(file, block_indexes, block_size, compression, level, window)
+    failed = {}
+    final = None
+    exhausted = False
+    while True:
+        while not exhausted and len(in_flight) < window:
+            block = next(pending, None)
+            if block is None:
+                exhausted = True
+                break
+            block_index, block_data, size, method = block
+            upload_request = {
+                FIELD_OPERATION: OP_UPLOAD,
+                FIELD_DIRECTION: DIR_REQUEST,
+                FIELD_TYPE: TYPE_FILE,
+                FIELD_TOKEN: token,
+                FIELD_KEY: key,
+                FIELD_BLOCK_INDEX: block_index
+            }
+            if method is not None:
+                upload_request[FIELD_COMPRESSION] = method
+            s.sendall(make_packet(upload_request, block_data, table))
+            in_flight[block_index] = size
+        if not in_flight:
+            return failed, final
+
+        json_data, _ = reader.read_frame()
+        if json_data is None:
+            raise ConnectionError("The server closed the connection during the upload.")
+        # The unacknowledged blocks are sent again once the server has room
+        check_busy(json_data)
+        block_index = json_data.get(FIELD_BLOCK_INDEX)
+        if block_index not in in_flight:
+            block_index = next(iter(in_flight))
+        size = in_flight.pop(block_index)
+        if json_data.get(FIELD_STATUS) == 200:
+            if on_block is not None:
+                on_block(block_index, size)
+            if json_data.get(FIELD_MD5) or json_data.get(FIELD_TREE_MD5):
+                final = json_data
+        else:
+            failed[block_index] = json_data.get(FIELD_STATUS_MSG, 'unknown error')
+
+
+def transfer_parallel(block_indexes, streams, transfer, on_block=None, max_rounds=3):
+    """
+    Split the blocks into `streams` contiguous ranges and transfer every range over its own connection
+    at the same time. Blocks that are not acknowledged (rejected, or lost with a connection) are
+    transferred again in the next round, up to max_rounds rounds. When the server answers busy, the next
+    round starts after the time it asks for and does not count (at most MAX_BUSY_WAITS times).
+    :param transfer: transfer(conn, part, on_block) -> (failed, final), e.g. upload_blocks
+    :return:
+        failed: {block_index: status_msg} of the blocks that never got through
+        final: the first non-None final value returned by transfer
+    """
+    lock = threading.Lock()
+    acked = set()
+    final = None
+    remaining = list(block_indexes)
+    errors = {}
+
+    def acked_block(block_index, size):
+        with lock:
+            acked.add(block_index)
+            if on_block is not None:
+                on_block(block_index, size)
+
+    def run_stream(part):
+        with socket.create_connection((SERVER_IP, SERVER_PORT)) as conn:
+            return transfer(conn, part, acked_block)
+
+    round_index = busy_waits = 0
+    while remaining and round_index < max_rounds:
+        n = min(streams, len(remaining))
+        parts = [remaining[len(remaining) * i // n:len(remaining) * (i + 1) // n] for i in range(n)]
+        retry_after = None
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            futures = {pool.submit(run_stream, part): part for part in parts}
+            for future, part in futures.items():
+                try:
+                    part_failed, part_final = future.result()
+                except ServerBusy as busy:
+                    part_failed = {block_index: str(busy) for block_index in part}
+                    part_final = None
+                    retry_after = max(retry_after or 0, busy.retry_after)
+                except OSError as ex:
+                    part_failed = {block_index: f'connection lost: {ex}' for block_index in part}
+                    part_final = None
+                errors.update(part_failed)
+                final = final or part_final
+        remaining = [block_index for block_index in remaining if block_index not in acked]
+        if remaining and retry_after is not None and busy_waits < MAX_BUSY_WAITS:
+            busy_waits += 1
+            print(f"The server is busy, retrying {len(remaining)} blocks in {retry_after * 1000:.0f} ms")
+            time.sleep(retry_after)
+            continue
+        round_index += 1
+        if remaining:
+            print(f"Round {round_index}: {len(remaining)} blocks not acknowledged, retrying...")
+    return {block_index: errors.get(block_index, 'unknown error') for block_index in remaining}, final
+
+
+def upload_blocks_parallel(token, key, file, block_indexes, block_size, streams, window=DEFAULT_WINDOW,
+                           on_block=None, max_rounds=3, compression=None, level=6):
+    """
+    Upload the blocks over `streams` connections at the same time, see transfer_parallel
+    :return:
+        failed: {block_index: status_msg} of the blocks that never got through
+        final: the response carrying the server md5/tree_md5, or None
+    """
+    def transfer(conn, part, acked_block):
+        return upload_blocks(conn, token, key, file, part, block_size, window, acked_block, compression, level)
+
+    return transfer_parallel(block_indexes, streams, transfer, on_block, max_rounds)
+
+
+def query_upload_progress(s, token, key):
+    """
+    Ask the server which blocks of an unfinished upload it already has (RESUME)
+    :return:
+        status code (200, 404 no upload in progress, 408 completely uploaded, ...), None if the server
+        does not support RESUME (it answers ERROR with 408 "not allowed", a SAVE starts over then)
+        the upload plan, or None
+        the missing block indexes, or None
+    """
+    resume_request = {
+        FIELD_OPERATION: OP_RESUME,
+        FIELD_DIRECTION: DIR_REQUEST,
+        FIELD_TYPE: TYPE_FILE,
+        FIELD_TOKEN: token,
+        FIELD_KEY: key
+    }
+    s.sendall(make_packet(resume_request))
+    json_data, bitmap = get_tcp_packet(s)
+    if json_data is None:
+        raise Exception("The server did not return a valid response.")
+    check_busy(json_data)
+    if json_data.get(FIELD_OPERATION) != OP_RESUME:
+        return None, None, None
+    if json_data.get(FIELD_STATUS) != 200:
+        return json_data.get(FIELD_STATUS), None, None
+    missing = [block_index for block_index in range(json_data[FIELD_TOTAL_BLOCK])
+               if not bitmap[block_index // 8] & (1 << (block_index % 8))]
+    return 200, json_data, missing
+
+
+def upload_file(token, file_path, max_retries=3, window=DEFAULT_WINDOW, streams=1, block_size=None, resume=False,
+                compression=None, compress_level=6):
+    if compression is not None and compression not in SERVER_COMPRESSIONS:
+        print(f"The server does not accept {compression} blocks, uploading them uncompressed")
+        compression = None
+    attempt = busy_waits = 0
+    while attempt < max_retries:
         try:
             # Get file size
             file_size = os.path.getsize(file_path)
@@ -154,16 +688,6 @@ def upload_file(token, file_path, max_retries=3):
                     print("Upload cancelled by user")
                     return False
 
-            # Convert file size to human-readable format
-            def convert_size(size_bytes):
-                if size_bytes == 0:
-                    return "0B"
-                size_name = ("B", "KB", "MB", "GB", "TB")
-                i = int(math.floor(math.log(size_bytes, 1024)))
-                p = math.pow(1024, i)
-                s = round(size_bytes / p, 2)
-                return f"{s} {size_name[i]}"
-
             readable_size = convert_size(file_size)
             print(f"Start uploading files: {os.path.basename(file_path)} (Size: {readable_size})")
 
@@ -179,65 +703,91 @@ def upload_file(token, file_path, max_retries=3):
                         f"Unable to connect to the server {SERVER_IP}:{SERVER_PORT}. Make sure the server is running.")
                     return
 
-                save_request = {
-                    FIELD_OPERATION: OP_SAVE,
-                    FIELD_DIRECTION: DIR_REQUEST,
-                    FIELD_TYPE: TYPE_FILE,
-                    FIELD_TOKEN: token,
-                    FIELD_KEY: os.path.basename(file_path),
-                    FIELD_SIZE: file_size
-                }
+                # After a failure (or with --resume) continue the unfinished upload instead of starting again
+                json_data = None
+                if resume or attempt > 0 or busy_waits > 0:
+                    status, json_data, missing = query_upload_progress(s, token, os.path.basename(file_path))
+                    if status == 408:
+                        print("The file is already completely uploaded")
+                        return True
+                    if json_data is not None and json_data.get(FIELD_SIZE) != file_size:
+                        print("The unfinished upload on the server is a different file, starting again")
+                        json_data = None
+                    if json_data is not None:
+                        print(f"Resuming upload: {json_data[FIELD_TOTAL_BLOCK] - len(missing)}/"
+                              f"{json_data[FIELD_TOTAL_BLOCK]} blocks already on the server")
 
-                s.sendall(make_packet(save_request))
+                if json_data is None:
+                    save_request = {
+                        FIELD_OPERATION: OP_SAVE,
+                        FIELD_DIRECTION: DIR_REQUEST,
+                        FIELD_TYPE: TYPE_FILE,
+                        FIELD_TOKEN: token,
+                        FIELD_KEY: os.path.basename(file_path),
+                        FIELD_SIZE: file_size
+                    }
+                    if block_size is not None:
+                        # The server clamps it to its allowed range, the plan has the real value
+                        save_request[FIELD_BLOCK_SIZE] = block_size
+                    if SERVER_DEDUP:
+                        # Content the server already has is not uploaded again
+                        local_md5 = hashlib.md5()
+                        with open(file_path, 'rb') as f:
+                            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                                local_md5.update(chunk)
+                        save_request[FIELD_MD5] = local_md5.hexdigest()
 
-                # Step 2: Receive upload plan
-                json_data, _ = get_tcp_packet(s)
+                    s.sendall(make_packet(save_request))
 
-                if json_data is None:
-                    raise Exception("The server did not return a valid response.")
+                    # Step 2: Receive upload plan
+                    json_data, _ = get_tcp_packet(s)
 
-                if json_data.get(FIELD_STATUS) != 200:
-                    raise Exception(
-                        f"Failed to upload: Status Code {json_data.get(FIELD_STATUS)}, error message: {json_data.get(FIELD_STATUS_MSG)}")
+                    if json_data is None:
+                        raise Exception("The server did not return a valid response.")
+                    check_busy(json_data)
 
-                # Step 3: Upload file in blocks
+                    if json_data.get(FIELD_STATUS) in (413, 507):
+                        # Over the quota or no space on the server: trying again will not help
+                        print(f"Upload rejected: {json_data.get(FIELD_STATUS_MSG)}")
+                        return False
+                    if json_data.get(FIELD_STATUS) != 200:
+                        raise Exception(
+                            f"Failed to upload: Status Code {json_data.get(FIELD_STATUS)}, error message: {json_data.get(FIELD_STATUS_MSG)}")
+                    missing = [] if json_data.get(FIELD_COMPLETED) else list(range(json_data[FIELD_TOTAL_BLOCK]))
+
+                # Step 3: Upload file in blocks over the same connection, pipelined
                 with open(file_path, 'rb') as file:
                     total_block = json_data.get(FIELD_TOTAL_BLOCK)
-                    block_size = json_data.get(FIELD_BLOCK_SIZE)
+                    plan_block_size = json_data.get(FIELD_BLOCK_SIZE)
                     key = json_data.get(FIELD_KEY)
 
                     # Show upload progress
-                    uploaded_size = 0
-                    for block_index in range(total_block):
-                        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                            s.connect((SERVER_IP, SERVER_PORT))
-
-                            file.seek(block_index * block_size)
-                            block_data = file.read(block_size)
-                            uploaded_size += len(block_data)
-
-                            # Calculate upload progress percentage
-                            progress = (uploaded_size / file_size) * 100
-
-                            upload_request = {
-                                FIELD_OPERATION: OP_UPLOAD,
-                                FIELD_DIRECTION: DIR_REQUEST,
-                                FIELD_TYPE: TYPE_FILE,
-                                FIELD_TOKEN: token,
-                                FIELD_KEY: key,
-                                FIELD_BLOCK_INDEX: block_index
-                            }
-
-                            s.sendall(make_packet(upload_request, block_data))
-
-                            json_data, _ = get_tcp_packet(s)
-
-                            if json_data and json_data[FIELD_STATUS] == 200:
-                                print(f"block {block_index + 1}/{total_block} Uploaded successfully ({progress:.1f}%)")
-                            else:
-                                print(
-                                    f"block {block_index + 1}/{total_block} Upload Failed: {json_data[FIELD_STATUS_MSG] if json_data else 'unknown error'}")
-                                return False
+                    uploaded_size = min((total_block - len(missing)) * plan_block_size, file_size)
+
+                    def on_block(block_index, size):
+                        nonlocal uploaded_size
+                        uploaded_size += size
+                        # Calculate upload progress percentage
+                        progress = min(uploaded_size / file_size, 1) * 100
+                        print(f"block {block_index + 1}/{total_block} Uploaded successfully ({progress:.1f}%)")
+
+                    if not missing:
+                        # Completed by the SAVE (known content or an empty file), the plan carries the md5
+                        print("The server already has this content, no block to upload" if total_block
+                              else "The file is empty, no block to upload")
+                        failed = {}
+                    elif streams > 1:
+                        failed, json_data = upload_blocks_parallel(token, key, file, missing,
+                                                                   plan_block_size, streams, window, on_block,
+                                                                   compression=compression, level=compress_level)
+                    else:
+                        failed, json_data = upload_blocks(s, token, key, file, missing, plan_block_size,
+                                                          window, on_block, compression, compress_level)
+                    if failed:
+                        for block_index, status_msg in sorted(failed.items()):
+                            print(f"block {block_index + 1}/{total_block} Upload Failed: {status_msg}")
+                        # The next try only sends the missing blocks
+                        raise Exception(f"{len(failed)} blocks were not uploaded")
 
             # End timing and calculate time and average speed
             end_time = time.time()
@@ -250,6 +800,17 @@ def upload_file(token, file_path, max_retries=3):
             print(f"average speed: {speed:.2f} MB/s")
 
             # Add MD5 display after upload is complete
+            if json_data and not json_data.get(FIELD_MD5) and json_data.get(FIELD_TREE_MD5):
+                # The blocks did not reach the server in order, compare the per-block tree hash instead
+                print(f"\nServer file tree MD5: {json_data[FIELD_TREE_MD5]}")
+                local_tree_md5 = get_tree_md5(file_path, plan_block_size)
+                print(f"Local file tree MD5: {local_tree_md5}")
+
+                if json_data[FIELD_TREE_MD5] == local_tree_md5:
+                    print("MD5 verification successful - File uploaded correctly")
+                else:
+                    print("MD5 verification failed - File might be corrupted")
+
             if json_data and json_data.get(FIELD_MD5):
                 print(f"\nServer file MD5: {json_data[FIELD_MD5]}")
                 # Calculate the MD5 of local files
@@ -264,9 +825,18 @@ def upload_file(token, file_path, max_retries=3):
 
             return True
 
+        except ServerBusy as e:
+            # Wait as long as the server asks, this does not count as a failed try
+            busy_waits += 1
+            if busy_waits > MAX_BUSY_WAITS:
+                print("Upload failed, the server stayed busy")
+                return False
+            print(f"{str(e)} Retrying in {e.retry_after * 1000:.0f} ms")
+            time.sleep(e.retry_after)
         except Exception as e:
-            print(f"Try {attempt + 1}/{max_retries} failed: {str(e)}")
-            if attempt < max_retries - 1:
+            attempt += 1
+            print(f"Try {attempt}/{max_retries} failed: {str(e)}")
+            if attempt < max_retries:
                 print("Waiting 5 seconds before retrying...")
                 time.sleep(5)
             else:
@@ -274,26 +844,218 @@ def upload_file(token, file_path, max_retries=3):
                 return False
 
 
-def verify_server_file(token, file_key):
+class BlockBitmap:
     """
-    Send a GET request to the server to verify the MD5 of the uploaded file
+    Sidecar file <output>.part.blocks of a download: the plan (size, block size, total block, md5)
+    and one bit per block already written, memory-mapped so an interrupted download can resume.
+    """
+    HEADER = struct.Struct('!QII32s')
+
+    def __init__(self, path, file_size, block_size, total_block, md5):
+        self.path = path
+        self.lock = threading.Lock()
+        header = self.HEADER.pack(file_size, block_size, total_block, (md5 or '').encode())
+        length = self.HEADER.size + math.ceil(total_block / 8)
+        self.resumed = False
+        if os.path.exists(path) and os.path.getsize(path) == length:
+            with open(path, 'rb') as f:
+                self.resumed = f.read(self.HEADER.size) == header
+        if not self.resumed:
+            with open(path, 'wb') as f:
+                f.write(header)
+                f.write(bytes(length - self.HEADER.size))
+        self.fid = open(path, 'rb+')
+        self.mm = mmap.mmap(self.fid.fileno(), length)
+
+    def has(self, block_index):
+        byte, bit = divmod(block_index, 8)
+        return bool(self.mm[self.HEADER.size + byte] & (1 << bit))
+
+    def mark(self, block_index):
+        byte, bit = divmod(block_index, 8)
+        with self.lock:
+            self.mm[self.HEADER.size + byte] |= 1 << bit
+
+    def close(self, remove=False):
+        self.mm.close()
+        self.fid.close()
+        if remove:
+            os.remove(self.path)
+
+
+def download_blocks(s, token, key, fd, block_indexes, block_size, window=DEFAULT_WINDOW, on_block=None,
+                    compression=None):
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((SERVER_IP, SERVER_PORT))
+    Download blocks over one connection, keeping up to `window` DOWNLOAD requests unanswered,
+    and write every block at its offset in the output file.
+    :param fd: file descriptor of the output file
+    :param on_block: called as on_block(block_index, size) once a block is written
+    :param compression: ask the server to compress the blocks with this method
+    :return:
+        failed: {block_index: status_msg}
+        None
+    """
+    table = HeaderTable() if BINARY_HEADER else None
+    reader = FrameReader(s, table=table)
+    in_flight = []
+    pending = iter(block_indexes)
+    failed = {}
+    exhausted = False
+    while True:
+        while not exhausted and len(in_flight) < window:
+            block_index = next(pending, None)
+            if block_index is None:
+                exhausted = True
+                break
+            download_request = {
+                FIELD_OPERATION: OP_DOWNLOAD,
+                FIELD_DIRECTION: DIR_REQUEST,
+                FIELD_TYPE: TYPE_FILE,
+                FIELD_TOKEN: token,
+                FIELD_KEY: key,
+                FIELD_BLOCK_INDEX: block_index,
+                FIELD_BLOCK_SIZE: block_size
+            }
+            if compression is not None:
+                download_request[FIELD_COMPRESSION] = compression
+            s.sendall(make_packet(download_request, None, table))
+            in_flight.append(block_index)
+        if not in_flight:
+            return failed, None
+
+        json_data, bin_data = reader.read_frame()
+        if json_data is None:
+            raise ConnectionError("The server closed the connection during the download.")
+        check_busy(json_data)
+        block_index = json_data.get(FIELD_BLOCK_INDEX)
+        if block_index not in in_flight:
+            block_index = in_flight[0]
+        in_flight.remove(block_index)
+        if json_data.get(FIELD_STATUS) == 200:
+            if json_data.get(FIELD_COMPRESSION) in COMPRESSIONS:
+                try:
+                    bin_data = decompress_block(bin_data, json_data[FIELD_COMPRESSION], block_size)
+                except ValueError as ex:
+                    failed[block_index] = f'broken compressed block: {ex}'
+                    continue
+            os.pwrite(fd, bin_data, block_index * block_size)
+            if on_block is not None:
+                on_block(block_index, len(bin_data))
+        else:
+            failed[block_index] = json_data.get(FIELD_STATUS_MSG, 'unknown error')
+
 
-        verify_request = {
-            FIELD_OPERATION: OP_GET,
-            FIELD_DIRECTION: DIR_REQUEST,
-            FIELD_TYPE: TYPE_FILE,
-            FIELD_TOKEN: token,
-            FIELD_KEY: file_key
-        }
+def download_file(token, key, out_path, window=DEFAULT_WINDOW, streams=1, block_size=None, compression=None):
+    """
+    Download a file: GET the plan, fetch the blocks over `streams` connections into a preallocated
+    <out_path>.part, then verify the MD5 and rename it to out_path, so an existing out_path is only
+    replaced by a complete file. Blocks already recorded in <out_path>.part.blocks are skipped,
+    so running it again after an interruption resumes the download.
+    :return: True if the file is downloaded and its MD5 matches the plan
+    """
+    if compression is not None and compression not in SERVER_COMPRESSIONS:
+        print(f"The server does not send {compression} blocks, downloading them uncompressed")
+        compression = None
+    get_request = {
+        FIELD_OPERATION: OP_GET,
+        FIELD_DIRECTION: DIR_REQUEST,
+        FIELD_TYPE: TYPE_FILE,
+        FIELD_TOKEN: token,
+        FIELD_KEY: key
+    }
+    if block_size is not None:
+        get_request[FIELD_BLOCK_SIZE] = block_size
+    try:
+        json_data, _ = send_request(get_request)
+    except ConnectionRefusedError:
+        print(f"Unable to connect to the server {SERVER_IP}:{SERVER_PORT}. Make sure the server is running.")
+        return False
 
-        s.sendall(make_packet(verify_request))
-        json_data, _ = get_tcp_packet(s)
+    if json_data is None or json_data.get(FIELD_STATUS) != 200:
+        print(f"Failed to get the download plan: {json_data.get(FIELD_STATUS_MSG) if json_data else 'unknown error'}")
+        return False
+    file_size = json_data[FIELD_SIZE]
+    total_block = json_data[FIELD_TOTAL_BLOCK]
+    plan_block_size = json_data[FIELD_BLOCK_SIZE]
+    md5 = json_data.get(FIELD_MD5)
 
-        if json_data and json_data.get(FIELD_MD5):
-            return json_data[FIELD_MD5]
+    part_path = out_path + '.part'
+    bitmap = BlockBitmap(part_path + '.blocks', file_size, plan_block_size, total_block, md5)
+    missing = [block_index for block_index in range(total_block) if not bitmap.has(block_index)]
+    if bitmap.resumed:
+        print(f"Resuming download: {total_block - len(missing)}/{total_block} blocks already downloaded")
+    print(f"Start downloading: {key} (Size: {convert_size(file_size)}) to {out_path}")
+
+    start_time = time.time()
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        # Preallocate the output file
+        os.ftruncate(fd, file_size)
+        if hasattr(os, 'posix_fallocate') and file_size > 0:
+            os.posix_fallocate(fd, 0, file_size)
+
+        downloaded_size = (total_block - len(missing)) * plan_block_size
+
+        def on_block(block_index, size):
+            nonlocal downloaded_size
+            bitmap.mark(block_index)
+            downloaded_size += size
+            progress = min(downloaded_size / file_size, 1) * 100
+            print(f"block {block_index + 1}/{total_block} Downloaded successfully ({progress:.1f}%)")
+
+        def transfer(conn, part, acked_block):
+            return download_blocks(conn, token, key, fd, part, plan_block_size, window, acked_block, compression)
+
+        failed, _ = transfer_parallel(missing, streams, transfer, on_block)
+    finally:
+        os.close(fd)
+
+    if failed:
+        for block_index, status_msg in sorted(failed.items()):
+            print(f"block {block_index + 1}/{total_block} Download Failed: {status_msg}")
+        bitmap.close()
+        print("Download incomplete, run the same command again to resume")
+        return False
+
+    download_time = max(time.time() - start_time, 1e-6)
+    print(f"\nDownload completed:")
+    print(f"file size: {convert_size(file_size)}")
+    print(f"Taking time:: {download_time:.2f} seconds")
+    print(f"average speed: {file_size / download_time / 1024 / 1024:.2f} MB/s")
+
+    if md5:
+        with open(part_path, 'rb') as f:
+            local_md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                local_md5.update(chunk)
+        print(f"\nServer file MD5: {md5}")
+        print(f"Local file MD5: {local_md5.hexdigest()}")
+        if local_md5.hexdigest() != md5:
+            # Forget the blocks, the next run downloads everything again
+            bitmap.close(remove=True)
+            print("MD5 verification failed - File might be corrupted")
+            return False
+        print("MD5 verification successful - File downloaded correctly")
+    os.replace(part_path, out_path)
+    bitmap.close(remove=True)
+    return True
+
+
+def verify_server_file(token, file_key):
+    """
+    Send a GET request to the server to verify the MD5 of the uploaded file
+    """
+    verify_request = {
+        FIELD_OPERATION: OP_GET,
+        FIELD_DIRECTION: DIR_REQUEST,
+        FIELD_TYPE: TYPE_FILE,
+        FIELD_TOKEN: token,
+        FIELD_KEY: file_key
+    }
+    json_data, _ = send_request(verify_request)
+
+    if json_data and json_data.get(FIELD_MD5):
+        return json_data[FIELD_MD5]
     return None
 
 
@@ -340,14 +1102,22 @@ def main():
     file_path = args.f
     password = username
 
-    token = login(username, password)
+    token = login(username, password, binary_header=not args.json_header)
     if token:
         print(f"Token: {token}")
         # Add token verification
         if verify_token(token):
             save_token(token)
-            if os.path.exists(file_path):
-                success = upload_file(token, file_path)
+            if args.download is not None:
+                out_path = args.out or os.path.basename(args.download)
+                success = download_file(token, args.download, out_path, window=args.window, streams=args.streams,
+                                        block_size=args.block_size, compression=args.compress)
+                if not success:
+                    print("File download failed")
+            elif os.path.exists(file_path):
+                success = upload_file(token, file_path, window=args.window, streams=args.streams,
+                                      block_size=args.block_size, resume=args.resume,
+                                      compression=args.compress, compress_level=args.compress_level)
                 if not success:
                     print("File upload failed")
             else:
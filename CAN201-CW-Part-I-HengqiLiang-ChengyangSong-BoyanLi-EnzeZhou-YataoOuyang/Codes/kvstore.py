@@ -0,0 +1,346 @@
+"""
+Storage backends of the DATA operations.
+FileStore keeps every key as its own json file in data/<username>/ (the original layout),
+LogStore appends the records to segment files with an in-memory index, compaction and an LRU cache.
+Both have the same interface: get(), save() and delete() on (username, key), and get_many(),
+save_many() and delete_many() for a batch of keys in one pass.
+"""
+import json
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from os.path import join
+
+
+class FileStore:
+    """
+    One json file per key: <root>/<username>/<key>
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def get(self, username, key):
+        """
+        :return: the saved dict, or None if the key is not existing
+        """
+        if os.path.exists(join(self.root, username, key)) is False:
+            return None
+        with open(join(self.root, username, key), 'r') as fid:
+            return json.load(fid)
+
+    def save(self, username, key, value):
+        """
+        :return: False if the key is existing
+        """
+        if os.path.exists(join(self.root, username, key)) is True:
+            return False
+        with open(join(self.root, username, key), 'w') as fid:
+            json.dump(value, fid)
+        return True
+
+    def delete(self, username, key):
+        """
+        :return: False if the key is not existing
+        """
+        if os.path.exists(join(self.root, username, key)) is False:
+            return False
+        os.remove(join(self.root, username, key))
+        return True
+
+    def get_many(self, username, keys):
+        """
+        :return: list of the saved dicts, None for the keys that are not existing
+        """
+        return [self.get(username, key) for key in keys]
+
+    def save_many(self, username, items):
+        """
+        :param items: list of (key, value)
+        :return: list of bools, False for the keys that are existing
+        """
+        return [self.save(username, key, value) for key, value in items]
+
+    def delete_many(self, username, keys):
+        """
+        :return: list of bools, False for the keys that are not existing
+        """
+        return [self.delete(username, key) for key in keys]
+
+    def close(self):
+        pass
+
+
+class LogStore:
+    """
+    Log-structured store: records are appended to <root>/segment-<n>.log, an in-memory hash index maps
+    (username, key) to the place of the current value, and decoded values are kept in a bounded LRU cache.
+    A deletion appends a tombstone. The index is rebuilt by scanning the segments when the store is opened,
+    a torn record at the end of the last segment (e.g. after a crash) is cut off.
+    A background thread compacts the sealed segments whose records are mostly overwritten or deleted,
+    by appending their live records again and removing the segment.
+    """
+    RECORD = struct.Struct('!IBHI')  # crc32 of the rest of the record, kind, length of username\0key, length of value
+    PUT, DELETE = 1, 2
+    SEGMENT_NAME = re.compile(r'^segment-(\d+)\.log$')
+
+    def __init__(self, root, segment_size=64 * 1024 * 1024, cache_entries=10000, compact_ratio=0.5):
+        """
+        :param root: folder of the segment files
+        :param segment_size: a new segment is started when the active one is larger
+        :param cache_entries: number of decoded values kept in memory
+        :param compact_ratio: a sealed segment is compacted when this part of its bytes is garbage
+        """
+        self.root = root
+        self.segment_size = segment_size
+        self.cache_entries = cache_entries
+        self.compact_ratio = compact_ratio
+        self.lock = threading.Lock()
+        self.index = {}  # (username, key) -> (segment id, offset of the value, length of the value)
+        self.cache = OrderedDict()  # (username, key) -> decoded value, most recently used last
+        self.segments = {}  # segment id -> fd
+        self.sizes = {}  # segment id -> size in bytes
+        self.live = {}  # segment id -> bytes of the records still in the index
+        os.makedirs(root, exist_ok=True)
+        ids = sorted(int(m.group(1)) for m in map(self.SEGMENT_NAME.match, os.listdir(root)) if m)
+        for segment_id in ids:
+            self._open_segment(segment_id)
+            self._load_segment(segment_id, segment_id == ids[-1])
+        self.active = ids[-1] if ids else self._open_segment(1)
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.compactor = threading.Thread(target=self._compact_loop, daemon=True)
+        self.compactor.start()
+
+    def _path(self, segment_id):
+        return join(self.root, f'segment-{segment_id:06d}.log')
+
+    def _open_segment(self, segment_id):
+        self.segments[segment_id] = os.open(self._path(segment_id), os.O_RDWR | os.O_CREAT | os.O_APPEND)
+        self.sizes[segment_id] = os.fstat(self.segments[segment_id]).st_size
+        self.live[segment_id] = 0
+        return segment_id
+
+    def _records(self, segment_id):
+        """
+        Scan a segment
+        :return: iterator of (offset, record size, kind, username, key, value offset, value length),
+                 stops at the first torn or corrupt record
+        """
+        fd = self.segments[segment_id]
+        size = self.sizes[segment_id]
+        offset = 0
+        while offset + self.RECORD.size <= size:
+            head = os.pread(fd, self.RECORD.size, offset)
+            crc, kind, name_len, value_len = self.RECORD.unpack(head)
+            record_size = self.RECORD.size + name_len + value_len
+            if offset + record_size > size:
+                return
+            body = os.pread(fd, name_len + value_len, offset + self.RECORD.size)
+            if zlib.crc32(head[4:] + body) != crc or kind not in (self.PUT, self.DELETE):
+                return
+            username, _, key = body[:name_len].decode().partition('\0')
+            yield offset, record_size, kind, username, key, offset + self.RECORD.size + name_len, value_len
+            offset += record_size
+
+    def _load_segment(self, segment_id, last):
+        end = 0
+        for offset, record_size, kind, username, key, value_offset, value_len in self._records(segment_id):
+            self._drop((username, key))
+            if kind == self.PUT:
+                self.index[(username, key)] = (segment_id, value_offset, value_len)
+                self.live[segment_id] += record_size
+            end = offset + record_size
+        if end < self.sizes[segment_id] and last:
+            # Torn write at the end of the log
+            os.ftruncate(self.segments[segment_id], end)
+            self.sizes[segment_id] = end
+
+    def _drop(self, name):
+        """
+        Forget the current value of a key (the caller holds the lock)
+        """
+        entry = self.index.pop(name, None)
+        if entry is not None:
+            segment_id, value_offset, value_len = entry
+            self.live[segment_id] -= self.RECORD.size + len(name[0].encode()) + 1 + len(name[1].encode()) + value_len
+        self.cache.pop(name, None)
+
+    def _append(self, kind, name, value_bytes):
+        """
+        Append a record to the active segment (the caller holds the lock)
+        :return: (segment id, offset of the value)
+        """
+        return self._append_many([(kind, name, value_bytes)])[0]
+
+    def _append_many(self, records):
+        """
+        Append records to the active segment with one write (the caller holds the lock)
+        :param records: list of (kind, name, value bytes)
+        :return: list of (segment id, offset of the value)
+        """
+        if self.sizes[self.active] >= self.segment_size:
+            self.active = self._open_segment(self.active + 1)
+        offset = self.sizes[self.active]
+        places = []
+        parts = []
+        for kind, name, value_bytes in records:
+            name_bytes = f'{name[0]}\0{name[1]}'.encode()
+            body = self.RECORD.pack(0, kind, len(name_bytes), len(value_bytes))[4:] + name_bytes + value_bytes
+            parts += [struct.pack('!I', zlib.crc32(body)), body]
+            places.append((self.active, offset + self.RECORD.size + len(name_bytes)))
+            offset += 4 + len(body)
+            if kind == self.PUT:
+                self.live[self.active] += 4 + len(body)
+        os.write(self.segments[self.active], b''.join(parts))
+        self.sizes[self.active] = offset
+        return places
+
+    def _cache_put(self, name, value):
+        self.cache[name] = value
+        self.cache.move_to_end(name)
+        while len(self.cache) > self.cache_entries:
+            self.cache.popitem(last=False)
+
+    def _get(self, name):
+        """
+        (the caller holds the lock)
+        """
+        value = self.cache.get(name)
+        if value is not None:
+            self.cache.move_to_end(name)
+            return dict(value)
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        segment_id, value_offset, value_len = entry
+        value = json.loads(os.pread(self.segments[segment_id], value_len, value_offset))
+        self._cache_put(name, value)
+        return dict(value)
+
+    def get(self, username, key):
+        """
+        :return: the saved dict (a copy), or None if the key is not existing
+        """
+        with self.lock:
+            return self._get((username, key))
+
+    def get_many(self, username, keys):
+        """
+        :return: list of the saved dicts, None for the keys that are not existing
+        """
+        with self.lock:
+            return [self._get((username, key)) for key in keys]
+
+    def save(self, username, key, value):
+        """
+        :return: False if the key is existing
+        """
+        name = (username, key)
+        value_bytes = json.dumps(value, ensure_ascii=False).encode()
+        with self.lock:
+            if name in self.index:
+                return False
+            segment_id, value_offset = self._append(self.PUT, name, value_bytes)
+            self.index[name] = (segment_id, value_offset, len(value_bytes))
+        return True
+
+    def save_many(self, username, items):
+        """
+        :param items: list of (key, value)
+        :return: list of bools, False for the keys that are existing (or repeated in the batch)
+        """
+        encoded = [(key, json.dumps(value, ensure_ascii=False).encode()) for key, value in items]
+        with self.lock:
+            saved = []
+            records = []
+            batch = set()
+            for key, value_bytes in encoded:
+                name = (username, key)
+                if name in self.index or name in batch:
+                    saved.append(False)
+                    continue
+                saved.append(True)
+                batch.add(name)
+                records.append((self.PUT, name, value_bytes))
+            if records:
+                for (_, name, value_bytes), (segment_id, value_offset) in zip(records, self._append_many(records)):
+                    self.index[name] = (segment_id, value_offset, len(value_bytes))
+        return saved
+
+    def delete(self, username, key):
+        """
+        :return: False if the key is not existing
+        """
+        return self.delete_many(username, [key])[0]
+
+    def delete_many(self, username, keys):
+        """
+        :return: list of bools, False for the keys that are not existing
+        """
+        with self.lock:
+            deleted = []
+            records = []
+            for key in keys:
+                name = (username, key)
+                if name not in self.index:
+                    deleted.append(False)
+                    continue
+                self._drop(name)
+                deleted.append(True)
+                records.append((self.DELETE, name, b''))
+            if records:
+                self._append_many(records)
+        if records:
+            self.wakeup.set()
+        return deleted
+
+    def _compact_loop(self):
+        while not self.closed:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if not self.closed:
+                self.compact()
+
+    def compact(self):
+        """
+        Rewrite the sealed segments that are mostly garbage
+        :return: number of compacted segments
+        """
+        with self.lock:
+            candidates = [segment_id for segment_id in self.segments if segment_id != self.active
+                          and self.sizes[segment_id] > 0
+                          and 1 - self.live[segment_id] / self.sizes[segment_id] >= self.compact_ratio]
+        for segment_id in candidates:
+            for offset, _, kind, username, key, value_offset, value_len in self._records(segment_id):
+                name = (username, key)
+                with self.lock:
+                    if kind == self.DELETE:
+                        # A tombstone is still needed while an older segment may hold a value of the key
+                        if name not in self.index and min(self.segments) < segment_id:
+                            self._append(self.DELETE, name, b'')
+                        continue
+                    # Only the records that are still the current value move
+                    if self.index.get(name) != (segment_id, value_offset, value_len):
+                        continue
+                    value_bytes = os.pread(self.segments[segment_id], value_len, value_offset)
+                    self._drop(name)
+                    new_segment_id, new_offset = self._append(self.PUT, name, value_bytes)
+                    self.index[name] = (new_segment_id, new_offset, value_len)
+            with self.lock:
+                os.close(self.segments.pop(segment_id))
+                del self.sizes[segment_id], self.live[segment_id]
+                os.remove(self._path(segment_id))
+        return len(candidates)
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.compactor.join()
+        with self.lock:
+            for fd in self.segments.values():
+                os.close(fd)
+            self.segments.clear()
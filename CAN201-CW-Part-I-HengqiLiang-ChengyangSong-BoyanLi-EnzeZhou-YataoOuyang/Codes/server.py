@@ -2,19 +2,52 @@ import struct # extra added (integers packed into binary)
 from socket import *
 import json
 import os
-from os.path import join, getsize
+from os.path import join
 import hashlib
 import argparse
-from threading import Thread
+from threading import Thread, Lock, Condition, local
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import time
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
+import itertools
 import base64
 import uuid
 import math
 import shutil
-
-MAX_PACKET_SIZE = 20480
+import mmap
+import zlib
+import lzma
+import signal
+import select
+import selectors
+import errno
+import re
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from kvstore import FileStore, LogStore
+try:
+    import fcntl  # flock() between the --workers processes
+except ImportError:
+    fcntl = None
+try:
+    from socket import MSG_MORE  # Linux: hold the header until the file data follows
+except ImportError:
+    MSG_MORE = 0
+try:
+    from socket import SO_REUSEPORT  # --workers: every worker listens on the port, the kernel spreads the connections
+except ImportError:
+    SO_REUSEPORT = None
+
+MAX_PACKET_SIZE = 20480  # Block size of the plans for clients that do not ask for one
+MIN_BLOCK_SIZE, MAX_BLOCK_SIZE = 64 * 1024, 8 * 1024 * 1024  # Range of the "block_size" a client can ask for
+MAX_BATCH_ITEMS = 1000  # Keys or items of one batched DATA request
+IOV_MAX = 1024  # buffers of one os.pwritev
 
 # Const Value
 OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN, OP_ERROR = 'SAVE', 'DELETE', 'GET', 'UPLOAD', 'DOWNLOAD', 'BYE', 'LOGIN', "ERROR"
@@ -22,12 +55,155 @@ TYPE_FILE, TYPE_DATA, TYPE_AUTH, DIR_EARTH = 'FILE', 'DATA', 'AUTH', 'EARTH'
 FIELD_OPERATION, FIELD_DIRECTION, FIELD_TYPE, FIELD_USERNAME, FIELD_PASSWORD, FIELD_TOKEN = 'operation', 'direction', 'type', 'username', 'password', 'token'
 FIELD_KEY, FIELD_SIZE, FIELD_TOTAL_BLOCK, FIELD_MD5, FIELD_BLOCK_SIZE = 'key', 'size', 'total_block', 'md5', 'block_size'
 FIELD_STATUS, FIELD_STATUS_MSG, FIELD_BLOCK_INDEX = 'status', 'status_msg', 'block_index'
+FIELD_TREE_MD5, FIELD_RECEIVED_BLOCK = 'tree_md5', 'received_block'
+FIELD_HEADER, FIELD_COMPRESSION = 'header', 'compression'
+FIELD_DEDUP, FIELD_COMPLETED = 'dedup', 'completed'
+FIELD_KEYS, FIELD_ITEMS, FIELD_RESULTS = 'keys', 'items', 'results'
+FIELD_RETRY_AFTER = 'retry_after'  # milliseconds, in the busy (503) responses
+COMPRESSIONS = ['zlib', 'lzma']  # per-block compression methods, negotiated at LOGIN
+OP_RESUME, OP_STAT = 'RESUME', 'STAT'
 DIR_REQUEST, DIR_RESPONSE = 'REQUEST', 'RESPONSE'
 #define constants
 
 logger = logging.getLogger('')
+BLOCK_LOG = {'block': True}  # extra= of the per-block log lines, they are sampled by BlockLogSampler
 # Logs
 
+FULL_MD5 = False  # --full_md5: re-read the whole file for "md5" when the stream MD5 is not available
+COMPRESS_LEVEL = 6  # --compress_level: of the DOWNLOAD blocks a client asks to be compressed
+RETRY_AFTER_MS = 100  # --retry_after: hint of the busy responses
+IDLE_TIMEOUT = 60  # --idle_timeout: seconds a thread engine connection may wait for its next request, 0 is no limit
+RESERVE_BYTES = 64 * 1024 * 1024  # --reserve_mb: free disk space an upload plan must leave
+QUOTA_BYTES = 0  # --quota_mb: bytes of stored files and upload plans per user, 0 is no quota
+DURABILITY = 'none'  # --durability: when the received blocks are synced to the disk, see BlockWriter
+COALESCE_BYTES = 1024 * 1024  # --coalesce_kb: buffered blocks of an upload are written out together, 0 is no buffer
+COALESCE_SECONDS = 0.1  # --coalesce_ms: longest time a block stays in the buffer
+FSYNC_BYTES = 16 * 1024 * 1024  # --fsync_mb: written bytes of an upload between two syncs with --durability every_mb
+upload_sessions = {}  # (username, key) -> UploadSession of the uploads in progress
+upload_sessions_lock = Lock()
+WORKERS = 1  # --workers: processes sharing the port, the upload state is then also changed by the others
+WORKER_ID = 0  # of this process, 1..WORKERS in a worker, 0 without --workers
+
+
+class ProcessLock:
+    """
+    Lock of the threads of this process that is also held against the other --workers processes,
+    with flock() on a lock file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.fd = None
+        self.pid = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if fcntl is not None:
+            if self.pid != os.getpid():
+                # A flock() is held by the open file, so a forked worker needs its own
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                self.pid = os.getpid()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+class FileHandle:
+    """
+    An open descriptor of FileHandleCache
+    """
+
+    def __init__(self, fd, flags):
+        self.fd = fd
+        self.flags = flags
+        self.inode = os.fstat(fd).st_ino
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.cached = True  # False once evicted or discarded, the last user closes it
+
+
+class FileHandleCache:
+    """
+    LRU cache of open file descriptors by path (the tmp file and digests of an upload, the stored file of a
+    download, i.e. per user and key), so that a block is one os.pwrite/os.pread instead of open, seek,
+    read/write and close. A descriptor is never closed under a thread using it: eviction and discard()
+    only drop it from the cache, the last user closes it. Descriptors idle for idle_seconds are closed
+    as the cache is used.
+    """
+
+    def __init__(self, capacity=256, idle_seconds=30):
+        self.capacity = capacity
+        self.idle_seconds = idle_seconds
+        self.lock = Lock()
+        self.entries = OrderedDict()  # path -> FileHandle, least recently used first
+        self.next_sweep = time.monotonic() + 1
+
+    @contextmanager
+    def open(self, path, flags=os.O_RDWR, inode=None):
+        """
+        Borrow the descriptor of a path, opening it if it is not cached
+        :param flags: of os.open
+        :param inode: of the file now at the path, a cached descriptor of another file is replaced
+        :return: the descriptor, for the with block
+        """
+        handle = self._acquire(path, flags, inode)
+        try:
+            yield handle.fd
+        finally:
+            with self.lock:
+                handle.users -= 1
+                handle.last_used = time.monotonic()
+                if handle.cached is False and handle.users == 0:
+                    os.close(handle.fd)
+
+    def _acquire(self, path, flags, inode):
+        with self.lock:
+            handle = self.entries.get(path)
+            if handle is not None and (handle.flags != flags or inode is not None and handle.inode != inode):
+                self._drop(path)
+                handle = None
+            if handle is None:
+                handle = self.entries[path] = FileHandle(os.open(path, flags), flags)
+                while len(self.entries) > self.capacity:
+                    self._drop(next(iter(self.entries)))
+            else:
+                self.entries.move_to_end(path)
+            handle.users += 1
+            now = time.monotonic()
+            if now >= self.next_sweep:
+                self.next_sweep = now + 1
+                for idle_path in [idle_path for idle_path, idle in self.entries.items()
+                                  if idle.users == 0 and now - idle.last_used > self.idle_seconds]:
+                    self._drop(idle_path)
+            return handle
+
+    def _drop(self, path):
+        """
+        (the caller holds the lock)
+        """
+        handle = self.entries.pop(path, None)
+        if handle is not None:
+            handle.cached = False
+            if handle.users == 0:
+                os.close(handle.fd)
+
+    def discard(self, *paths):
+        """
+        Forget the descriptors of paths that are removed, moved or recreated
+        """
+        with self.lock:
+            for path in paths:
+                self._drop(path)
+
+
+fd_cache = FileHandleCache()  # --fd_cache, --fd_idle
+
+
 def getfile_md5(filename):
     """
     Get MD5 value for big file
@@ -44,6 +220,844 @@ def getfile_md5(filename):
     return m.hexdigest()
 # Generate md5 hashes to determine if a file has been changed
 
+def tree_md5(block_digests):
+    """
+    Tree hash of a file: MD5 over the concatenated MD5 digests (16 bytes each) of its blocks
+    :param block_digests: bytes
+    :return: hex digest
+    """
+    return hashlib.md5(block_digests).hexdigest()
+
+
+MD5_HEX = re.compile(r'[0-9a-f]{32}')
+
+
+def is_md5(value):
+    """
+    :return: True if value is a lowercase hex MD5 digest, the only "md5" a client may name content by
+    """
+    return isinstance(value, str) and MD5_HEX.fullmatch(value) is not None
+
+
+class UploadSession:
+    """
+    State of one upload in progress, kept in the memory-mapped file tmp/<username>/<key>.state so
+    that it survives a crash: the plan, a running count of received blocks and one bit per block.
+    Marking a block and detecting completion are constant time.
+    The bitmap is shared through the file by the --workers processes (changed under flock()),
+    the stream MD5 of the blocks received in order only lives in the memory of one process.
+    """
+    HEADER = struct.Struct('!4sQIII')  # magic, file size, block size, total block, received blocks
+    MAGIC = b'STEP'
+
+    def __init__(self, path, fid):
+        self.path = path
+        self.lock = Lock()
+        self.fid = fid
+        self.inode = os.fstat(fid.fileno()).st_ino
+        self.mm = mmap.mmap(fid.fileno(), 0)
+        self.writer = BlockWriter(self, path[:-len('.state')])
+        magic, self.file_size, self.block_size, self.total_block, received = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not an upload state file')
+        self.stream_next = 0 if received == 0 else None  # next block of the stream MD5, None if given up
+        self.stream_md5 = hashlib.md5()
+
+    @classmethod
+    def create(cls, path, file_size, block_size, total_block):
+        """
+        Create the state file of a new upload plan
+        """
+        fid = open(path, 'wb+')
+        fid.write(cls.HEADER.pack(cls.MAGIC, file_size, block_size, total_block, 0))
+        fid.write(bytes(math.ceil(total_block / 8)))
+        fid.flush()
+        return cls(path, fid)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Open the state file of an upload started earlier (e.g. before a restart)
+        """
+        return cls(path, open(path, 'rb+'))
+
+    @property
+    def received(self):
+        return self.HEADER.unpack_from(self.mm, 0)[4]
+
+    def current(self):
+        """
+        :return: False if the state file was removed or replaced (by another worker) since it was opened
+        """
+        try:
+            return os.stat(self.path).st_ino == self.inode
+        except FileNotFoundError:
+            return False
+
+    def mark(self, block_index):
+        """
+        Record a received block
+        :return: True only for the call that records the last missing block, in any worker
+        """
+        byte, bit = divmod(block_index, 8)
+        pos = self.HEADER.size + byte
+        with self.lock:
+            if fcntl is not None:
+                fcntl.flock(self.fid, fcntl.LOCK_EX)
+            try:
+                if self.mm[pos] & (1 << bit):
+                    return False
+                self.mm[pos] |= 1 << bit
+                received = self.received + 1
+                struct.pack_into('!I', self.mm, self.HEADER.size - 4, received)
+                return received == self.total_block
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.fid, fcntl.LOCK_UN)
+
+    def has(self, block_index):
+        """
+        :return: True if the block is recorded as received
+        """
+        byte, bit = divmod(block_index, 8)
+        return bool(self.mm[self.HEADER.size + byte] & (1 << bit))
+
+    def bitmap(self):
+        """
+        :return: a copy of the received-block bitmap, bit (i % 8) of byte (i // 8) is block i
+        """
+        with self.lock:
+            if fcntl is not None:
+                fcntl.flock(self.fid, fcntl.LOCK_SH)
+            try:
+                return bytes(self.mm[self.HEADER.size:])
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.fid, fcntl.LOCK_UN)
+
+    def update_stream(self, block_index, bin_data):
+        """
+        Feed a block into the stream MD5. Only the next expected block extends it,
+        any block arriving ahead of it gives up the stream MD5 for this upload.
+        """
+        with self.lock:
+            if self.stream_next is None:
+                return
+            if block_index == self.stream_next:
+                self.stream_md5.update(bin_data)
+                self.stream_next += 1
+            elif block_index > self.stream_next:
+                self.stream_next = None
+
+    def stream_hexdigest(self):
+        """
+        :return: the MD5 of the whole file, or None if the blocks did not all arrive in order
+        """
+        if self.stream_next != self.total_block:
+            return None
+        return self.stream_md5.hexdigest()
+
+    def close(self):
+        self.writer.close()
+        self.mm.close()
+        self.fid.close()
+
+
+def write_runs(fd, blocks, unit):
+    """
+    Write blocks with one call per run of adjacent blocks (os.pwritev where available)
+    :param blocks: list of (index, bytes) sorted by index, a block is at offset index * unit
+    :return: number of write calls
+    """
+    writes = 0
+    start = 0
+    while start < len(blocks):
+        end = start + 1
+        while end < len(blocks) and blocks[end][0] == blocks[end - 1][0] + 1 and end - start < IOV_MAX:
+            end += 1
+        buffers = [data for _, data in blocks[start:end]]
+        offset = blocks[start][0] * unit
+        total = sum(len(data) for data in buffers)
+        written = os.pwritev(fd, buffers, offset) if hasattr(os, 'pwritev') else 0
+        if written < total:
+            data = memoryview(b''.join(buffers))
+            while written < total:
+                written += os.pwrite(fd, data[written:], offset + written)
+        writes += 1
+        start = end
+    return writes
+
+
+def sync_files(*fds):
+    start = time.perf_counter()
+    for fd in fds:
+        os.fsync(fd)
+    metrics.observe_fsync(time.perf_counter() - start, len(fds))
+
+
+def sync_dir(path):
+    """
+    Sync a folder, so that a file renamed into it stays there after a crash
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        sync_files(fd)
+    finally:
+        os.close(fd)
+
+
+class BlockWriter:
+    """
+    Write-behind stage of one upload (UploadSession.writer): the received blocks are buffered and
+    written out together, sorted with one os.pwritev per run of adjacent blocks, once COALESCE_BYTES are
+    buffered, the oldest one waited COALESCE_SECONDS (write_behind_loop) or the upload has all its blocks.
+    A block is only recorded in the session once it is as durable as DURABILITY promises, so after a
+    crash RESUME asks again for every block that was only buffered, or written but not synced:
+        none      the ACK of a block is sent once it is buffered, nothing is synced
+        complete  as none, but the file (and its rename into file/) is synced before the last ACK
+        every_mb  the file and its digests are synced every FSYNC_BYTES and at the end, the blocks are
+                  recorded then; the ACK of the block that reaches the threshold waits for the sync
+    """
+
+    def __init__(self, session, path):
+        self.session = session
+        self.path = path  # the tmp file, its per-block digests are in path + '.md5s'
+        self.lock = Lock()
+        self.pending = {}  # block index -> (data, MD5 digest), not written yet
+        self.pending_bytes = 0
+        self.oldest = 0  # time.monotonic() of the oldest pending block
+        self.unsynced = []  # indexes of the blocks written but not synced yet (every_mb)
+        self.unsynced_bytes = 0
+        self.waiting = set()  # indexes of the pending and unsynced blocks that are not recorded
+        self.closed = False
+
+    def add(self, block_index, data):
+        """
+        Buffer a received block
+        :return: True for the block that completes the upload: every block is then written and recorded
+        """
+        if isinstance(data, bytes) is False:
+            data = bytes(data)  # a view of the receive buffer of the connection, which is reused
+        digest = hashlib.md5(data).digest()
+        with self.lock:
+            if self.closed:
+                return False
+            if not self.pending:
+                self.oldest = time.monotonic()
+            previous = self.pending.get(block_index)
+            if previous is not None:
+                self.pending_bytes -= len(previous[0])
+            self.pending[block_index] = (data, digest)
+            self.pending_bytes += len(data)
+            if self.session.has(block_index) is False:
+                self.waiting.add(block_index)
+            # The last missing block is written in the same call, so the completion stays with its request
+            final = self.session.received + len(self.waiting) >= self.session.total_block
+            if final or self.pending_bytes >= COALESCE_BYTES:
+                return self._write(final)
+            return False
+
+    def flush(self, older_than=None):
+        """
+        Write out the pending blocks
+        :param older_than: seconds, only if the oldest pending block waited that long
+        """
+        with self.lock:
+            if self.closed or not self.pending:
+                return
+            if older_than is not None and time.monotonic() - self.oldest < older_than:
+                return
+            self._write(False)
+
+    def _write(self, final):
+        """
+        (the caller holds the lock)
+        :param final: every block of the upload is received, sync and record all of them
+        :return: True if the last missing block got recorded
+        """
+        blocks = sorted(self.pending.items())
+        size = self.pending_bytes
+        self.pending = {}
+        self.pending_bytes = 0
+        recorded = [block_index for block_index, _ in blocks]
+        start = time.perf_counter()
+        with fd_cache.open(self.path) as fd, fd_cache.open(self.path + '.md5s', os.O_RDWR | os.O_CREAT) as md5_fd:
+            writes = write_runs(fd, [(block_index, data) for block_index, (data, _) in blocks], self.session.block_size)
+            writes += write_runs(md5_fd, [(block_index, digest) for block_index, (_, digest) in blocks], 16)
+            metrics.observe_disk_write(time.perf_counter() - start, size, writes)
+            if DURABILITY == 'every_mb':
+                self.unsynced += recorded
+                self.unsynced_bytes += size
+                if final is False and self.unsynced_bytes < FSYNC_BYTES:
+                    return False
+                recorded, self.unsynced, self.unsynced_bytes = self.unsynced, [], 0
+                sync_files(fd, md5_fd)
+        completed = False
+        for block_index in recorded:
+            completed = self.session.mark(block_index) or completed
+            self.waiting.discard(block_index)
+        return completed
+
+    def close(self):
+        """
+        Drop the blocks not written yet (the plan is replaced, deleted or completed)
+        """
+        with self.lock:
+            self.closed = True
+            self.pending = {}
+
+
+def write_behind_loop():
+    """
+    Write out the blocks that waited COALESCE_SECONDS in the buffer of an upload
+    """
+    while True:
+        time.sleep(COALESCE_SECONDS / 2)
+        with upload_sessions_lock:
+            sessions = list(upload_sessions.values())
+        for session in sessions:
+            try:
+                session.writer.flush(COALESCE_SECONDS)
+            except Exception as ex:
+                logger.error(f'Write-behind of {session.writer.path} failed: {str(ex)}@{ex.__traceback__.tb_lineno}')
+
+
+class FileMetadataIndex:
+    """
+    Size and MD5 of the completed files, so that a GET plan does not re-hash the file.
+    Entries are keyed by path and only trusted while (inode, size, mtime) still match the file.
+    The index is persisted in meta/index.log, one json line appended per stored or removed entry, so an
+    update is one small write whatever the number of files. The log is rewritten with only the live
+    entries (atomic replace) once it has COMPACT_RATIO times more lines than entries.
+    The --workers processes append under a ProcessLock and read the lines the others appended since,
+    or the whole log again when another one compacted it.
+    """
+    COMPACT_RATIO = 2
+    COMPACT_MIN_LINES = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.file_lock = ProcessLock(path + '.lock')
+        self.entries = None
+        self.inode = None  # of the log the entries were read from
+        self.offset = 0  # bytes of the log read so far, up to the end of a complete line
+        self.lines = 0  # lines of the log up to offset
+
+    def _load(self, refresh=False):
+        """
+        (the caller holds self.lock)
+        :param refresh: also read what was appended to the log, or all of it if it was replaced, since it was read
+        """
+        if self.entries is not None and refresh is False:
+            return
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            self.entries, self.inode, self.offset, self.lines = {}, None, 0, 0
+            return
+        try:
+            st = os.fstat(fd)
+            if self.entries is None or st.st_ino != self.inode:
+                self.entries, self.inode, self.offset, self.lines = {}, st.st_ino, 0, 0
+            if st.st_size > self.offset:
+                data = os.pread(fd, st.st_size - self.offset, self.offset)
+                end = data.rfind(b'\n') + 1  # a torn line at the end (a crashed writer) is not read
+                for line in data[:end].splitlines():
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError) as ex:
+                        logger.error(f'Metadata index {self.path} has an unreadable line, skipped. {str(ex)}')
+                    self.lines += 1
+                self.offset += end
+        finally:
+            os.close(fd)
+
+    def _apply(self, record):
+        file_path = record.pop('path')
+        if record.get('removed'):
+            self.entries.pop(file_path, None)
+        else:
+            self.entries[file_path] = record
+
+    def _append(self, record):
+        """
+        (the caller holds self.file_lock and self.lock, and has refreshed the entries)
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        line = (json.dumps(record) + '\n').encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            st = os.fstat(fd)
+            if st.st_ino != self.inode:
+                # Created by this append
+                self.inode, self.offset, self.lines = st.st_ino, 0, 0
+            if st.st_size > self.offset:
+                # Only a torn line is left after the refresh, the new line must not be glued to it
+                os.ftruncate(fd, self.offset)
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self.offset += len(line)
+        self.lines += 1
+        self._apply(record)
+        if self.lines >= max(self.COMPACT_MIN_LINES, self.COMPACT_RATIO * len(self.entries)):
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrite the log with the live entries (the caller holds self.file_lock and self.lock)
+        """
+        with open(self.path + '.tmp', 'w') as fid:
+            for file_path, entry in self.entries.items():
+                fid.write(json.dumps({'path': file_path, **entry}) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        st = os.stat(self.path)
+        self.inode, self.offset, self.lines = st.st_ino, st.st_size, len(self.entries)
+
+    def lookup(self, file_path, st):
+        """
+        :param file_path:
+        :param st: os.stat() of file_path
+        :return: the entry {'inode', 'size', 'mtime_ns', 'md5'}, or None if missing or stale
+        """
+        with self.lock:
+            self._load()
+            entry = self.entries.get(file_path)
+            if not self._matches(entry, st):
+                # Another worker may have stored it since
+                self._load(refresh=True)
+                entry = self.entries.get(file_path)
+        return entry if self._matches(entry, st) else None
+
+    @staticmethod
+    def _matches(entry, st):
+        return entry is not None and entry['inode'] == st.st_ino and entry['size'] == st.st_size \
+            and entry['mtime_ns'] == st.st_mtime_ns
+
+    def store(self, file_path, st, md5):
+        with self.file_lock, self.lock:
+            self._load(refresh=True)
+            self._append({'path': file_path, 'inode': st.st_ino, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                          'md5': md5})
+
+    def remove(self, file_path):
+        with self.file_lock, self.lock:
+            self._load(refresh=True)
+            if file_path in self.entries:
+                self._append({'path': file_path, 'removed': True})
+
+
+file_index = FileMetadataIndex(join('meta', 'index.log'))
+
+
+class ContentStore:
+    """
+    Content-addressed store of the completed files (--dedup): one object per content in
+    cas/<username>/<md5[:2]>/<md5>, and every file/<username>/<key> with that content is a hard link to it.
+    st_nlink - 1 is the number of keys referencing an object, it is deleted with its last key.
+    Objects are kept per user, so knowing a digest never gives access to another user's file.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.lock = ProcessLock(join(root, '.lock'))  # also held against the other --workers processes
+
+    def object_path(self, username, md5):
+        if is_md5(md5) is False:
+            # The digest becomes a path, anything else could name a file outside the store
+            raise ValueError(f'{md5!r} is not an MD5 digest')
+        return join(self.root, username, md5[:2], md5)
+
+    def adopt(self, username, file_path, md5):
+        """
+        Store a newly completed file: it becomes the object of its content,
+        or is replaced by a link to the object that already has the same content
+        """
+        obj = self.object_path(username, md5)
+        with self.lock:
+            if os.path.exists(obj):
+                # A unique name next to the file, so a link left by a crash never blocks the next one
+                tmp_link = f'{file_path}.{uuid.uuid4().hex}.link'
+                os.link(obj, tmp_link)
+                try:
+                    os.replace(tmp_link, file_path)
+                except OSError:
+                    os.remove(tmp_link)
+                    raise
+            else:
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                os.link(file_path, obj)
+
+    def link(self, username, md5, size, file_path):
+        """
+        Make file_path a new key of stored content
+        :return: False if there is no object with this md5 and size
+        """
+        obj = self.object_path(username, md5)
+        with self.lock:
+            try:
+                if os.stat(obj).st_size != size:
+                    return False
+            except FileNotFoundError:
+                return False
+            os.link(obj, file_path)
+        return True
+
+    def remove(self, username, file_path):
+        """
+        Delete a key, and its object if no other key references it
+        """
+        with self.lock:
+            st = os.stat(file_path)
+            obj = None
+            if st.st_nlink > 1:
+                entry = file_index.lookup(file_path, st)
+                md5 = entry['md5'] if entry is not None and is_md5(entry['md5']) else getfile_md5(file_path)
+                obj = self.object_path(username, md5)
+            os.remove(file_path)
+            if obj is not None:
+                try:
+                    obj_st = os.stat(obj)
+                except FileNotFoundError:
+                    return
+                if obj_st.st_ino == st.st_ino and obj_st.st_nlink == 1:
+                    os.remove(obj)
+
+
+content_store = None  # ContentStore with --dedup
+data_store = FileStore('data')  # backend of the DATA operations, LogStore with --data_backend log
+
+
+def planned_block_size(json_data):
+    """
+    Block size of a SAVE/GET plan (and of the DOWNLOAD requests that follow it): the "block_size"
+    asked by the client clamped to [MIN_BLOCK_SIZE, MAX_BLOCK_SIZE], or MAX_PACKET_SIZE if not asked.
+    MAX_PACKET_SIZE itself is always accepted, so a client can repeat the size of a default plan.
+    :param json_data:
+    :return: the block size, or None if "block_size" is not a positive integer
+    """
+    if FIELD_BLOCK_SIZE not in json_data.keys():
+        return MAX_PACKET_SIZE
+    block_size = json_data[FIELD_BLOCK_SIZE]
+    if type(block_size) is not int or block_size <= 0:
+        return None
+    if block_size == MAX_PACKET_SIZE:
+        return block_size
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def preallocate(path, size):
+    """
+    Create the tmp file of an upload plan with its blocks allocated (posix_fallocate), so the blocks
+    written in any order land in a few extents and a full disk shows at the plan, not in the middle of
+    the upload. A sparse file is made where the call or the file system does not support it.
+    :raise OSError: ENOSPC or EDQUOT if the space is not available, the file is removed then
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError as ex:
+                if ex.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                    raise
+        os.ftruncate(fd, size)
+    except OSError:
+        os.close(fd)
+        os.remove(path)
+        raise
+    os.close(fd)
+
+
+class StorageUsage:
+    """
+    Bytes counted against the quota of every user: the stored files and the tmp files of the upload plans.
+    A user is counted by one walk of file/<username> and tmp/<username> at the first plan, then kept up to
+    date by update() at every change; the hard links of the same content (--dedup) are counted once.
+    With --workers the others change the folders too, so the count is walked again when older than a second.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.users = {}  # username -> [{path: inode}, {inode: [size, links]}, total, time of the walk]
+
+    def _count(self, username):
+        """
+        (the caller holds the lock)
+        """
+        user = self.users.get(username)
+        if user is None or WORKERS > 1 and time.monotonic() - user[3] > 1:
+            user = self.users[username] = [{}, {}, 0, time.monotonic()]
+            for folder in ('file', 'tmp'):
+                for dirpath, _, filenames in os.walk(join(folder, username)):
+                    for name in filenames:
+                        self._add(user, join(dirpath, name))
+        return user
+
+    @staticmethod
+    def _add(user, path):
+        if path.startswith('tmp') and path.endswith(('.md5s', '.state')):
+            return
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        user[0][path] = st.st_ino
+        inode = user[1].setdefault(st.st_ino, [st.st_size, 0])
+        if inode[1] == 0:
+            user[2] += st.st_size
+        inode[1] += 1
+
+    @staticmethod
+    def _discard(user, path):
+        ino = user[0].pop(path, None)
+        if ino is not None:
+            inode = user[1][ino]
+            inode[1] -= 1
+            if inode[1] == 0:
+                user[2] -= inode[0]
+                del user[1][ino]
+
+    def used(self, username, key=None):
+        """
+        :param key: the plan of this key is not counted, it is about to be replaced
+        """
+        with self.lock:
+            user = self._count(username)
+            total = user[2]
+            ino = user[0].get(join('tmp', username, key)) if key is not None else None
+            if ino is not None and user[1][ino][1] == 1:
+                total -= user[1][ino][0]
+            return total
+
+    def update(self, username, *paths):
+        """
+        Count the files now at paths (created, resized, moved or removed) again
+        """
+        with self.lock:
+            user = self.users.get(username)
+            if user is None:
+                return
+            for path in paths:
+                self._discard(user, path)
+                self._add(user, path)
+
+
+storage_usage = StorageUsage()  # with --quota_mb
+
+
+def check_plan_space(username, key, file_size, quota=True, disk=True):
+    """
+    Check the space of an upload plan before anything is written
+    :param quota: check the user's quota (--quota_mb), also needed when the content is linked to a stored object
+    :param disk: check the free disk space, which the tmp file is about to take
+    :return: (status, status message) of the rejection, or None if the plan fits
+    """
+    if quota and QUOTA_BYTES > 0:
+        used = storage_usage.used(username, key)
+        if used + file_size > QUOTA_BYTES:
+            return 413, f'Quota exceeded: {used} of {QUOTA_BYTES} bytes are used, the file needs {file_size}.'
+    if disk:
+        tmp_path = join('tmp', username, key)
+        # The tmp file of a previous plan of the key is replaced
+        free = shutil.disk_usage(join('tmp', username)).free
+        if os.path.exists(tmp_path):
+            free += os.stat(tmp_path).st_blocks * 512
+        if free - file_size < RESERVE_BYTES:
+            return 507, f'Insufficient storage: {free} bytes are free, the file needs {file_size}.'
+    return None
+
+
+def get_upload_session(username, key):
+    """
+    Get the session of an upload in progress, loading its state file if needed
+    :return: UploadSession, or None if there is no upload plan for the key
+    """
+    with upload_sessions_lock:
+        session = upload_sessions.get((username, key))
+        if session is not None and WORKERS > 1 and session.current() is False:
+            # Completed, deleted or planned again by another worker; a thread may still hold the old session
+            del upload_sessions[(username, key)]
+            fd_cache.discard(join('tmp', username, key), join('tmp', username, key + '.md5s'))
+            session = None
+        if session is None:
+            path = join('tmp', username, key + '.state')
+            if os.path.exists(path) is False:
+                return None
+            session = UploadSession.load(path)
+            upload_sessions[(username, key)] = session
+        return session
+
+
+def drop_upload_session(username, key):
+    """
+    Forget an upload session and delete its state file
+    """
+    with upload_sessions_lock:
+        session = upload_sessions.pop((username, key), None)
+    if session is not None:
+        session.close()
+    path = join('tmp', username, key + '.state')
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class Metrics:
+    """
+    Counters and fixed-bucket latency histograms of the server, per (type, operation, status),
+    plus traffic, connection, upload and disk-write figures. Shared by every connection thread.
+    """
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.requests = {}  # (type, operation, status) -> [count, sum of seconds, count per bucket (+Inf last)]
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.active_connections = 0
+        self.disk_write_seconds = 0.0
+        self.disk_write_bytes = 0
+        self.disk_writes = 0
+        self.fsync_seconds = 0.0
+        self.fsyncs = 0
+        self.busy_responses = 0
+
+    def observe_request(self, request_type, request_operation, status, seconds):
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            entry = self.requests.get((request_type, request_operation, status))
+            if entry is None:
+                entry = self.requests[(request_type, request_operation, status)] = \
+                    [0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2][bucket] += 1
+
+    def add_bytes_in(self, size):
+        with self.lock:
+            self.bytes_in += size
+
+    def add_bytes_out(self, size):
+        with self.lock:
+            self.bytes_out += size
+
+    def add_connection(self, delta):
+        with self.lock:
+            self.active_connections += delta
+
+    def observe_disk_write(self, seconds, size, writes=1):
+        with self.lock:
+            self.disk_write_seconds += seconds
+            self.disk_write_bytes += size
+            self.disk_writes += writes
+
+    def observe_fsync(self, seconds, count=1):
+        with self.lock:
+            self.fsync_seconds += seconds
+            self.fsyncs += count
+
+    def add_busy(self):
+        with self.lock:
+            self.busy_responses += 1
+
+    def snapshot(self):
+        """
+        :return: every figure as a json-able dict, the bucket counts are not cumulative
+        """
+        with self.lock:
+            requests = [{'type': request_type, 'operation': request_operation, 'status': status,
+                         'count': entry[0], 'seconds': round(entry[1], 6), 'buckets': list(entry[2])}
+                        for (request_type, request_operation, status), entry in sorted(self.requests.items(),
+                                                                                       key=str)]
+            return {
+                'worker': WORKER_ID,
+                'uptime_seconds': round(time.time() - self.started, 3),
+                'active_connections': self.active_connections,
+                'uploads_in_progress': len(upload_sessions),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'disk_write_seconds': round(self.disk_write_seconds, 6),
+                'disk_write_bytes': self.disk_write_bytes,
+                'disk_writes': self.disk_writes,
+                'fsync_seconds': round(self.fsync_seconds, 6),
+                'fsyncs': self.fsyncs,
+                'busy_responses': self.busy_responses,
+                'buckets': list(self.BUCKETS),
+                'requests': requests
+            }
+
+    def prometheus_text(self):
+        """
+        :return: the snapshot in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, kind, value in (('step_uptime_seconds', 'gauge', snapshot['uptime_seconds']),
+                                  ('step_active_connections', 'gauge', snapshot['active_connections']),
+                                  ('step_uploads_in_progress', 'gauge', snapshot['uploads_in_progress']),
+                                  ('step_received_bytes_total', 'counter', snapshot['bytes_in']),
+                                  ('step_sent_bytes_total', 'counter', snapshot['bytes_out']),
+                                  ('step_disk_write_seconds_total', 'counter', snapshot['disk_write_seconds']),
+                                  ('step_disk_write_bytes_total', 'counter', snapshot['disk_write_bytes']),
+                                  ('step_disk_writes_total', 'counter', snapshot['disk_writes']),
+                                  ('step_fsync_seconds_total', 'counter', snapshot['fsync_seconds']),
+                                  ('step_fsyncs_total', 'counter', snapshot['fsyncs']),
+                                  ('step_busy_responses_total', 'counter', snapshot['busy_responses'])):
+            lines += [f'# TYPE {name} {kind}', f'{name} {value}']
+        lines.append('# TYPE step_request_duration_seconds histogram')
+        for entry in snapshot['requests']:
+            labels = f'type="{entry["type"]}",operation="{entry["operation"]}",status="{entry["status"]}"'
+            cumulative = 0
+            for le, count in zip([*snapshot['buckets'], '+Inf'], entry['buckets']):
+                cumulative += count
+                lines.append(f'step_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'step_request_duration_seconds_sum{{{labels}}} {entry["seconds"]}')
+            lines.append(f'step_request_duration_seconds_count{{{labels}}} {entry["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+request_context = local()  # of the request handled by this thread: status (of the last response made, read by
+# STEP_request) and table (HeaderTable to answer with binary headers, None for json)
+
+
+class MetricsHTTPHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics on the --metrics_port, in the Prometheus text format
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_http(port, ip):
+    """
+    Serve the Prometheus text endpoint from a daemon thread
+    """
+    httpd = ThreadingHTTPServer((ip, int(port)), MetricsHTTPHandler)
+    httpd.daemon_threads = True
+    th = Thread(target=httpd.serve_forever)
+    th.daemon = True
+    th.start()
+    logger.info(f'Metrics are served on http://{ip or "0.0.0.0"}:{port}/metrics')
+    return httpd
+
+
 def get_time_based_filename(ext, prefix='', t=None):
     """
     Get a filename based on time
@@ -60,14 +1074,37 @@ def get_time_based_filename(ext, prefix='', t=None):
     return time.strftime(f"{prefix}%Y%m%d%H%M%S." + ext, time.localtime(t))
 #Set the file name according to the current time
 
-def set_logger(logger_name):
+class BlockLogSampler(logging.Filter):
+    """
+    Keep one of every `every` per-block records (logged with extra=BLOCK_LOG), 0 drops them all.
+    Other records, and warnings and errors of the per-block paths, always pass.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if not getattr(record, 'block', False) or record.levelno >= logging.WARNING:
+            return True
+        if self.every <= 0:
+            return False
+        return next(self.counter) % self.every == 0
+
+
+def set_logger(logger_name, level=logging.INFO, block_log_every=1, queued=True):
     """
     Create a logger
     :param logger_name: 日志名称
+    :param level: lowest level that is logged
+    :param block_log_every: log one of every N per-block lines (1 logs all of them, 0 none)
+    :param queued: hand the records to one background writer thread instead of formatting and
+                   writing them under the handler locks of the calling thread
     :return: logger
     """
     logger_ = logging.getLogger(logger_name)   # Set root logger without name
-    logger_.setLevel(logging.INFO)
+    logger_.setLevel(level)
 
     formatter = logging.Formatter(
         '\033[0;34m%s\033[0m' % '%(asctime)s-%(name)s[%(levelname)s] %(message)s @ %(filename)s[%(lineno)d]',
@@ -80,16 +1117,27 @@ def set_logger(logger_name):
     fh = TimedRotatingFileHandler(filename=f'log/{logger_name}/log', when='D', interval=1, backupCount=1)
     fh.setFormatter(formatter)
 
-    fh.setLevel(logging.INFO)
+    fh.setLevel(level)
 
     # --> SCREEN DISPLAY
     ch = logging.StreamHandler()
-    ch.setLevel(logging.INFO)
+    ch.setLevel(level)
     ch.setFormatter(formatter)
 
     logger_.propagate = False
-    logger_.addHandler(ch)
-    logger_.addHandler(fh)
+    logger_.addFilter(BlockLogSampler(block_log_every))
+    if queued:
+        # --> BACKGROUND WRITER
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, ch, fh, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)  # flush what is still queued at exit
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.listener = listener
+        logger_.addHandler(queue_handler)
+    else:
+        logger_.addHandler(ch)
+        logger_.addHandler(fh)
     return logger_
 # Set up logs and output logs
 
@@ -99,18 +1147,251 @@ def _argparse():
                        help="The IP address bind to the server. Default bind all IP.")
     parse.add_argument("--port", default='1379', action='store', required=False, dest="port",
                        help="The port that server listen on. Default is 1379.")
+    parse.add_argument("--dedup", default=False, action='store_true', required=False, dest="dedup",
+                       help="Store every distinct content of a user once (hard links in cas/), a SAVE that "
+                            "carries the \"md5\" of stored content completes without any UPLOAD.")
+    parse.add_argument("--data_backend", default='file', choices=['file', 'log'], required=False, dest="data_backend",
+                       help="Storage of the DATA operations: one json file per key in data/, or an append-only "
+                            "segment log in kv/ with an in-memory index and cache. Default is file.")
+    parse.add_argument("--data_cache", default=10000, type=int, required=False, dest="data_cache",
+                       help="Decoded values kept in memory by the log backend. Default is 10000.")
+    parse.add_argument("--full_md5", default=False, action='store_true', required=False, dest="full_md5",
+                       help="Compatibility: always return the whole-file \"md5\" when an upload completes, "
+                            "re-reading the file if the blocks did not arrive in order.")
+    parse.add_argument("--min_block_size", default=MIN_BLOCK_SIZE, type=int, required=False, dest="min_block_size",
+                       help=f"Smallest block size a client can ask for in a plan. Default is {MIN_BLOCK_SIZE}.")
+    parse.add_argument("--max_block_size", default=MAX_BLOCK_SIZE, type=int, required=False, dest="max_block_size",
+                       help=f"Largest block size a client can ask for in a plan. Default is {MAX_BLOCK_SIZE}.")
+    parse.add_argument("--engine", default='thread', choices=['thread', 'async'], required=False, dest="engine",
+                       help="Connection engine: one thread per connection, or one asyncio loop. Default is thread.")
+    parse.add_argument("--workers", default=1, type=int, required=False, dest="workers",
+                       help="Processes serving the port (SO_REUSEPORT), each with its own engine. With more than "
+                            "one, --metrics_port is the port of worker 1, worker N serves metrics_port + N - 1. "
+                            "Default is 1.")
+    parse.add_argument("--reserve_mb", default=RESERVE_BYTES // 1024 // 1024, type=int, required=False,
+                       dest="reserve_mb", help="Free disk space in MB an upload plan has to leave, a larger plan is "
+                                               "rejected with status 507. Default is 64.")
+    parse.add_argument("--quota_mb", default=0, type=int, required=False, dest="quota_mb",
+                       help="MB of stored files and upload plans per user, a plan beyond it is rejected with "
+                            "status 413. Default is 0, no quota.")
+    parse.add_argument("--durability", default=DURABILITY, choices=['none', 'complete', 'every_mb'], required=False,
+                       dest="durability",
+                       help="When the uploaded blocks are synced to the disk: none, when the upload completes "
+                            "(before its last ACK), or every --fsync_mb of an upload (the ACK that reaches it waits "
+                            "for the sync). A block only counts as received for RESUME once it is synced as "
+                            "promised. Default is none.")
+    parse.add_argument("--fsync_mb", default=FSYNC_BYTES // 1024 // 1024, type=int, required=False, dest="fsync_mb",
+                       help="MB written to an upload between two syncs with --durability every_mb. Default is 16.")
+    parse.add_argument("--coalesce_kb", default=COALESCE_BYTES // 1024, type=int, required=False, dest="coalesce_kb",
+                       help="KB of the received blocks of an upload buffered and written out together (adjacent "
+                            "blocks in one write), 0 writes every block as it arrives. With --workers the blocks "
+                            "are always written as they arrive. Default is 1024.")
+    parse.add_argument("--coalesce_ms", default=int(COALESCE_SECONDS * 1000), type=int, required=False,
+                       dest="coalesce_ms", help="Longest time in ms a block stays in the buffer. Default is 100.")
+    parse.add_argument("--fd_cache", default=256, type=int, required=False, dest="fd_cache",
+                       help="Open file descriptors kept for the block reads and writes. Default is 256.")
+    parse.add_argument("--fd_idle", default=30, type=float, required=False, dest="fd_idle",
+                       help="Seconds after which an unused cached descriptor is closed. Default is 30.")
+    parse.add_argument("--backlog", default=1024, type=int, required=False, dest="backlog",
+                       help="Backlog of the listening socket (capped by the kernel's somaxconn). Default is 1024.")
+    parse.add_argument("--max_connections", default=1024, type=int, required=False, dest="max_connections",
+                       help="Thread engine: connections served at once, one pool thread each. Default is 1024.")
+    parse.add_argument("--max_pending", default=1024, type=int, required=False, dest="max_pending",
+                       help="Thread engine: accepted connections waiting for a pool thread. Async engine: requests "
+                            "waiting for a worker thread. Beyond it the server answers busy (status 503 with "
+                            "\"retry_after\"). Default is 1024.")
+    parse.add_argument("--max_wait", default=1000, type=int, required=False, dest="max_wait",
+                       help="Thread engine: ms an accepted connection may wait for a pool thread, it is then "
+                            "answered busy. Default is 1000.")
+    parse.add_argument("--idle_timeout", default=IDLE_TIMEOUT, type=float, required=False, dest="idle_timeout",
+                       help="Thread engine: seconds a connection may stay without a request before it is closed "
+                            f"and its thread serves another one, 0 is no limit. Default is {IDLE_TIMEOUT}.")
+    parse.add_argument("--retry_after", default=RETRY_AFTER_MS, type=int, required=False, dest="retry_after",
+                       help=f"Milliseconds a busy client is told to wait before retrying. Default is {RETRY_AFTER_MS}.")
+    parse.add_argument("--async_threads", default=16, type=int, required=False, dest="async_threads",
+                       help="Size of the request worker pool used by the async engine. Default is 16.")
+    parse.add_argument("--metrics_port", default=None, type=int, required=False, dest="metrics_port",
+                       help="Also serve Prometheus text metrics on http://<ip>:<metrics_port>/metrics. Default is off.")
+    parse.add_argument("--log_level", default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], required=False,
+                       dest="log_level", help="Lowest level that is logged. Default is INFO.")
+    parse.add_argument("--compress_level", default=COMPRESS_LEVEL, type=int, choices=range(10), required=False,
+                       dest="compress_level",
+                       help=f"Level of the compressed DOWNLOAD blocks (zlib level, lzma preset). Default is {COMPRESS_LEVEL}.")
+    parse.add_argument("--block_log_every", default=100, type=int, required=False, dest="block_log_every",
+                       help="Log one of every N per-block UPLOAD/DOWNLOAD lines, 1 logs all, 0 none. "
+                            "Errors are always logged. Default is 100.")
     return parse.parse_args()
 #Parameter parsing, parsing command line arguments, server ip and port
 
-def make_packet(json_data, bin_data=None):
+BINARY_HEADER_FLAG = 0x80000000  # top bit of j_len: the header is binary (negotiated at LOGIN), not json
+BIN_HEADER = struct.Struct('!BBBBHHHqqIB')  # operation, direction, type, compression, status, token id, key id,
+# block_index, size, block_size, number of string definitions; -1/0 mean "not in the fixed fields"
+BIN_STRING = struct.Struct('!HH')  # string definition: id, length of the utf-8 bytes that follow
+BIN_OPERATIONS = [None, OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN, OP_ERROR, OP_RESUME,
+                  OP_STAT]
+BIN_DIRECTIONS = [None, DIR_REQUEST, DIR_RESPONSE]
+BIN_TYPES = [None, TYPE_FILE, TYPE_DATA, TYPE_AUTH]
+BIN_COMPRESSIONS = [None, 'zlib', 'lzma']
+
+
+class HeaderTable:
+    """
+    Interned strings (token, key) of one connection for the binary header.
+    The client gives a string an id the first time it sends it, later headers only carry the id.
+    """
+
+    def __init__(self):
+        self.strings = {}  # id -> string
+        self.ids = {}  # string -> id
+
+    def define(self, string_id, string):
+        old = self.strings.get(string_id)
+        if old is not None:
+            self.ids.pop(old, None)
+        self.strings[string_id] = string
+        self.ids[string] = string_id
+
+
+def encode_binary_header(json_data, table, intern):
+    """
+    Binary form of a json header: the fixed fields, the new string definitions,
+    then the remaining fields (if any) as json. "status_msg" is left out of 200 responses.
+    :param table: HeaderTable of the connection
+    :param intern: define ids for new strings (the client); the server only uses the client's ids
+    :return: bytes
+    """
+    rest = dict(json_data)
+    codes = []
+    for field, values in ((FIELD_OPERATION, BIN_OPERATIONS), (FIELD_DIRECTION, BIN_DIRECTIONS),
+                          (FIELD_TYPE, BIN_TYPES), (FIELD_COMPRESSION, BIN_COMPRESSIONS)):
+        value = rest.get(field)
+        if value is not None and value in values:
+            del rest[field]
+            codes.append(values.index(value))
+        else:
+            codes.append(0)
+    status = rest.get(FIELD_STATUS)
+    if type(status) is int and 0 < status < 0x10000:
+        del rest[FIELD_STATUS]
+        if status == 200:
+            rest.pop(FIELD_STATUS_MSG, None)
+    else:
+        status = 0
+    definitions = []
+    string_ids = []
+    for field in (FIELD_TOKEN, FIELD_KEY):
+        value = rest.get(field)
+        string_id = table.ids.get(value) if type(value) is str else None
+        if string_id is None and intern and type(value) is str and len(table.strings) < 0xFFFF:
+            string_id = len(table.strings) + 1
+            table.define(string_id, value)
+            definitions.append((string_id, value.encode()))
+        if string_id is not None:
+            del rest[field]
+        string_ids.append(string_id or 0)
+    numbers = []
+    for field, low, high, missing in ((FIELD_BLOCK_INDEX, 0, 2 ** 63, -1), (FIELD_SIZE, 0, 2 ** 63, -1),
+                                      (FIELD_BLOCK_SIZE, 1, 2 ** 32, 0)):
+        value = rest.get(field)
+        if type(value) is int and low <= value < high:
+            del rest[field]
+            numbers.append(value)
+        else:
+            numbers.append(missing)
+    parts = [BIN_HEADER.pack(*codes, status, *string_ids, *numbers, len(definitions))]
+    for string_id, string in definitions:
+        parts += [BIN_STRING.pack(string_id, len(string)), string]
+    if rest:
+        parts.append(json.dumps(rest, ensure_ascii=False).encode())
+    return b''.join(parts)
+
+
+def decode_binary_header(buf, table):
+    """
+    json header (dict) of a binary header, the string definitions are added to table
+    :param buf: bytes-like
+    :param table: HeaderTable of the connection
+    :return: dict
+    """
+    operation, direction, data_type, compression, status, token_id, key_id, block_index, size, block_size, \
+        n_strings = BIN_HEADER.unpack_from(buf, 0)
+    pos = BIN_HEADER.size
+    for _ in range(n_strings):
+        string_id, length = BIN_STRING.unpack_from(buf, pos)
+        pos += BIN_STRING.size
+        table.define(string_id, bytes(buf[pos:pos + length]).decode())
+        pos += length
+    json_data = json.loads(bytes(buf[pos:])) if pos < len(buf) else {}
+    for field, code, values in ((FIELD_OPERATION, operation, BIN_OPERATIONS),
+                                (FIELD_DIRECTION, direction, BIN_DIRECTIONS), (FIELD_TYPE, data_type, BIN_TYPES),
+                                (FIELD_COMPRESSION, compression, BIN_COMPRESSIONS)):
+        if code:
+            json_data[field] = values[code]
+    if status:
+        json_data[FIELD_STATUS] = status
+    if token_id:
+        json_data[FIELD_TOKEN] = table.strings[token_id]
+    if key_id:
+        json_data[FIELD_KEY] = table.strings[key_id]
+    if block_index >= 0:
+        json_data[FIELD_BLOCK_INDEX] = block_index
+    if size >= 0:
+        json_data[FIELD_SIZE] = size
+    if block_size:
+        json_data[FIELD_BLOCK_SIZE] = block_size
+    return json_data
+# Binary header, an alternative to the json header for clients that ask for it at LOGIN
+
+def compress_block(data, method, level):
+    """
+    Compress one block
+    :param method: 'zlib' or 'lzma'
+    :param level: 0-9 (zlib level, lzma preset)
+    :return: the compressed bytes, or None if they are not smaller than data
+    """
+    if method == 'zlib':
+        packed = zlib.compress(data, level)
+    else:
+        packed = lzma.compress(data, preset=level)
+    return packed if len(packed) < len(data) else None
+
+
+def decompress_block(data, method, max_size):
+    """
+    Decompress one block, producing at most max_size bytes
+    :return: bytes, ValueError if the data is broken or longer than max_size
+    """
+    try:
+        if method == 'zlib':
+            decompressor = zlib.decompressobj()
+            block = decompressor.decompress(data, max_size)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError('the block is longer than expected or truncated')
+        else:
+            decompressor = lzma.LZMADecompressor()
+            block = decompressor.decompress(data, max_size)
+            if not decompressor.eof:
+                raise ValueError('the block is longer than expected or truncated')
+    except (zlib.error, lzma.LZMAError) as ex:
+        raise ValueError(str(ex))
+    return block
+# Per-block compression of UPLOAD and DOWNLOAD
+
+
+def make_packet(json_data, bin_data=None, table=None):
     """
     Make a packet following the STEP protocol.
     Any information or data for TCP transmission has to use this function to get the packet.
     :param json_data:
     :param bin_data:
+    :param table: HeaderTable of the connection to make a binary header, json if None
     :return:
         The complete binary packet
     """
+    if table is not None:
+        header = encode_binary_header(json_data, table, False)
+        bin_data = b'' if bin_data is None else bin_data
+        return struct.pack('!II', len(header) | BINARY_HEADER_FLAG, len(bin_data)) + header + bin_data
     j = json.dumps(dict(json_data), ensure_ascii=False)
     j_len = len(j)
     if bin_data is None:
@@ -135,53 +1416,274 @@ def make_response_packet(operation, status_code, data_type, status_msg, json_dat
     json_data[FIELD_STATUS] = status_code
     json_data[FIELD_STATUS_MSG] = status_msg
     json_data[FIELD_TYPE] = data_type
-    return make_packet(json_data, bin_data)
+    request_context.status = status_code
+    packet = make_packet(json_data, bin_data, getattr(request_context, 'table', None))
+    metrics.add_bytes_out(len(packet))
+    return packet
 # Generate a response packet (to see if it was successful or where the error was), json (key-value pair format)
 
+def make_busy_packet(json_data=None, table=None):
+    """
+    Make the "busy, retry after N ms" response (status 503) of a request the server has no room for,
+    or of a connection it is not going to serve (json_data None)
+    :param json_data: the rejected request
+    :param table: HeaderTable of a binary header connection
+    :return:
+    """
+    json_data = json_data or {}
+    rval = {
+        FIELD_OPERATION: json_data.get(FIELD_OPERATION, OP_ERROR),
+        FIELD_DIRECTION: DIR_RESPONSE,
+        FIELD_TYPE: json_data.get(FIELD_TYPE, 'ERROR'),
+        FIELD_STATUS: 503,
+        FIELD_STATUS_MSG: f'The server is busy, retry after {RETRY_AFTER_MS} ms.',
+        FIELD_RETRY_AFTER: RETRY_AFTER_MS
+    }
+    # So that a pipelining client can match it to the request
+    for field in (FIELD_KEY, FIELD_BLOCK_INDEX):
+        if field in json_data:
+            rval[field] = json_data[field]
+    packet = make_packet(rval, None, table)
+    metrics.add_busy()
+    metrics.add_bytes_out(len(packet))
+    return packet
+
+def make_response_header(operation, status_code, data_type, status_msg, json_data, bin_size):
+    """
+    Make only the header of a response packet, for binary data of bin_size bytes that is sent separately
+    :return:
+        8-byte length prefix + json
+    """
+    packet = make_response_packet(operation, status_code, data_type, status_msg, json_data)
+    return packet[:4] + struct.pack('!I', bin_size) + packet[8:]
+
+
+def send_file_block(connection_socket, header, fd, offset, count):
+    """
+    Send a packet header followed by count bytes of an open file starting at offset.
+    On a real socket the bytes go through os.sendfile and never enter Python;
+    other connections (e.g. the asyncio engine) get a slice of an mmap of the file.
+    :param connection_socket:
+    :param header: from make_response_header
+    :param fd: descriptor of the file, e.g. from fd_cache
+    :param offset:
+    :param count:
+    :return: None
+    """
+    metrics.add_bytes_out(count)
+    if hasattr(connection_socket, 'sendfile') and hasattr(os, 'sendfile'):
+        connection_socket.sendall(header, MSG_MORE)
+        sent = 0
+        while sent < count:
+            size = os.sendfile(connection_socket.fileno(), fd, offset + sent, count - sent)
+            if size == 0:
+                raise EOFError('The file is shorter than its plan.')
+            sent += size
+        return
+    connection_socket.sendall(header)
+    if count == 0:
+        return
+    aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with mmap.mmap(fd, count + offset - aligned, offset=aligned, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            connection_socket.sendall(view[offset - aligned:])
+        finally:
+            view.release()
+
+def recv_exactly(conn, n):
+    """
+    Receive exactly n bytes into one preallocated buffer
+    :param conn: the TCP connection
+    :param n:
+    :return: bytearray, or None if the connection is closed
+    """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        size = conn.recv_into(view[got:])
+        if size == 0:
+            return None
+        got += size
+    return buf
+
+
 def get_tcp_packet(conn):
     """
     Receive a complete TCP "packet" from a TCP stream and get the json data and binary data.
+    It never reads past the end of the packet; use FrameReader on a persistent connection.
     :param conn: the TCP connection
     :return:
         json_data
         bin_data
     """
-    bin_data = b''
-    while len(bin_data) < 8:
-        data_rec = conn.recv(8)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
-    data = bin_data[:8]
-    bin_data = bin_data[8:]
-    j_len, b_len = struct.unpack('!II', data)
-    while len(bin_data) < j_len:
-        data_rec = conn.recv(j_len)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
-    j_bin = bin_data[:j_len]
+    head = recv_exactly(conn, 8)
+    if head is None:
+        return None, None
+    j_len, b_len = struct.unpack('!II', head)
+    j_bin = recv_exactly(conn, j_len)
+    if j_bin is None:
+        return None, None
 
     try:
         json_data = json.loads(j_bin.decode())
     except Exception as ex:
         return None, None
 
-    bin_data = bin_data[j_len:]
-    while len(bin_data) < b_len:
-        data_rec = conn.recv(b_len)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
+    bin_data = recv_exactly(conn, b_len)
+    if bin_data is None:
+        return None, None
     return json_data, bin_data
 # Receive packets
 
+
+class FrameReader:
+    """
+    Buffered STEP frame reader for a persistent connection.
+    recv_into() fills one preallocated bytearray, bytes of the next frame stay in the buffer,
+    and the binary part is handed out as a memoryview into that buffer (no copy).
+    The memoryview is only valid until the next read_frame() call.
+    """
+
+    def __init__(self, conn, buffer_size=MAX_PACKET_SIZE * 4, table=None):
+        self.conn = conn
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first unread byte
+        self.end = 0  # end of the received bytes
+        self.frame_size = 0  # size of the last frame
+        self.binary = False  # the last frame had a binary header
+        self.table = table if table is not None else HeaderTable()
+
+    def _fill(self, n):
+        """
+        Make sure n unread bytes are in the buffer
+        :return: False if the connection is closed first
+        """
+        if self.end - self.start >= n:
+            return True
+        if self.start + n > len(self.buf):
+            pending = self.end - self.start
+            if n > len(self.buf):
+                # Frame bigger than the buffer: move to a new buffer, old views stay valid
+                buf = bytearray(max(n, len(self.buf) * 2))
+                buf[:pending] = self.view[self.start:self.end]
+                self.buf = buf
+                self.view = memoryview(buf)
+            else:
+                self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        while self.end - self.start < n:
+            size = self.conn.recv_into(self.view[self.end:])
+            if size == 0:
+                return False
+            self.end += size
+        return True
+
+    def buffered(self):
+        """
+        :return: True if bytes of the next frame are received already
+        """
+        return self.end > self.start
+
+    def read_frame(self):
+        """
+        Read the next frame
+        :return:
+            json_data
+            bin_data (memoryview)
+        """
+        if self._fill(8) is False:
+            return None, None
+        j_len, b_len = struct.unpack_from('!II', self.buf, self.start)
+        self.binary = j_len & BINARY_HEADER_FLAG != 0
+        j_len &= ~BINARY_HEADER_FLAG
+        if self._fill(8 + j_len + b_len) is False:
+            return None, None
+        j_start = self.start + 8
+        b_start = j_start + j_len
+        self.start = b_start + b_len
+        self.frame_size = 8 + j_len + b_len
+        try:
+            if self.binary:
+                json_data = decode_binary_header(self.view[j_start:b_start], self.table)
+            else:
+                json_data = json.loads(bytes(self.view[j_start:b_start]))
+        except Exception as ex:
+            return None, None
+        return json_data, self.view[b_start:self.start]
+# Receive packets from a persistent connection
+
+def data_batch_process(username, request_operation, json_data, connection_socket):
+    """
+    Batched DATA GET/DELETE ("keys": list of keys) and SAVE ("items": list of dicts, stored like the
+    request of a single SAVE, "key" is optional). The batch runs against the store in one pass and the
+    response has one entry per key or item in "results", with the status of the single operation.
+    :param username:
+    :param request_operation:
+    :param json_data:
+    :param connection_socket:
+    :return: None
+    """
+    global logger
+    field = FIELD_ITEMS if request_operation == OP_SAVE else FIELD_KEYS
+    entries = json_data.get(field)
+    if not isinstance(entries, list) or len(entries) > MAX_BATCH_ITEMS:
+        logger.error(f'<-- Field "{field}" of a batched DATA {request_operation} is not a list of at most '
+                     f'{MAX_BATCH_ITEMS} entries.')
+        connection_socket.send(
+            make_response_packet(request_operation, 410, TYPE_DATA,
+                                 f'Field "{field}" has to be a list of at most {MAX_BATCH_ITEMS} entries.', {}))
+        return
+    logger.info(f'--> Batched {request_operation} of {len(entries)} data')
+    results = [None] * len(entries)
+    # Entries that can not be run get their status here, the others go to the store together
+    if request_operation == OP_SAVE:
+        valid = []
+        for i, item in enumerate(entries):
+            if not isinstance(item, dict) or not isinstance(item.get(FIELD_KEY, ''), str):
+                results[i] = {FIELD_STATUS: 410, FIELD_STATUS_MSG: 'An item has to be a dict with a string "key".'}
+            else:
+                valid.append((i, item.get(FIELD_KEY) or str(uuid.uuid4()), item))
+    else:
+        valid = []
+        for i, key in enumerate(entries):
+            if not isinstance(key, str):
+                results[i] = {FIELD_STATUS: 410, FIELD_STATUS_MSG: 'A key has to be a string.'}
+            else:
+                valid.append((i, key, None))
+    try:
+        keys = [key for _, key, _ in valid]
+        if request_operation == OP_GET:
+            for (i, key, _), value in zip(valid, data_store.get_many(username, keys)):
+                if value is None:
+                    results[i] = {FIELD_KEY: key, FIELD_STATUS: 404, FIELD_STATUS_MSG: f'The key {key} is not existing.'}
+                else:
+                    results[i] = {FIELD_KEY: key, FIELD_STATUS: 200, 'value': value}
+        elif request_operation == OP_SAVE:
+            saved = data_store.save_many(username, [(key, item) for _, key, item in valid])
+            for (i, key, _), ok in zip(valid, saved):
+                results[i] = {FIELD_KEY: key, FIELD_STATUS: 200} if ok else \
+                    {FIELD_KEY: key, FIELD_STATUS: 402, FIELD_STATUS_MSG: f'This key "{key}" is existing.'}
+        elif request_operation == OP_DELETE:
+            for (i, key, _), ok in zip(valid, data_store.delete_many(username, keys)):
+                results[i] = {FIELD_KEY: key, FIELD_STATUS: 200} if ok else \
+                    {FIELD_KEY: key, FIELD_STATUS: 404, FIELD_STATUS_MSG: f'The "key" {key} is not existing.'}
+    except Exception as ex:
+        logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+        # Which entries the store ran is not known, the whole batch failed
+        connection_socket.send(
+            make_response_packet(request_operation, 500, TYPE_DATA,
+                                 f'The batched {request_operation} failed: {str(ex)}', {}))
+        return
+    succeeded = sum(1 for result in results if result[FIELD_STATUS] == 200)
+    logger.info(f'<-- Batched {request_operation}: {succeeded} of {len(results)} succeeded.')
+    connection_socket.send(
+        make_response_packet(request_operation, 200, TYPE_DATA,
+                             f'{succeeded} of {len(results)} succeeded.', {FIELD_RESULTS: results}))
+
+
 def data_process(username, request_operation, json_data, connection_socket):
     """
     Data Process
@@ -192,6 +1694,14 @@ def data_process(username, request_operation, json_data, connection_socket):
     :return: None
     """
     global logger
+    if FIELD_KEYS in json_data.keys() or FIELD_ITEMS in json_data.keys():
+        if request_operation not in (OP_GET, OP_SAVE, OP_DELETE):
+            logger.error(f'<-- Operation {request_operation} can not be batched.')
+            connection_socket.send(
+                make_response_packet(OP_ERROR, 408, 'ERROR', f'Operation {request_operation} is not allowed', {}))
+            return
+        data_batch_process(username, request_operation, json_data, connection_socket)
+        return
     if request_operation == OP_GET:
         if FIELD_KEY not in json_data.keys():
             logger.info(f'<-- Get data without key.')
@@ -200,17 +1710,16 @@ def data_process(username, request_operation, json_data, connection_socket):
                 make_response_packet(OP_GET, 410, TYPE_DATA, f'Field "key" is missing for DATA GET.', {}))
             return
         logger.info(f'--> Get data {json_data[FIELD_KEY]}')
-        if os.path.exists(join('data', username, json_data[FIELD_KEY])) is False:
-            logger.error(f'<-- The key {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_DATA, f'The key {json_data[FIELD_KEY]} is not existing.', {}))
-            return
         try:
-            with open(join('data', username, json_data[FIELD_KEY]), 'r') as fid:
-                data_from_file = json.load(fid)
-                logger.info(f'<-- Find the data and return to client.')
+            data_from_file = data_store.get(username, json_data[FIELD_KEY])
+            if data_from_file is None:
+                logger.error(f'<-- The key {json_data[FIELD_KEY]} is not existing.')
                 connection_socket.send(
-                    make_response_packet(OP_GET, 200, TYPE_DATA, f'OK', data_from_file))
+                    make_response_packet(OP_GET, 404, TYPE_DATA, f'The key {json_data[FIELD_KEY]} is not existing.', {}))
+                return
+            logger.info(f'<-- Find the data and return to client.')
+            connection_socket.send(
+                make_response_packet(OP_GET, 200, TYPE_DATA, f'OK', data_from_file))
         except Exception as ex:
             logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
@@ -221,16 +1730,14 @@ def data_process(username, request_operation, json_data, connection_socket):
         if FIELD_KEY in json_data.keys():
             key = json_data[FIELD_KEY]
         logger.info(f'--> Save data with key "{key}"')
-        if os.path.exists(join('data', username, key)) is True:
-            logger.error(f'<-- This key "{key}" is existing.')
-            connection_socket.send(make_response_packet(OP_SAVE, 402, TYPE_DATA, f'This key "{key}" is existing.', {}))
-            return
         try:
-            with open(join('data', username, key), 'w') as fid:
-                json.dump(json_data, fid)
-                logger.error(f'<-- Data is saved with key "{key}"')
-                connection_socket.send(
-                    make_response_packet(OP_SAVE, 200, TYPE_DATA, f'Data is saved with key "{key}"', {FIELD_KEY: key}))
+            if data_store.save(username, key, json_data) is False:
+                logger.error(f'<-- This key "{key}" is existing.')
+                connection_socket.send(make_response_packet(OP_SAVE, 402, TYPE_DATA, f'This key "{key}" is existing.', {}))
+                return
+            logger.error(f'<-- Data is saved with key "{key}"')
+            connection_socket.send(
+                make_response_packet(OP_SAVE, 200, TYPE_DATA, f'Data is saved with key "{key}"', {FIELD_KEY: key}))
         except Exception as ex:
             logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
@@ -243,14 +1750,13 @@ def data_process(username, request_operation, json_data, connection_socket):
             connection_socket.send(
                 make_response_packet(OP_DELETE, 410, TYPE_DATA, f'Field "key" is missing for DATA delete.', {}))
             return
-        if os.path.exists(join('data', username, json_data[FIELD_KEY])) is False:
-            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_DELETE, 404, TYPE_DATA, f'The "key" {json_data[FIELD_KEY]} is not existing.',
-                                     {}))
-            return
         try:
-            os.remove(join('data', username, json_data[FIELD_KEY]))
+            if data_store.delete(username, json_data[FIELD_KEY]) is False:
+                logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
+                connection_socket.send(
+                    make_response_packet(OP_DELETE, 404, TYPE_DATA, f'The "key" {json_data[FIELD_KEY]} is not existing.',
+                                         {}))
+                return
             logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is deleted.')
             connection_socket.send(
                 make_response_packet(OP_DELETE, 200, TYPE_DATA, f'The "key" {json_data[FIELD_KEY]} is deleted.',
@@ -279,15 +1785,18 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
                 make_response_packet(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for DATA GET.', {}))
             return
         logger.info(f'--> Plan to download file with "key" {json_data[FIELD_KEY]}')
-        if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False and os.path.exists(
-                join('tmp', username, json_data[FIELD_KEY])) is False:
+        file_path = join('file', username, json_data[FIELD_KEY])
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            st = None
+        if st is None and os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is False:
             logger.error(f'<-- The key {json_data[FIELD_KEY]} is not existing.')
             connection_socket.send(
                 make_response_packet(OP_GET, 404, TYPE_FILE, f'The key {json_data[FIELD_KEY]} is not existing.', {}))
             return
 
-        if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False and os.path.exists(
-                join('tmp', username, json_data[FIELD_KEY])) is True:
+        if st is None:
             logger.error(f'<-- The key {json_data[FIELD_KEY]} is not completely uploaded.')
             connection_socket.send(
                 make_response_packet(OP_GET, 404, TYPE_FILE,
@@ -296,12 +1805,21 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
 
         #get again (check key, check file)
 
-        file_path = join('file', username, json_data[FIELD_KEY])
-        file_size = getsize(file_path)
-        block_size = MAX_PACKET_SIZE
+        block_size = planned_block_size(json_data)
+        if block_size is None:
+            logger.error(f'<-- The "block_size" should be a positive integer.')
+            connection_socket.send(
+                make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_size" should be a positive integer.', {}))
+            return
+        file_size = st.st_size
         total_block = math.ceil(file_size / block_size)
-        #The following line has also been changed
-        md5 = getfile_md5(file_path)
+        # The MD5 comes from the metadata index, the file is only hashed on a miss
+        entry = file_index.lookup(file_path, st)
+        if entry is not None:
+            md5 = entry['md5']
+        else:
+            md5 = getfile_md5(file_path)
+            file_index.store(file_path, st, md5)
         # Download Plan
         rval = {
             FIELD_KEY: json_data[FIELD_KEY],
@@ -330,8 +1848,18 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
             connection_socket.send(
                 make_response_packet(OP_SAVE, 402, TYPE_FILE, f'This file "size" has to be included', {}))
             return
+        block_size = planned_block_size(json_data)
+        if block_size is None:
+            logger.error(f'<-- The "block_size" should be a positive integer.')
+            connection_socket.send(
+                make_response_packet(OP_SAVE, 410, TYPE_FILE, f'The "block_size" should be a positive integer.', {}))
+            return
         file_size = json_data[FIELD_SIZE]
-        block_size = MAX_PACKET_SIZE
+        if type(file_size) is not int or file_size < 0:
+            logger.error(f'<-- The "size" should be a non-negative integer.')
+            connection_socket.send(
+                make_response_packet(OP_SAVE, 410, TYPE_FILE, f'The "size" should be a non-negative integer.', {}))
+            return
         total_block = math.ceil(file_size / block_size)
         try:
             rval = {
@@ -340,13 +1868,80 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
                 FIELD_TOTAL_BLOCK: total_block,
                 FIELD_BLOCK_SIZE: block_size,
             }
-            # Write a tmp file
-            with open(join('tmp', username, key), 'wb+') as fid:
-                fid.seek(file_size - 1)
-                fid.write(b'\0')
+            rejection = check_plan_space(username, key, file_size, disk=False)
+            if rejection is not None:
+                logger.error(f'<-- Plan of key {key} rejected: {rejection[1]}')
+                connection_socket.send(make_response_packet(OP_SAVE, rejection[0], TYPE_FILE, rejection[1], {}))
+                return
+            md5 = json_data[FIELD_MD5].lower() if isinstance(json_data.get(FIELD_MD5), str) else None
+            if content_store is not None and is_md5(md5) \
+                    and content_store.link(username, md5, file_size, join('file', username, key)):
+                # Same content as a stored file: completed without any UPLOAD
+                drop_upload_session(username, key)
+                fd_cache.discard(join('tmp', username, key), join('tmp', username, key + '.md5s'))
+                for tmp_path in (join('tmp', username, key), join('tmp', username, key + '.md5s')):
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                storage_usage.update(username, join('file', username, key), join('tmp', username, key))
+                file_index.store(join('file', username, key), os.stat(join('file', username, key)), md5)
+                rval[FIELD_MD5] = md5
+                rval[FIELD_COMPLETED] = True
+                logger.info(f'<-- The content of key {key} is stored already, no block to upload.')
+                connection_socket.send(
+                    make_response_packet(OP_SAVE, 200, TYPE_FILE, f'The file is stored already, no block to upload.',
+                                         rval))
+                return
+            if total_block == 0:
+                # An empty file has no block to upload, it is completed by the plan
+                drop_upload_session(username, key)
+                fd_cache.discard(join('tmp', username, key), join('tmp', username, key + '.md5s'))
+                for tmp_path in (join('tmp', username, key), join('tmp', username, key + '.md5s')):
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                md5 = hashlib.md5(b'').hexdigest()
+                open(join('file', username, key), 'wb').close()
+                if content_store is not None:
+                    content_store.adopt(username, join('file', username, key), md5)
+                storage_usage.update(username, join('file', username, key), join('tmp', username, key))
+                if DURABILITY != 'none':
+                    sync_dir(os.path.dirname(join('file', username, key)))
+                file_index.store(join('file', username, key), os.stat(join('file', username, key)), md5)
+                rval[FIELD_MD5] = md5
+                rval[FIELD_TREE_MD5] = tree_md5(b'')
+                rval[FIELD_COMPLETED] = True
+                logger.info(f'<-- The empty file of key {key} is stored, no block to upload.')
+                connection_socket.send(
+                    make_response_packet(OP_SAVE, 200, TYPE_FILE, f'The file is empty and stored, no block to upload.',
+                                         rval))
+                return
+            rejection = check_plan_space(username, key, file_size, quota=False)
+            if rejection is not None:
+                logger.error(f'<-- Plan of key {key} rejected: {rejection[1]}')
+                connection_socket.send(make_response_packet(OP_SAVE, rejection[0], TYPE_FILE, rejection[1], {}))
+                return
+            # Write a tmp file, its space allocated up front
+            fd_cache.discard(join('tmp', username, key), join('tmp', username, key + '.md5s'))
+            try:
+                preallocate(join('tmp', username, key), file_size)
+            except OSError as ex:
+                storage_usage.update(username, join('tmp', username, key))
+                if ex.errno not in (errno.ENOSPC, errno.EDQUOT):
+                    raise
+                drop_upload_session(username, key)
+                logger.error(f'<-- Plan of key {key} rejected: no space for {file_size} bytes.')
+                connection_socket.send(make_response_packet(
+                    OP_SAVE, 507, TYPE_FILE, f'Insufficient storage: no space for {file_size} bytes.', {}))
+                return
+
+            storage_usage.update(username, join('tmp', username, key))
 
-            fid = open(join('tmp', username, key + '.log'), 'w')
+            # Per-block MD5 digests, 16 bytes for each block at block_index * 16
+            fid = open(join('tmp', username, key + '.md5s'), 'wb')
             fid.close()
+            drop_upload_session(username, key)
+            session = UploadSession.create(join('tmp', username, key + '.state'), file_size, block_size, total_block)
+            with upload_sessions_lock:
+                upload_sessions[(username, key)] = session
 
             logger.error(f'<-- Upload plan: key {key}, total block number {total_block}, block size {block_size}.')
             connection_socket.send(
@@ -366,10 +1961,14 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
         if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False:
             if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is True:
                 try:
+                    drop_upload_session(username, json_data[FIELD_KEY])
+                    fd_cache.discard(join('tmp', username, json_data[FIELD_KEY]),
+                                     join('tmp', username, json_data[FIELD_KEY]) + '.md5s')
                     os.remove(join('tmp', username, json_data[FIELD_KEY]))
-                    os.remove(join('tmp', username, json_data[FIELD_KEY]) + '.log')
+                    os.remove(join('tmp', username, json_data[FIELD_KEY]) + '.md5s')
                 except Exception as ex:
                     logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+                storage_usage.update(username, join('tmp', username, json_data[FIELD_KEY]))
                 logger.error(
                     f'<-- The "key" {json_data[FIELD_KEY]} is not completely uploaded. The tmp files are deleted.')
                 connection_socket.send(
@@ -383,7 +1982,13 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
                 make_response_packet(OP_GET, 404, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is not existing.', {}))
             return
         try:
-            os.remove(join('file', username, json_data[FIELD_KEY]))
+            fd_cache.discard(join('file', username, json_data[FIELD_KEY]))
+            if content_store is not None:
+                content_store.remove(username, join('file', username, json_data[FIELD_KEY]))
+            else:
+                os.remove(join('file', username, json_data[FIELD_KEY]))
+            storage_usage.update(username, join('file', username, json_data[FIELD_KEY]))
+            file_index.remove(join('file', username, json_data[FIELD_KEY]))
             logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is deleted.')
             connection_socket.send(
                 make_response_packet(OP_GET, 200, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is deleted.',
@@ -393,6 +1998,46 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
 
 # Still checking the key and the file, then doing the deletion of the error file and its logs
 
+    if request_operation == OP_RESUME:
+        if FIELD_KEY not in json_data.keys():
+            logger.info(f'--> Resume an upload without any key.')
+            logger.error(f'<-- Field "key" is missing for FILE resume.')
+            connection_socket.send(
+                make_response_packet(OP_RESUME, 410, TYPE_FILE, f'Field "key" is missing for FILE resume.', {}))
+            return
+        logger.info(f'--> Resume the upload of "key" {json_data[FIELD_KEY]}.')
+
+        if os.path.exists(join('file', username, json_data[FIELD_KEY])) is True:
+            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is completely uploaded.')
+            connection_socket.send(
+                make_response_packet(OP_RESUME, 408, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is completely uploaded.', {}))
+            return
+
+        session = get_upload_session(username, json_data[FIELD_KEY])
+        if session is None:
+            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} has no upload in progress.')
+            connection_socket.send(
+                make_response_packet(OP_RESUME, 404, TYPE_FILE,
+                                     f'The "key" {json_data[FIELD_KEY]} has no upload in progress.', {}))
+            return
+
+        # The upload plan again, with the bitmap of the received blocks as binary data
+        session.writer.flush()
+        bitmap = session.bitmap()
+        rval = {
+            FIELD_KEY: json_data[FIELD_KEY],
+            FIELD_SIZE: session.file_size,
+            FIELD_TOTAL_BLOCK: session.total_block,
+            FIELD_BLOCK_SIZE: session.block_size,
+            FIELD_RECEIVED_BLOCK: session.received
+        }
+        logger.info(f'<-- {rval[FIELD_RECEIVED_BLOCK]}/{session.total_block} blocks of "key" {json_data[FIELD_KEY]} received.')
+        connection_socket.send(
+            make_response_packet(OP_RESUME, 200, TYPE_FILE, f'This is the upload plan and the received blocks.',
+                                 rval, bitmap))
+        return
+# Plan and received blocks of an unfinished upload, so a client only sends the missing blocks
+
     if request_operation == OP_UPLOAD:
         if FIELD_KEY not in json_data.keys():
             logger.info(f'--> Upload file/block without any key.')
@@ -400,7 +2045,7 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
             connection_socket.send(
                 make_response_packet(OP_UPLOAD, 410, TYPE_FILE, f'Field "key" is missing for FILE uploading.', {}))
             return
-        logger.info(f'--> Upload file/block of "key" {json_data[FIELD_KEY]}.')
+        logger.info(f'--> Upload file/block of "key" {json_data[FIELD_KEY]}.', extra=BLOCK_LOG)
 
         if os.path.exists(join('file', username, json_data[FIELD_KEY])) is True:
             logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is completely uploaded.')
@@ -408,7 +2053,8 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
                 make_response_packet(OP_UPLOAD, 408, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is completely uploaded.', {}))
             return
 
-        if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is False:
+        session = get_upload_session(username, json_data[FIELD_KEY])
+        if session is None:
             logger.error(
                 f'<-- The "key" {json_data[FIELD_KEY]} is not accepted for uploading.')
             connection_socket.send(
@@ -424,9 +2070,9 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
                 make_response_packet(OP_UPLOAD, 410, TYPE_FILE, f'The "block_index" is compulsory.', {}))
             return
         file_path = join('tmp', username, json_data[FIELD_KEY])
-        file_size = getsize(file_path)
-        block_size = MAX_PACKET_SIZE
-        total_block = math.ceil(file_size / block_size)
+        file_size = session.file_size
+        block_size = session.block_size
+        total_block = session.total_block
         block_index = json_data[FIELD_BLOCK_INDEX]
         if block_index >= total_block:
             logger.error(f'<-- The "block_index" exceed the max index.')
@@ -438,6 +2084,21 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
             connection_socket.send(
                 make_response_packet(OP_UPLOAD, 410, TYPE_FILE, f'The "block_index" should >= 0.', {}))
             return
+        if FIELD_COMPRESSION in json_data.keys():
+            if json_data[FIELD_COMPRESSION] not in COMPRESSIONS:
+                logger.error(f'<-- The "compression" {json_data[FIELD_COMPRESSION]} is not supported.')
+                connection_socket.send(
+                    make_response_packet(OP_UPLOAD, 410, TYPE_FILE,
+                                         f'The "compression" {json_data[FIELD_COMPRESSION]} is not supported.', {}))
+                return
+            try:
+                # The stored file, its digests and md5 are of the original bytes
+                bin_data = decompress_block(bin_data, json_data[FIELD_COMPRESSION], block_size)
+            except ValueError as ex:
+                logger.error(f'<-- The compressed block is broken. {str(ex)}')
+                connection_socket.send(
+                    make_response_packet(OP_UPLOAD, 406, TYPE_FILE, f'The compressed block is broken.', {}))
+                return
         if block_index == total_block - 1 and len(bin_data) != file_size - block_size * block_index:
             logger.error(f'<-- The "block_size" is wrong.')
             connection_socket.send(
@@ -451,24 +2112,35 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
             return
 
 # Check, check block index
-        with open(file_path, 'rb+') as fid:
-            fid.seek(block_size * block_index)
-            fid.write(bin_data)
-        with open(file_path + '.log', 'a') as fid:
-            fid.write(f'{block_index}\n')
-        fid = open(file_path + '.log', 'r')
-        lines = fid.readlines()
-        fid.close()
+        session.update_stream(block_index, bin_data)
         rval = {
             FIELD_KEY: json_data[FIELD_KEY],
             FIELD_BLOCK_INDEX: block_index
         }
-        if len(set(lines)) == total_block:
-            # It's also changed underneath
-            md5 = getfile_md5(file_path)
-            rval[FIELD_MD5] = md5
-            os.remove(file_path + '.log')
+        if session.writer.add(block_index, bin_data):
+            # Combine the per-block digests instead of re-reading the file
+            with fd_cache.open(file_path + '.md5s', os.O_RDWR | os.O_CREAT) as fd:
+                rval[FIELD_TREE_MD5] = tree_md5(os.pread(fd, 16 * total_block, 0))
+            md5 = session.stream_hexdigest()
+            if md5 is None and (FULL_MD5 or content_store is not None):
+                md5 = getfile_md5(file_path)
+            if md5 is not None:
+                rval[FIELD_MD5] = md5
+            if DURABILITY == 'complete':
+                with fd_cache.open(file_path) as fd:
+                    sync_files(fd)
+            drop_upload_session(username, json_data[FIELD_KEY])
+            fd_cache.discard(file_path, file_path + '.md5s', join('file', username, json_data[FIELD_KEY]))
+            os.remove(file_path + '.md5s')
             shutil.move(file_path, join('file', username, json_data[FIELD_KEY]))
+            if content_store is not None:
+                content_store.adopt(username, join('file', username, json_data[FIELD_KEY]), md5)
+            storage_usage.update(username, file_path, join('file', username, json_data[FIELD_KEY]))
+            if DURABILITY != 'none':
+                sync_dir(os.path.dirname(join('file', username, json_data[FIELD_KEY])))
+            if md5 is not None:
+                file_index.store(join('file', username, json_data[FIELD_KEY]),
+                                 os.stat(join('file', username, json_data[FIELD_KEY])), md5)
         connection_socket.send(
             make_response_packet(OP_UPLOAD, 200, TYPE_FILE, f'The block {block_index} is uploaded.', rval))
         return
@@ -482,7 +2154,7 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
             connection_socket.send(
                 make_response_packet(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for FILE downloading.', {}))
             return
-        logger.info(f'--> Download file/block of "key" {json_data[FIELD_KEY]}.')
+        logger.info(f'--> Download file/block of "key" {json_data[FIELD_KEY]}.', extra=BLOCK_LOG)
 
         if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False:
             if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is True:
@@ -504,9 +2176,16 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
             connection_socket.send(
                 make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_index" is compulsory.', {}))
             return
+        # The client repeats the "block_size" of its GET plan, if it asked for one
+        block_size = planned_block_size(json_data)
+        if block_size is None:
+            logger.error(f'<-- The "block_size" should be a positive integer.')
+            connection_socket.send(
+                make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_size" should be a positive integer.', {}))
+            return
         file_path = join('file', username, json_data[FIELD_KEY])
-        file_size = getsize(file_path)
-        block_size = MAX_PACKET_SIZE
+        st = os.stat(file_path)
+        file_size = st.st_size
         total_block = math.ceil(file_size / block_size)
         block_index = json_data[FIELD_BLOCK_INDEX]
         if block_index >= total_block:
@@ -520,194 +2199,669 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
                 make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_index" should >= 0.', {}))
             return
 
-        with open(file_path, 'rb') as fid:
-            fid.seek(block_size * block_index)
-            if block_size * (block_index + 1) < file_size:
-                bin_data = fid.read(block_size)
-            else:
-                bin_data = fid.read(file_size - block_size * block_index)
+        offset = block_size * block_index
+        block_length = min(block_size, file_size - offset)
+        rval = {
+            FIELD_BLOCK_INDEX: block_index,
+            FIELD_KEY: json_data[FIELD_KEY],
+            FIELD_SIZE: block_length
+        }
+        logger.info(f'<-- Return block {block_index}({block_length}bytes) of "key" {json_data[FIELD_KEY]} >= 0.',
+                    extra=BLOCK_LOG)
+
+        if json_data.get(FIELD_COMPRESSION) in COMPRESSIONS:
+            with fd_cache.open(file_path, os.O_RDONLY, st.st_ino) as fd:
+                packed = compress_block(os.pread(fd, block_length, offset), json_data[FIELD_COMPRESSION],
+                                        COMPRESS_LEVEL)
+            if packed is not None:
+                # "size" stays the length of the original block
+                rval[FIELD_COMPRESSION] = json_data[FIELD_COMPRESSION]
+                connection_socket.send(
+                    make_response_packet(OP_DOWNLOAD, 200, TYPE_FILE, 'An available block.', rval, packed))
+                return
+            # Blocks that do not shrink are sent as they are
 
-            rval = {
-                FIELD_BLOCK_INDEX: block_index,
-                FIELD_KEY: json_data[FIELD_KEY],
-                FIELD_SIZE: len(bin_data)
-            }
-            logger.info(f'<-- Return block {block_index}({len(bin_data)}bytes) of "key" {json_data[FIELD_KEY]} >= 0.')
+        header = make_response_header(OP_DOWNLOAD, 200, TYPE_FILE, 'An available block.', rval, block_length)
+        # The inode check catches a file replaced since its descriptor was cached (e.g. by another worker)
+        with fd_cache.open(file_path, os.O_RDONLY, st.st_ino) as fd:
+            send_file_block(connection_socket, header, fd, offset, block_length)
+        # Send the header, then the file block straight from the page cache
 
-            connection_socket.send(make_response_packet(OP_DOWNLOAD, 200, TYPE_FILE,
-                                                        'An available block.', rval, bin_data))
-            # Read the file block and send
+class ConnectionState:
+    """
+    Per-connection state: the last validated token and its username, and the binary header strings
+    """
 
-def STEP_service(connection_socket, addr):
+    def __init__(self):
+        self.token = None
+        self.username = None
+        self.table = HeaderTable()  # strings interned by the client for binary headers
+        self.binary = False  # the current request has a binary header, answer with one
+
+
+user_dirs_ready = set()  # usernames whose data/, file/ and tmp/ folders exist
+user_dirs_lock = Lock()
+
+
+def check_token(token):
     """
-    STEP Protocol service
+    Validate a token
+    :param token: the base64 token from LOGIN
+    :return:
+        username, or None if the token is not valid
+        error message
+    """
+    try:
+        token = base64.b64decode(token).decode()
+    except Exception:
+        return None, f'Token format is wrong.'
+    parts = token.split('.')
+    if len(parts) != 4:
+        return None, f'Token format is wrong.'
+
+    user_str = ".".join(parts[:3])
+    if hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest().lower() != parts[3].lower():
+        return None, f'Token is wrong.'
+    return parts[0], ''
+
+
+def ensure_user_dirs(username):
+    """
+    Create the folders of a user, once per process
+    """
+    if username in user_dirs_ready:
+        return
+    os.makedirs(join('data', username), exist_ok=True)
+    os.makedirs(join('file', username), exist_ok=True)
+    os.makedirs(join('tmp', username), exist_ok=True)
+    with user_dirs_lock:
+        user_dirs_ready.add(username)
+
+
+def STEP_request(connection_socket, json_data, bin_data, state=None):
+    """
+    Handle one STEP request and send the response(s) through connection_socket.
+    Shared by the threaded listener and the asyncio engine.
+    The request is counted in the metrics under its (type, operation, status).
+    :param connection_socket: anything with a socket-like send()
+    :param json_data:
+    :param bin_data:
+    :param state: ConnectionState of the connection, a fresh one if None
+    :return: None
+    """
+    request_context.status = None
+    request_context.table = state.table if state is not None and state.binary else None
+    start = time.perf_counter()
+    try:
+        STEP_dispatch(connection_socket, json_data, bin_data, state)
+    finally:
+        if isinstance(json_data, dict):
+            request_type, request_operation = json_data.get(FIELD_TYPE), json_data.get(FIELD_OPERATION)
+        else:
+            request_type, request_operation = None, None
+        # Unknown values are folded together, the clients choose them
+        if request_type not in [TYPE_FILE, TYPE_DATA, TYPE_AUTH]:
+            request_type = 'OTHER'
+        if request_operation not in [OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN,
+                                     OP_RESUME, OP_STAT]:
+            request_operation = 'OTHER'
+        metrics.observe_request(request_type, request_operation, request_context.status,
+                                time.perf_counter() - start)
+
+
+def STEP_dispatch(connection_socket, json_data, bin_data, state=None):
+    """
+    Check a STEP request and hand it to data_process or file_process
     :param connection_socket:
-    :param addr:
+    :param json_data:
+    :param bin_data:
+    :param state: ConnectionState of the connection, a fresh one if None
     :return: None
     """
     global logger
-    while True:
-        json_data, bin_data = get_tcp_packet(connection_socket)
-        json_data: dict
-        if json_data is None:
-            logger.warning('Connection is closed by client.')
-            break
-        # Receive packets
+    if state is None:
+        state = ConnectionState()
+    # ACK for "Three Body". If you never read the book "Three Body",
+    # just understand the following part as an Echo function. This part is out of the protocol.
+    # This is an Easter egg. Aha, this is a very good book.
+    if FIELD_DIRECTION in json_data:
+        if json_data[FIELD_DIRECTION] == DIR_EARTH:
+            connection_socket.send(
+                make_response_packet('3BODY', 333, 'DANGEROUS', f'DO NOT ANSWER! DO NOT ANSWER! DO NOT ANSWER!', {}))
+            return
 
-        # ACK for "Three Body". If you never read the book "Three Body",
-        # just understand the following part as an Echo function. This part is out of the protocol.
-        # This is an Easter egg. Aha, this is a very good book.
-        if FIELD_DIRECTION in json_data:
-            if json_data[FIELD_DIRECTION] == DIR_EARTH:
-                connection_socket.send(
-                    make_response_packet('3BODY', 333, 'DANGEROUS', f'DO NOT ANSWER! DO NOT ANSWER! DO NOT ANSWER!', {}))
-                continue
+    # Check the compulsory fields
+    compulsory_fields = [FIELD_OPERATION, FIELD_DIRECTION, FIELD_TYPE]
 
-        # Check the compulsory fields
-        compulsory_fields = [FIELD_OPERATION, FIELD_DIRECTION, FIELD_TYPE]
+    check_ok = True
+    for _compulsory_fields in compulsory_fields:
+        if _compulsory_fields not in list(json_data.keys()):
+            connection_socket.send(
+                make_response_packet(OP_ERROR, 400, 'ERROR', f'Compulsory field {_compulsory_fields} is missing.',
+                                     {}))
+            check_ok = False
+            break
+    if check_ok is False:
+        return
 
-        check_ok = True
-        for _compulsory_fields in compulsory_fields:
-            if _compulsory_fields not in list(json_data.keys()):
-                connection_socket.send(
-                    make_response_packet(OP_ERROR, 400, 'ERROR', f'Compulsory field {_compulsory_fields} is missing.',
-                                         {}))
-                check_ok = False
-                break
-        if check_ok is False:
-            continue
+    request_type = json_data[FIELD_TYPE]
+    request_operation = json_data[FIELD_OPERATION]
+    request_direction = json_data[FIELD_DIRECTION]
 
-        request_type = json_data[FIELD_TYPE]
-        request_operation = json_data[FIELD_OPERATION]
-        request_direction = json_data[FIELD_DIRECTION]
+    if request_direction != DIR_REQUEST:
+        connection_socket.send(
+            make_response_packet(OP_ERROR, 407, 'ERROR', f'Wrong direction. Should be "REQUEST"', {}))
+        return
 
-        if request_direction != DIR_REQUEST:
-            connection_socket.send(
-                make_response_packet(OP_ERROR, 407, 'ERROR', f'Wrong direction. Should be "REQUEST"', {}))
-            continue
+    if request_operation not in [OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN, OP_RESUME,
+                                 OP_STAT]:
+        connection_socket.send(
+            make_response_packet(OP_ERROR, 408, 'ERROR', f'Operation {request_operation} is not allowed', {}))
+        return
 
-        if request_operation not in [OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN]:
+    if request_type not in [TYPE_FILE, TYPE_DATA, TYPE_AUTH]:
+        connection_socket.send(
+            make_response_packet(OP_ERROR, 409, 'ERROR', f'Type {request_type} is not allowed', {}))
+        return
+    # All about checking key data
+    if request_operation == OP_LOGIN:
+        if request_type != TYPE_AUTH:
             connection_socket.send(
-                make_response_packet(OP_ERROR, 408, 'ERROR', f'Operation {request_operation} is not allowed', {}))
-            continue
+                make_response_packet(OP_LOGIN, 409, TYPE_AUTH, f'Type of LOGIN has to be AUTH.', {}))
+            return
+        else:
+            if FIELD_USERNAME not in json_data.keys():
+                connection_socket.send(
+                    make_response_packet(OP_LOGIN, 410, TYPE_AUTH, f'"username" has to be a field for LOGIN', {}))
+                return
+            if FIELD_PASSWORD not in json_data.keys():
+                connection_socket.send(
+                    make_response_packet(OP_LOGIN, 410, TYPE_AUTH, f'"password" has to be a field for LOGIN', {}))
+                return
 
-        if request_type not in [TYPE_FILE, TYPE_DATA, TYPE_AUTH]:
-            connection_socket.send(
-                make_response_packet(OP_ERROR, 409, 'ERROR', f'Type {request_type} is not allowed', {}))
-            continue
-        # All about checking key data
-        if request_operation == OP_LOGIN:
-            if request_type != TYPE_AUTH:
+            # Check the username and password
+            if hashlib.md5(json_data[FIELD_USERNAME].encode()).hexdigest().lower() != json_data['password'].lower():
                 connection_socket.send(
-                    make_response_packet(OP_LOGIN, 409, TYPE_AUTH, f'Type of LOGIN has to be AUTH.', {}))
-                continue
+                    make_response_packet(OP_LOGIN, 401, TYPE_AUTH, f'"Password error for login.', {}))
+                return
             else:
-                if FIELD_USERNAME not in json_data.keys():
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 410, TYPE_AUTH, f'"username" has to be a field for LOGIN', {}))
-                    continue
-                if FIELD_PASSWORD not in json_data.keys():
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 410, TYPE_AUTH, f'"password" has to be a field for LOGIN', {}))
-                    continue
-
-                # Check the username and password
-                if hashlib.md5(json_data[FIELD_USERNAME].encode()).hexdigest().lower() != json_data['password'].lower():
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 401, TYPE_AUTH, f'"Password error for login.', {}))
-                    continue
-                else:
-                    # Login successful
-                    user_str = f'{json_data[FIELD_USERNAME].replace(".", "_")}.' \
-                               f'{get_time_based_filename("login")}'
-                    md5_auth_str = hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest()
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 200, TYPE_AUTH, f'Login successfully', {
-                            FIELD_TOKEN: base64.b64encode(f'{user_str}.{md5_auth_str}'.encode()).decode()
-                        }))
-                    continue
-
-        # If the operation is not LOGIN, check token
-        if FIELD_TOKEN not in json_data.keys():
-            connection_socket.send(
-                make_response_packet(request_operation, 403, TYPE_AUTH, f'No token.', {}))
-            continue
-
-        token = json_data[FIELD_TOKEN]
-        token = base64.b64decode(token).decode()
-        token: str
+                # Login successful
+                user_str = f'{json_data[FIELD_USERNAME].replace(".", "_")}.' \
+                           f'{get_time_based_filename("login")}'
+                md5_auth_str = hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest()
+                rval = {
+                    FIELD_TOKEN: base64.b64encode(f'{user_str}.{md5_auth_str}'.encode()).decode()
+                }
+                if json_data.get(FIELD_HEADER) == 'binary':
+                    # The client may use binary headers from now on, json still works
+                    rval[FIELD_HEADER] = 'binary'
+                if content_store is not None:
+                    # A SAVE with the "md5" of stored content completes at once
+                    rval[FIELD_DEDUP] = True
+                if isinstance(json_data.get(FIELD_COMPRESSION), list):
+                    # The compression methods both sides know
+                    rval[FIELD_COMPRESSION] = [method for method in COMPRESSIONS
+                                               if method in json_data[FIELD_COMPRESSION]]
+                connection_socket.send(
+                    make_response_packet(OP_LOGIN, 200, TYPE_AUTH, f'Login successfully', rval))
+                return
 
-        if len(token.split('.')) != 4:
-            connection_socket.send(
-                make_response_packet(request_operation, 403, TYPE_AUTH, f'Token format is wrong.', {}))
-            continue
+    # If the operation is not LOGIN, check token
+    if FIELD_TOKEN not in json_data.keys():
+        connection_socket.send(
+            make_response_packet(request_operation, 403, TYPE_AUTH, f'No token.', {}))
+        return
 
-        user_str = ".".join(token.split('.')[:3])
-        md5_auth_str = token.split('.')[3]
-        if hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest().lower() != md5_auth_str.lower():
+    token = json_data[FIELD_TOKEN]
+    if token == state.token:
+        # Same token as the previous request on this connection, already checked
+        username = state.username
+    else:
+        username, error_msg = check_token(token)
+        if username is None:
             connection_socket.send(
-                make_response_packet(request_operation, 403, TYPE_AUTH, f'Token is wrong.', {}))
-            continue
+                make_response_packet(request_operation, 403, TYPE_AUTH, error_msg, {}))
+            return
+        state.token, state.username = token, username
+        ensure_user_dirs(username)
 
-        username = token.split('.')[0]
+    # Check the token (authentication credentials) and then verify the information in it.
 
-        os.makedirs(join('data', username), exist_ok=True)
-        os.makedirs(join('file', username), exist_ok=True)
-        os.makedirs(join('tmp', username), exist_ok=True)
+    if request_operation == OP_STAT:
+        connection_socket.send(
+            make_response_packet(OP_STAT, 200, request_type, f'OK. These are the server metrics.', metrics.snapshot()))
+        return
 
-        # Check the token (authentication credentials) and then verify the information in it.
+    if request_type == TYPE_DATA:
+        data_process(username, request_operation, json_data, connection_socket)
+        return
 
-        if request_type == TYPE_DATA:
-            data_process(username, request_operation, json_data, connection_socket)
-            continue
+    if request_type == TYPE_FILE:
+        file_process(username, request_operation, json_data, bin_data, connection_socket)
+        return
 
-        if request_type == TYPE_FILE:
-            file_process(username, request_operation, json_data, bin_data, connection_socket)
-            continue
 
-    connection_socket.close()
+def STEP_service(connection_socket, addr):
+    """
+    STEP Protocol service
+    :param connection_socket:
+    :param addr:
+    :return: None
+    """
+    global logger
+    state = ConnectionState()
+    reader = FrameReader(connection_socket, table=state.table)
+    # The socket stays blocking (sendfile), the wait for the next request is polled instead
+    poller = select.poll() if IDLE_TIMEOUT > 0 and hasattr(select, 'poll') else None
+    if poller is not None:
+        poller.register(connection_socket, select.POLLIN)
+    metrics.add_connection(1)
+    try:
+        while True:
+            if poller is not None and reader.buffered() is False and not poller.poll(IDLE_TIMEOUT * 1000):
+                # An idle connection must not keep a pool thread from the ones waiting
+                logger.warning(f'Connection idle for {IDLE_TIMEOUT} s, closed.')
+                break
+            json_data, bin_data = reader.read_frame()
+            json_data: dict
+            if json_data is None:
+                logger.warning('Connection is closed by client.')
+                break
+            # Receive packets
+            metrics.add_bytes_in(reader.frame_size)
+            state.binary = reader.binary
+            STEP_request(connection_socket, json_data, bin_data, state)
+    finally:
+        # Also after a reset connection or a failed request
+        metrics.add_connection(-1)
+        connection_socket.close()
     logger.info(f'Connection close. {addr}')
 
 
-def Tcp_Listener(server_port, server_ip):
+class ConnectionPool:
+    """
+    Bounded pool of the threads serving connections (thread engine): at most `workers` connections are
+    served at once, at most `pending` accepted connections wait for a thread, the pool refuses the others.
+    A connection that waited max_wait seconds is taken out of the queue and answered busy by the rejector,
+    so a client is never left without an answer while the threads are held by other connections.
+    Threads are started on demand and then kept.
+    """
+
+    def __init__(self, workers, pending, max_wait, rejector):
+        self.workers = workers
+        self.pending = max(pending, 1)
+        self.max_wait = max_wait
+        self.rejector = rejector
+        self.cond = Condition()
+        self.queue = deque()  # (connection_socket, addr, time.monotonic() it was queued), oldest first
+        self.threads = 0
+        self.idle = 0
+        th = Thread(target=self._expire_loop)
+        th.daemon = True
+        th.start()
+
+    def submit(self, connection_socket, addr):
+        """
+        :return: False if every thread is busy and the pending queue is full
+        """
+        with self.cond:
+            if len(self.queue) >= self.pending:
+                return False
+            if self.idle <= len(self.queue) and self.threads < self.workers:
+                self.threads += 1
+                th = Thread(target=self._run)
+                th.daemon = True
+                th.start()
+            self.queue.append((connection_socket, addr, time.monotonic()))
+            self.cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.idle += 1
+                while not self.queue:
+                    self.cond.wait()
+                connection_socket, addr, _ = self.queue.popleft()
+                self.idle -= 1
+            try:
+                STEP_service(connection_socket, addr)
+            except Exception as ex:
+                logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+                connection_socket.close()
+
+    def _expire_loop(self):
+        while True:
+            time.sleep(min(self.max_wait / 4, 0.1))
+            now = time.monotonic()
+            expired = []
+            with self.cond:
+                while self.queue and now - self.queue[0][2] > self.max_wait:
+                    expired.append(self.queue.popleft())
+            for connection_socket, addr, _ in expired:
+                logger.warning(f'<-- Busy: {addr[0]} on {addr[1]} waited {self.max_wait} s for a thread, '
+                               f'told to retry after {RETRY_AFTER_MS} ms.')
+                self.rejector.reject(connection_socket)
+
+
+class BusyRejector:
+    """
+    Answers the connections the pool refused with the busy response and closes them. The socket is
+    half-closed after the answer and what the client still sends is read and dropped (up to LINGER seconds),
+    a close() with unread data would reset the connection before the client reads the answer.
+    One thread watches all of them with a selector.
+    """
+    LINGER = 2
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = Lock()
+        self.deadlines = {}  # socket -> time it is closed anyway
+        th = Thread(target=self._run)
+        th.daemon = True
+        th.start()
+
+    def reject(self, connection_socket):
+        try:
+            connection_socket.setblocking(False)
+            connection_socket.send(make_busy_packet())
+            connection_socket.shutdown(SHUT_WR)
+        except OSError:
+            connection_socket.close()
+            return
+        with self.lock:
+            self.deadlines[connection_socket] = time.monotonic() + self.LINGER
+            self.selector.register(connection_socket, selectors.EVENT_READ)
+
+    def _close(self, connection_socket):
+        with self.lock:
+            self.deadlines.pop(connection_socket, None)
+            self.selector.unregister(connection_socket)
+        connection_socket.close()
+
+    def _run(self):
+        while True:
+            if not self.deadlines:
+                time.sleep(0.1)
+                continue
+            for selector_key, _ in self.selector.select(timeout=0.1):
+                try:
+                    if selector_key.fileobj.recv(65536):
+                        continue
+                except OSError:
+                    pass
+                self._close(selector_key.fileobj)
+            now = time.monotonic()
+            with self.lock:
+                expired = [connection_socket for connection_socket, deadline in self.deadlines.items() if deadline < now]
+            for connection_socket in expired:
+                self._close(connection_socket)
+
+
+def Tcp_Listener(server_port, server_ip, reuse_port=False, backlog=1024, max_connections=1024, max_pending=1024,
+                 max_wait=1.0):
     """
-    TCP listener: liston to a port and assign TCP sub connections using new threads
+    TCP listener: liston to a port and assign TCP sub connections to a bounded pool of threads
     :param server_ip
     :param server_port
+    :param reuse_port: share the port with the other workers
+    :param backlog: of listen()
+    :param max_connections: connections served at once (threads)
+    :param max_pending: accepted connections waiting for a thread, the next ones are answered busy
+    :param max_wait: seconds a connection may wait for a thread before it is answered busy
     :return: None
     """
     global logger
     server_socket = socket(AF_INET, SOCK_STREAM)
     server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     server_socket.bind((server_ip, int(server_port)))
     logger.info('Server is ready!')
     #The following line is also added
-    server_socket.listen(10)
+    server_socket.listen(backlog)
     logger.info(
         f'Start the TCP service, listing {server_port} on IP {"All available" if server_ip == "" else server_ip}')
+    rejector = BusyRejector()
+    pool = ConnectionPool(max_connections, max_pending, max_wait, rejector)
     while True:
         try:
             #The following line is also added
             connection_socket, addr = server_socket.accept()
             logger.info(f'--> New connection from {addr[0]} on {addr[1]}')
-            th = Thread(target=STEP_service, args=(connection_socket, addr))
-            th.daemon = True
-            th.start()
+            if pool.submit(connection_socket, addr) is False:
+                logger.warning(f'<-- Busy: {max_connections} connections served and {max_pending} waiting, '
+                               f'{addr[0]} on {addr[1]} is told to retry after {RETRY_AFTER_MS} ms.')
+                rejector.reject(connection_socket)
         except Exception as ex:
             logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
 
-def main():
+class AsyncConnection:
+    """
+    Socket-like wrapper around an asyncio transport, so that data_process/file_process
+    can keep calling connection_socket.send() from a worker thread.
+    """
+
+    def __init__(self, loop, transport):
+        self.loop = loop
+        self.transport = transport
+
+    def send(self, data):
+        self.loop.call_soon_threadsafe(self.transport.write, bytes(data))
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+
+class RequestAdmission:
+    """
+    Requests of the asyncio engine that are in the worker pool, running or waiting for a thread.
+    Only changed on the event loop.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+
+
+async def STEP_service_async(reader, writer, executor, admission):
+    """
+    STEP Protocol service on the asyncio engine. Frames are read on the event loop,
+    requests are handled in the shared worker pool one after another for each connection.
+    A request that finds admission.limit requests in the pool is answered busy at once.
+    :param reader: asyncio.StreamReader
+    :param writer: asyncio.StreamWriter
+    :param executor: the request worker pool
+    :param admission: RequestAdmission shared by the connections
+    :return: None
+    """
+    global logger
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info('peername')
+    logger.info(f'--> New connection from {addr[0]} on {addr[1]}')
+    connection = AsyncConnection(loop, writer.transport)
+    state = ConnectionState()
+    metrics.add_connection(1)
+    try:
+        while True:
+            try:
+                j_len, b_len = struct.unpack('!II', await reader.readexactly(8))
+                state.binary = j_len & BINARY_HEADER_FLAG != 0
+                j_len &= ~BINARY_HEADER_FLAG
+                j_bin = await reader.readexactly(j_len)
+                bin_data = await reader.readexactly(b_len)
+                if state.binary:
+                    json_data = decode_binary_header(j_bin, state.table)
+                else:
+                    json_data = json.loads(j_bin.decode())
+            except Exception:
+                logger.warning('Connection is closed by client.')
+                break
+            metrics.add_bytes_in(8 + j_len + b_len)
+            if admission.in_flight >= admission.limit:
+                logger.warning(f'<-- Busy: {admission.in_flight} requests in the pool, retry after {RETRY_AFTER_MS} ms.')
+                writer.write(make_busy_packet(json_data, state.table if state.binary else None))
+            else:
+                admission.in_flight += 1
+                try:
+                    await loop.run_in_executor(executor, STEP_request, connection, json_data, bin_data, state)
+                finally:
+                    admission.in_flight -= 1
+            try:
+                await writer.drain()
+            except ConnectionError:
+                break
+    finally:
+        # Also after a reset connection or a failed request
+        metrics.add_connection(-1)
+        writer.close()
+    logger.info(f'Connection close. {addr}')
+
+
+async def _async_listener(server_port, server_ip, async_threads, reuse_port, backlog, max_pending):
     global logger
-    logger = set_logger('STEP')
+    executor = ThreadPoolExecutor(max_workers=async_threads)
+    admission = RequestAdmission(async_threads + max_pending)
+    server = await asyncio.start_server(lambda r, w: STEP_service_async(r, w, executor, admission),
+                                        host=server_ip or None, port=int(server_port),
+                                        reuse_address=True, reuse_port=reuse_port or None, backlog=backlog)
+    logger.info('Server is ready!')
+    logger.info(
+        f'Start the asyncio TCP service, listing {server_port} on IP {"All available" if server_ip == "" else server_ip}')
+    async with server:
+        await server.serve_forever()
+
+
+def Async_Listener(server_port, server_ip, async_threads=16, reuse_port=False, backlog=1024, max_pending=1024):
+    """
+    asyncio listener: one event loop owns every connection, the requests are handled by a bounded
+    thread pool instead of one thread per connection
+    :param server_ip
+    :param server_port
+    :param async_threads: size of the request worker pool
+    :param reuse_port: share the port with the other workers
+    :param backlog: of listen()
+    :param max_pending: requests waiting for a worker thread, the next ones are answered busy
+    :return: None
+    """
+    asyncio.run(_async_listener(server_port, server_ip, async_threads, reuse_port, backlog, max_pending))
+
+
+def serve(parser):
+    """
+    Open the stores and run the connection engine, in the server process or in one worker
+    :param parser: the parsed arguments
+    :return: None
+    """
+    global content_store, data_store
+    if parser.dedup:
+        content_store = ContentStore('cas')
+    if parser.data_backend == 'log':
+        data_store = LogStore('kv', cache_entries=parser.data_cache)
+    if parser.metrics_port is not None:
+        start_metrics_http(parser.metrics_port + max(WORKER_ID - 1, 0), parser.ip)
+    if COALESCE_BYTES > 0:
+        Thread(target=write_behind_loop, daemon=True).start()
+    #The following li  e is also changed
+    if parser.engine == 'async':
+        Async_Listener(parser.port, parser.ip, parser.async_threads, reuse_port=WORKERS > 1,
+                       backlog=parser.backlog, max_pending=parser.max_pending)
+    else:
+        Tcp_Listener(parser.port, parser.ip, reuse_port=WORKERS > 1, backlog=parser.backlog,
+                     max_connections=parser.max_connections, max_pending=parser.max_pending,
+                     max_wait=max(parser.max_wait, 1) / 1000)
+
+
+def run_workers(parser):
+    """
+    Fork the --workers processes, each binds the port with SO_REUSEPORT and runs serve(); a worker that
+    exits is started again, SIGTERM/SIGINT stop them all. Every worker logs to log/STEP-<id>/.
+    :param parser: the parsed arguments
+    :return: None
+    """
+    children = {}  # pid -> worker id
+
+    def spawn(worker_id):
+        global logger, WORKER_ID
+        pid = os.fork()
+        if pid != 0:
+            children[pid] = worker_id
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        WORKER_ID = worker_id
+        logger = set_logger(f'STEP-{worker_id}', getattr(logging, parser.log_level), parser.block_log_every)
+        try:
+            serve(parser)
+        except Exception as ex:
+            logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+        finally:
+            for handler in logger.handlers:
+                if getattr(handler, 'listener', None) is not None:
+                    handler.listener.stop()
+            os._exit(1)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_id in range(1, WORKERS + 1):
+        spawn(worker_id)
+    logger.info(f'Started {WORKERS} workers on port {parser.port}: {sorted(children, key=children.get)}')
+    while True:
+        pid, status = os.wait()
+        worker_id = children.pop(pid, None)
+        if worker_id is None:
+            continue
+        logger.error(f'Worker {worker_id} (pid {pid}) exited with status {status}, starting it again.')
+        time.sleep(1)
+        spawn(worker_id)
+
+
+def main():
+    global logger, FULL_MD5, MIN_BLOCK_SIZE, MAX_BLOCK_SIZE, COMPRESS_LEVEL, WORKERS, RETRY_AFTER_MS, IDLE_TIMEOUT
+    global RESERVE_BYTES, QUOTA_BYTES, DURABILITY, COALESCE_BYTES, COALESCE_SECONDS, FSYNC_BYTES
     parser = _argparse()
-    server_ip = parser.ip
-    server_port = parser.port
+    # The supervisor of --workers forks, so it logs without the background thread
+    logger = set_logger('STEP', getattr(logging, parser.log_level), parser.block_log_every,
+                        queued=parser.workers <= 1)
+    FULL_MD5 = parser.full_md5
+    COMPRESS_LEVEL = parser.compress_level
+    MIN_BLOCK_SIZE, MAX_BLOCK_SIZE = parser.min_block_size, parser.max_block_size
+    WORKERS = max(parser.workers, 1)
+    RETRY_AFTER_MS = parser.retry_after
+    IDLE_TIMEOUT = parser.idle_timeout
+    RESERVE_BYTES, QUOTA_BYTES = parser.reserve_mb * 1024 * 1024, parser.quota_mb * 1024 * 1024
+    DURABILITY, FSYNC_BYTES = parser.durability, parser.fsync_mb * 1024 * 1024
+    COALESCE_BYTES, COALESCE_SECONDS = parser.coalesce_kb * 1024, max(parser.coalesce_ms, 1) / 1000
+    if WORKERS > 1:
+        # The blocks of one upload may reach different workers, none of them could see it complete
+        # while another still holds blocks
+        COALESCE_BYTES = FSYNC_BYTES = 0
+    fd_cache.capacity, fd_cache.idle_seconds = max(parser.fd_cache, 1), parser.fd_idle
 
     os.makedirs('data', exist_ok=True)
     os.makedirs('file', exist_ok=True)
-    #The following li  e is also changed
-    Tcp_Listener(server_port, server_ip)
+    os.makedirs('meta', exist_ok=True)
+    if WORKERS == 1:
+        serve(parser)
+        return
+    if SO_REUSEPORT is None or hasattr(os, 'fork') is False:
+        logger.error('--workers needs SO_REUSEPORT and fork(), which this platform does not have.')
+        return
+    if parser.data_backend == 'log':
+        # Its index and cache live in the memory of one process
+        logger.error('--data_backend log can not be shared by --workers, use --data_backend file.')
+        return
+    run_workers(parser)
 
 
 